@@ -1,3 +1,7 @@
 from django.contrib import admin
+from .models import HistorySync, PlayHistory
 
 # Register your models here.
+
+admin.site.register(PlayHistory)
+admin.site.register(HistorySync)
@@ -0,0 +1,183 @@
+'''Async versions of the views that wait on Spotify, used when settings.ASYNC_VIEWS is set.
+
+Served by an ASGI worker, each request or queue job waiting on Spotify is a coroutine
+rather than a blocked thread, so one worker can serve many users at once. Requests for
+pages are fanned out with asyncio.gather through spotify_async. Work that has no async
+version, such as the database and shuffling, runs in a thread.'''
+
+import asyncio
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import render, redirect
+from . import jobs
+from . import metrics
+from . import playlist_cache
+from . import plans
+from . import shuffler
+from . import spotify_async
+from . import spotify_utils
+from .queue_dispatcher import QueueDispatchError
+from .ratelimit import SpotifyUnavailable
+from .views import (get_access_token, get_user_id, liked_weights, playlist_snapshots,
+    playlists_error, playlists_page, queue_error_message, queue_job_args, synced_recency_index,
+    take_songs)
+
+
+async def select(request):
+    '''Async views.select.'''
+
+    if not "access_token" in request.COOKIES or not "refresh_token" in request.COOKIES:
+        return redirect('/login')
+
+    return render(request, "main/select.html", {})
+
+
+async def playlists(request):
+    '''Async views.playlists.'''
+
+    access_token = await sync_to_async(get_access_token)(request)
+    if access_token is None:
+        return JsonResponse({"message": "ERROR: Tokens not set."}, status=401)
+
+    try:
+        user_playlists = await playlist_cache.aget(access_token, get_user_id(request),
+            refresh=request.GET.get("refresh") == "1")
+    except Exception as error:
+        return playlists_error(error)
+
+    return playlists_page(request, user_playlists)
+
+
+async def queue(request):
+    '''Async views.queue. The job runs as a task on this worker's event loop.'''
+
+    job_args = await sync_to_async(queue_job_args)(request)
+    if isinstance(job_args, HttpResponse):
+        return job_args
+
+    job = await jobs.submit_async(queue_job, *job_args)
+
+    return JsonResponse({"job_id": job.id})
+
+
+async def queue_job(job, access_token, selected_playlists, selected_snapshots, queue_limit,
+    sampled=False, user_id=None, liked=False):
+    '''Async views.queue_job.'''
+
+    if selected_snapshots is not None:
+        selected_snapshots = await current_snapshots(access_token, user_id, selected_playlists)
+
+    remaining_songs = None
+    if user_id and selected_snapshots is not None and not sampled and not liked:
+        shuffled_queue = await sync_to_async(_claim_planned)(user_id, selected_playlists,
+            selected_snapshots, queue_limit)
+
+        if len(shuffled_queue) < queue_limit:
+            remaining_songs = await shuffle_tracks(job, access_token, selected_playlists,
+                selected_snapshots, None, user_id=user_id)
+            if remaining_songs is None:
+                return
+            fresh_songs, passed_over = await asyncio.to_thread(take_songs, remaining_songs,
+                queue_limit - len(shuffled_queue), shuffled_queue)
+            shuffled_queue += fresh_songs
+    else:
+        shuffled_queue = await shuffle_tracks(job, access_token, selected_playlists,
+            selected_snapshots, queue_limit, sampled=sampled, user_id=user_id, liked=liked)
+        if shuffled_queue is None:
+            return
+
+    job.update(phase="queuing")
+
+    try:
+        await spotify_async.queue_tracks(access_token, shuffled_queue,
+            progress=lambda tracks_queued: job.update(tracks_queued=tracks_queued))
+        job.finish("Success!")
+    except QueueDispatchError as error:
+        job.finish(queue_error_message(error, len(shuffled_queue)), error=True)
+
+    if remaining_songs is not None:
+        await asyncio.to_thread(_create_plan, user_id, selected_playlists, selected_snapshots,
+            fresh_songs, remaining_songs, passed_over)
+
+
+async def shuffle_tracks(job, access_token, selected_playlists, selected_snapshots, queue_limit,
+    sampled=False, user_id=None, liked=False):
+    '''Async views.shuffle_tracks. Liked Songs are streamed on a thread.'''
+
+    job.update(phase="fetching")
+
+    def progress(tracks_fetched):
+        job.update(tracks_fetched=tracks_fetched)
+
+    weights = None
+
+    try:
+        if sampled:
+            playlists_tracks = await sync_to_async(spotify_utils.sample_tracks_from_playlists,
+                thread_sensitive=False)(access_token, selected_playlists,
+                queue_limit * settings.SAMPLE_POOL_FACTOR, snapshot_ids=selected_snapshots,
+                progress=progress)
+        else:
+            playlists_tracks = await spotify_async.get_tracks_from_playlists(access_token,
+                selected_playlists, snapshot_ids=selected_snapshots, progress=progress)
+
+        if liked:
+            tracks_fetched = sum(len(tracks) for tracks in playlists_tracks)
+            saved_tracks, saved_total = await sync_to_async(spotify_utils.sample_saved_tracks,
+                thread_sensitive=False)(access_token, queue_limit * settings.SAMPLE_POOL_FACTOR,
+                progress=lambda count: progress(tracks_fetched + count))
+            weights = liked_weights(playlists_tracks, saved_total, sampled)
+            playlists_tracks.append(saved_tracks)
+    except SpotifyUnavailable as error:
+        job.finish(f"ERROR: {error}", error=True)
+        return None
+    except:
+        job.finish("ERROR: Could not load playlists.", error=True)
+        return None
+
+    recent_tracks = []
+    recency_index = None
+    if user_id:
+        with metrics.span("history_sync"):
+            recency_index = await sync_to_async(synced_recency_index)(access_token, user_id)
+    else:
+        recent_tracks = await spotify_async.get_recently_played(access_token)
+
+    job.update(phase="shuffling")
+
+    rng = None
+    if settings.SHUFFLE_BACKEND == 'numpy':
+        rng = shuffler.Shuffler.numpy_rng()
+
+    if queue_limit is None:
+        # Ordered as it is taken, which the caller does on a thread
+        return shuffler.Shuffler.iter_multiple_playlists(playlists_tracks, recent_tracks,
+            no_double_artist=True, rng=rng, recency_index=recency_index, weights=weights)
+
+    # Scoring is CPU bound, so it would stall every other request on the loop
+    return await asyncio.to_thread(shuffler.Shuffler.shuffle_multiple_playlists,
+        playlists_tracks, recent_tracks, queue_limit=queue_limit,
+        no_double_artist=True, rng=rng, recency_index=recency_index, weights=weights)
+
+
+async def current_snapshots(access_token, user_id, playlist_ids):
+    '''Async views.current_snapshots.'''
+
+    try:
+        user_playlists = await playlist_cache.aget(access_token, user_id, refresh=True)
+    except Exception:
+        return None
+
+    return playlist_snapshots(user_playlists, playlist_ids)
+
+
+def _claim_planned(user_id, selected_playlists, selected_snapshots, queue_limit):
+    plan = plans.ShufflePlan.get(user_id, selected_playlists, selected_snapshots)
+    return plan.claim(queue_limit) if plan is not None else []
+
+
+def _create_plan(user_id, selected_playlists, selected_snapshots, fresh_songs,
+    remaining_songs, passed_over):
+    plans.ShufflePlan.create(user_id, selected_playlists, selected_snapshots,
+        fresh_songs + list(remaining_songs) + passed_over, claimed=len(fresh_songs))
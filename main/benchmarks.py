@@ -0,0 +1,187 @@
+'''Benchmark helpers and the Shuffler regression suite.
+
+The suite times the Shuffler on synthetic, Spotify-shaped playlists (see
+fake_spotify.make_playlist, which skews artists and albums the way real libraries are
+skewed) and records peak memory. Results are compared against a JSON baseline saved
+from an earlier run.'''
+
+import json
+import random
+import time
+import tracemalloc
+from .fake_spotify import make_playlist
+from .shuffler import ScoredSong, Shuffler
+from .tracks import TrackRecord
+
+
+def best_time(func, *args, repeat=3):
+    '''Return the fastest of several runs of func(*args) in seconds.'''
+
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - start)
+
+    return min(timings)
+
+def peak_memory(func, *args):
+    '''Return the peak number of bytes allocated while running func(*args).'''
+
+    tracemalloc.start()
+    try:
+        func(*args)
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def percentile(values, fraction):
+    '''Return the value below which the given fraction of values fall, e.g. 0.95 for p95.'''
+
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+def make_records(count, artists=200):
+    '''Build count TrackRecords quickly, for sizes where make_playlist is too slow.'''
+
+    return [TrackRecord(f'spotify:track:{idx}', artist_name=f'Artist {idx % artists}')
+        for idx in range(count)]
+
+def various_artists_queue(count):
+    '''Build count ScoredSongs sorted by a random score, half of them by one artist spread
+    over an album per ten of its tracks, like the "Various Artists" of a library full of
+    compilations. The other half are skewed like make_playlist's.'''
+
+    rng = random.Random(0)
+    queue = []
+    for idx in range(count):
+        if idx % 2:
+            artist = 'Various Artists'
+            album = f'Compilation {idx // 20}'
+        else:
+            artist = f'Artist {int(200 * rng.random() ** 3)}'
+            album = f'{artist} {rng.randrange(5)}'
+        queue.append(ScoredSong(TrackRecord(f'spotify:track:{idx}', artist_name=artist,
+            album_name=album), score=rng.randint(0, 1000)))
+
+    return sorted(queue, key=lambda x: -x.score)
+
+def scored_queue(song_list):
+    '''Wrap tracks the way shuffle_single_playlist does and sort them by a random score.'''
+
+    queue = [ScoredSong(song, score=random.randint(0, 1000))
+        for song in TrackRecord.from_items(song_list)]
+
+    return sorted(queue, key= lambda x: -x.score)
+
+def recently_played_from(song_list, count=50):
+    '''Pick recently played tracks, half from song_list and half from elsewhere.'''
+
+    recently_played = random.sample(song_list, min(count // 2, len(song_list)))
+    recently_played += make_playlist('elsewhere', count - len(recently_played))
+    random.shuffle(recently_played)
+
+    return recently_played
+
+
+def suite_cases(sizes=(1000, 10000), playlist_counts=(2, 8, 32), playlist_size=2000,
+ interleave_counts=(8, 64, 512)):
+    '''Return the regression cases as {name: (func, args)}.
+
+    Inputs are generated here, outside of anything that is timed.'''
+
+    random.seed(0)
+    cases = {}
+
+    for size in sizes:
+        song_list = make_playlist('suite', size)
+        recently_played = recently_played_from(song_list)
+
+        cases[f'shuffle_single_playlist/{size}'] = (
+            lambda songs, recent: Shuffler.shuffle_single_playlist(songs, recent),
+            (song_list, recently_played))
+        cases[f'shuffle_single_playlist/no_double_artist/{size}'] = (
+            lambda songs, recent: Shuffler.shuffle_single_playlist(songs, recent,
+                no_double_artist=True),
+            (song_list, recently_played))
+        cases[f'filter_double_artist/{size}'] = (
+            lambda queue: Shuffler.filter_double_artist(list(queue)),
+            (scored_queue(song_list),))
+        cases[f'filter_double_album/{size}'] = (
+            lambda queue: Shuffler.filter_double_album(list(queue)),
+            (scored_queue(song_list),))
+
+    for count in playlist_counts:
+        playlists = [make_playlist(f'suite{idx}', playlist_size) for idx in range(count)]
+        recently_played = recently_played_from(playlists[0])
+
+        cases[f'shuffle_multiple_playlists/{count}x{playlist_size}'] = (
+            lambda lists, recent: Shuffler.shuffle_multiple_playlists(lists, recent,
+                queue_limit=50, no_double_artist=True),
+            (playlists, recently_played))
+
+    # Many playlists of uneven sizes, where the interleaving itself dominates
+    for count in interleave_counts:
+        lengths = [random.randint(20, 400) for _ in range(count)]
+        records = make_records(sum(lengths))
+        bounds = [0]
+        for size in lengths:
+            bounds.append(bounds[-1] + size)
+        playlists = [records[start:end] for start, end in zip(bounds, bounds[1:])]
+
+        cases[f'interleave/{count}'] = (
+            lambda lists: Shuffler.shuffle_multiple_playlists(lists, [], queue_limit=2000),
+            (playlists,))
+        cases[f'interleave/equal_weights/{count}'] = (
+            lambda lists: Shuffler.shuffle_multiple_playlists(lists, [], queue_limit=2000,
+                weights=[1] * len(lists)),
+            (playlists,))
+
+    return cases
+
+def run_suite(cases, repeat=5):
+    '''Run every case, returning {name: {'seconds': best time, 'peak_bytes': peak memory}}.'''
+
+    results = {}
+
+    for name, (func, args) in cases.items():
+        random.seed(0)
+        seconds = best_time(func, *args, repeat=repeat)
+        random.seed(0)
+        results[name] = {'seconds': seconds, 'peak_bytes': peak_memory(func, *args)}
+
+    return results
+
+def compare(results, baseline, threshold=0.25):
+    '''Return a list of regression messages for results that are worse than baseline
+     by more than threshold (a fraction, 0.25 being 25%).'''
+
+    regressions = []
+
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+
+        for metric in ('seconds', 'peak_bytes'):
+            before = baseline[name][metric]
+            after = result[metric]
+            if before and after > before * (1 + threshold):
+                regressions.append(f'{name} {metric}: {before:.6g} -> {after:.6g}'
+                    f' (+{(after / before - 1) * 100:.0f}%)')
+
+    return regressions
+
+def load_baseline(path):
+    '''Read a baseline written by save_baseline.'''
+
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+def save_baseline(path, results):
+    '''Write suite results to be used as the baseline of later runs.'''
+
+    with open(path, 'w', encoding='utf-8') as file:
+        json.dump(results, file, indent=2, sort_keys=True)
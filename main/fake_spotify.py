@@ -0,0 +1,487 @@
+'''A local stand-in for the Spotify Web API and accounts service.
+
+Serves deterministic, Spotify-shaped playlists so the fetch and queue paths can be
+benchmarked without talking to the real service. Logging in through its accounts
+endpoints gives every login a user of its own, who owns the same playlists.'''
+
+from collections import deque
+import hashlib
+from datetime import datetime, timezone
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlparse, parse_qs
+
+MARKETS = ['AD', 'AR', 'AT', 'AU', 'BE', 'BG', 'BO', 'BR', 'CA', 'CH', 'CL', 'CO', 'CR', 'CY',
+    'CZ', 'DE', 'DK', 'DO', 'EC', 'EE', 'ES', 'FI', 'FR', 'GB', 'GR', 'GT', 'HK', 'HN', 'HU', 'ID',
+    'IE', 'IL', 'IS', 'IT', 'JP', 'LI', 'LT', 'LU', 'LV', 'MC', 'MT', 'MX', 'MY', 'NI', 'NL', 'NO',
+    'NZ', 'PA', 'PE', 'PH', 'PL', 'PT', 'PY', 'RO', 'SE', 'SG', 'SK', 'SV', 'TH', 'TR', 'TW', 'US',
+    'UY', 'VN', 'ZA']
+
+# Unix time in milliseconds of the fake user's first play, 2022-01-01
+FIRST_PLAY_MS = 1640995200000
+
+BASE62 = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+
+
+def spotify_id(name):
+    '''Derive a stable 22 character base62 id, the format spotipy validates, from a name.'''
+
+    number = int.from_bytes(hashlib.sha1(name.encode('utf-8')).digest(), 'big')
+    chars = []
+    for _ in range(22):
+        number, remainder = divmod(number, 62)
+        chars.append(BASE62[remainder])
+
+    return ''.join(chars)
+
+
+def make_track(playlist_id, position, artist_count=200):
+    '''Build a deterministic playlist item for the given playlist position.
+
+    Artists are drawn with a heavy skew so a handful of them dominate each playlist,
+    which is what real libraries look like.
+
+    playlist_id -- id of the playlist the item belongs to.
+
+    position -- index of the item within the playlist.
+
+    artist_count -- number of distinct artists to draw from. (default: 200)'''
+
+    rng = random.Random(f'{playlist_id}:{position}')
+    artist = int(artist_count * rng.random() ** 3)
+    album = f'{artist}-{rng.randrange(5)}'
+    # Roughly one track in ten is shared with the other playlists
+    track_name = f'shared{rng.randrange(1000)}' if rng.random() < 0.1 else f'{playlist_id}-{position}'
+    track_id = spotify_id(track_name)
+
+    album_object = {
+        'id': f'album{album}',
+        'name': f'Album {album}',
+        'uri': f'spotify:album:album{album}',
+        'album_type': 'album',
+        'available_markets': MARKETS,
+        'images': [{'height': size, 'width': size,
+            'url': f'https://i.scdn.co/image/{album}-{size}'} for size in (640, 300, 64)],
+        'release_date': '2020-01-01',
+    }
+    artist_object = {
+        'id': f'artist{artist}',
+        'name': f'Artist {artist}',
+        'uri': f'spotify:artist:artist{artist}',
+        'type': 'artist',
+    }
+
+    return {
+        'added_at': '2022-01-01T00:00:00Z',
+        'is_local': False,
+        'track': {
+            'id': track_id,
+            'name': f'Track {track_name}',
+            'uri': f'spotify:track:{track_id}',
+            'duration_ms': 120000 + rng.randrange(180000),
+            'explicit': False,
+            'popularity': rng.randrange(100),
+            'available_markets': MARKETS,
+            'artists': [artist_object],
+            'album': album_object,
+            'type': 'track',
+        },
+    }
+
+
+def make_playlist(playlist_id, size):
+    '''Build the items of a deterministic playlist of the given size.'''
+
+    return [make_track(playlist_id, position) for position in range(size)]
+
+
+def drop_markets(item):
+    '''Remove the market lists Spotify leaves out when a request names a market.'''
+
+    item['track'].pop('available_markets', None)
+    item['track']['album'].pop('available_markets', None)
+
+
+def parse_fields(fields):
+    '''Parse a Web API fields parameter, e.g. 'total,items(track(uri,name))', into nested
+     dictionaries mapping each selected key to its own selection, or None for all of it.'''
+
+    def parse(position):
+        selection = {}
+        name = ''
+        while position < len(fields):
+            char = fields[position]
+            if char == '(':
+                selection[name], position = parse(position + 1)
+                name = ''
+            elif char == ')':
+                break
+            elif char == ',':
+                if name:
+                    selection[name] = None
+                name = ''
+            else:
+                name += char
+            position += 1
+        if name:
+            selection[name] = None
+        return selection, position
+
+    return parse(0)[0]
+
+
+def project(value, selection):
+    '''Keep only the parts of value picked by a selection from parse_fields.'''
+
+    if selection is None:
+        return value
+    if isinstance(value, list):
+        return [project(element, selection) for element in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], sub) for key, sub in selection.items() if key in value}
+    return value
+
+
+class FakeSpotify:
+    '''Threaded HTTP server that answers the Web API endpoints used by this app.
+
+    playlist_count -- number of playlists the fake user owns. (default: 8)
+
+    playlist_size -- number of tracks in each playlist. (default: 2000)
+
+    latency -- seconds to wait before answering each request. (default: 0)
+
+    throttle_every -- answer every nth request with a 429 instead. (default: 0, never)
+
+    retry_after -- seconds sent in the Retry-After header of 429 responses. (default: 1)
+
+    error_rate -- fraction of requests answered with a 503. (default: 0)
+
+    active_device -- whether queuing succeeds or fails with NO_ACTIVE_DEVICE. (default: True)
+
+    play_count -- number of plays already in the fake user's history, three minutes
+     apart. More can be added with play. (default: 50)
+
+    saved_count -- number of tracks in the fake user's Liked Songs. (default: 2000)
+
+    rate_limit -- requests allowed in any one second, like Spotify's rolling window.
+     Requests over it are answered like throttled ones. (default: 0, no limit)
+
+    token_lifetime -- seconds until the access tokens it hands out expire. (default: 3600)
+
+    log_size -- number of the latest requests kept in request_log as (method, path,
+     params) tuples. (default: 1000)
+
+    Access tokens are not checked, so any token can be used with the Web API. Those
+    handed out by the accounts endpoints make /v1/me answer with their login's user.'''
+
+    def __init__(self, playlist_count=8, playlist_size=2000, latency=0.0, port=0,
+     throttle_every=0, retry_after=1, error_rate=0.0, active_device=True, play_count=50,
+     saved_count=2000, rate_limit=0, token_lifetime=3600, log_size=1000):
+        self.playlist_count = playlist_count
+        self.playlist_size = playlist_size
+        self.saved_count = saved_count
+        self.rate_limit = rate_limit
+        self._arrivals = deque()
+        self.latency = latency
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.active_device = active_device
+        self.token_lifetime = token_lifetime
+        self._edits = {}
+        self.logins = 0
+        self.token_requests = 0
+        self._codes = {}
+        self._token_users = {}
+        self.request_count = 0
+        self.request_log = deque(maxlen=log_size)
+        self.throttled = 0
+        self.failed = 0
+        self.queued = []
+        self.plays = []
+        self._random = random.Random(0)
+        self._lock = threading.Lock()
+        self._server = _Server(('127.0.0.1', port), _make_handler(self))
+        self._thread = None
+        self.play(play_count)
+
+    def play(self, count):
+        '''Add count plays of the first playlist's tracks to the fake user's history.'''
+
+        with self._lock:
+            for _ in range(count):
+                played_at = FIRST_PLAY_MS + len(self.plays) * 180000
+                self.plays.append((played_at, make_track('fake0',
+                    len(self.plays) % self.playlist_size)['track']))
+
+    def edit(self, playlist_id):
+        '''Give the playlist a new snapshot id, as editing it on Spotify would.
+        Its tracks stay the same.'''
+
+        with self._lock:
+            self._edits[playlist_id] = self._edits.get(playlist_id, 0) + 1
+
+    def snapshot_id(self, playlist_id):
+        '''Current snapshot id of the playlist.'''
+
+        edits = self._edits.get(playlist_id, 0)
+        return f'{playlist_id}-snapshot' + (f'-{edits}' if edits else '')
+
+    @property
+    def url(self):
+        '''Base URL to use as SPOTIFY_API_URL.'''
+        return f'{self.accounts_url}v1/'
+
+    @property
+    def accounts_url(self):
+        '''Base URL to use as SPOTIFY_ACCOUNTS_URL.'''
+        return f'http://127.0.0.1:{self._server.server_address[1]}/'
+
+    def playlist_ids(self):
+        '''Ids of the fake user's playlists.'''
+        return [f'fake{idx}' for idx in range(self.playlist_count)]
+
+    def start(self):
+        '''Serve requests on a background thread.'''
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def serve_forever(self):
+        '''Serve requests on the calling thread.'''
+        self._server.serve_forever()
+
+    def stop(self):
+        '''Stop serving and release the port.'''
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def route(self, method, path, params, headers=None):
+        '''Return (status, body) or (status, body, headers) for a request.
+
+        params -- query string and form body parameters.
+
+        headers -- request headers, of which only Authorization is read. (default: None)'''
+
+        with self._lock:
+            self.request_count += 1
+            self.request_log.append((method, path, dict(params)))
+            throttle = self.throttle_every and self.request_count % self.throttle_every == 0
+            if self.rate_limit:
+                now = time.monotonic()
+                while self._arrivals and self._arrivals[0] <= now - 1:
+                    self._arrivals.popleft()
+                if len(self._arrivals) >= self.rate_limit:
+                    throttle = True
+                else:
+                    self._arrivals.append(now)
+            fail = not throttle and self._random.random() < self.error_rate
+            if throttle:
+                self.throttled += 1
+            if fail:
+                self.failed += 1
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if throttle:
+            return 429, {'error': {'status': 429, 'message': 'API rate limit exceeded'}}, \
+                {'Retry-After': str(self.retry_after)}
+
+        if fail:
+            return 503, {'error': {'status': 503, 'message': 'Service unavailable'}}
+
+        if not path.startswith('/v1/'):
+            return self.accounts_route(method, path, params)
+        # spotipy asks for some endpoints, like me/, with a trailing slash
+        path = path.rstrip('/')
+
+        offset = int(params.get('offset', 0))
+
+        if method == 'GET' and path == '/v1/me':
+            access_token = (headers or {}).get('Authorization', '').removeprefix('Bearer ')
+            with self._lock:
+                user_id = self._token_users.get(access_token, 'fake-user')
+            return 200, {'id': user_id, 'display_name': 'Fake User'}
+
+        if method == 'GET' and path == '/v1/me/playlists':
+            limit = int(params.get('limit', 50))
+            ids = self.playlist_ids()
+            items = [{'id': playlist_id, 'name': f'Playlist {playlist_id}',
+                'snapshot_id': self.snapshot_id(playlist_id),
+                'tracks': {'total': self.playlist_size}} for playlist_id in ids[offset:offset + limit]]
+            return 200, {'items': items, 'total': len(ids), 'limit': limit, 'offset': offset}
+
+        match = re.fullmatch(r'/v1/playlists/([^/]+)/(tracks|items)', path)
+        if method == 'GET' and match:
+            playlist_id = match.group(1)
+            if playlist_id not in self.playlist_ids():
+                return 404, {'error': {'status': 404, 'message': 'Not found.'}}
+            limit = int(params.get('limit', 100))
+            end = min(offset + limit, self.playlist_size)
+            items = [make_track(playlist_id, position) for position in range(offset, end)]
+            if 'market' in params:
+                for item in items:
+                    drop_markets(item)
+            next_url = None
+            if end < self.playlist_size:
+                next_url = f'{self.url}playlists/{playlist_id}/{match.group(2)}?offset={end}&limit={limit}'
+            page = {'items': items, 'total': self.playlist_size, 'limit': limit,
+                'offset': offset, 'next': next_url}
+            if params.get('fields'):
+                page = project(page, parse_fields(params['fields']))
+            return 200, page
+
+        if method == 'GET' and path == '/v1/me/tracks':
+            limit = int(params.get('limit', 20))
+            end = min(offset + limit, self.saved_count)
+            items = [make_track('liked', position) for position in range(offset, end)]
+            if 'market' in params:
+                for item in items:
+                    drop_markets(item)
+            next_url = None
+            if end < self.saved_count:
+                next_url = f'{self.url}me/tracks?offset={end}&limit={limit}'
+            return 200, {'items': items, 'total': self.saved_count, 'limit': limit,
+                'offset': offset, 'next': next_url}
+
+        if method == 'GET' and path == '/v1/me/player/recently-played':
+            limit = int(params.get('limit', 20))
+            with self._lock:
+                plays = list(self.plays)
+            if 'after' in params:
+                # The oldest plays after the cursor, returned most recent first like any page
+                plays = [play for play in plays if play[0] > int(params['after'])]
+                more = len(plays) > limit
+                plays = plays[:limit]
+            else:
+                if 'before' in params:
+                    plays = [play for play in plays if play[0] < int(params['before'])]
+                more = len(plays) > limit
+                plays = plays[-limit:]
+
+            items = [{'track': track, 'played_at': datetime.fromtimestamp(played_at / 1000,
+                timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')}
+                for played_at, track in reversed(plays)]
+            cursors = {'after': str(plays[-1][0]), 'before': str(plays[0][0])} if plays else None
+            next_url = None
+            if more:
+                cursor = 'after' if 'after' in params else 'before'
+                next_url = f'{self.url}me/player/recently-played?{cursor}={cursors[cursor]}'
+            return 200, {'items': items, 'limit': limit, 'cursors': cursors, 'next': next_url}
+
+        if method == 'POST' and path == '/v1/me/player/queue':
+            if not self.active_device:
+                return 404, {'error': {'status': 404, 'reason': 'NO_ACTIVE_DEVICE',
+                    'message': 'Player command failed: No active device found'}}
+            with self._lock:
+                self.queued.append(params.get('uri'))
+            return 204, None
+
+        return 404, {'error': {'status': 404, 'message': 'Service not found'}}
+
+    def accounts_route(self, method, path, params):
+        '''route for the accounts endpoints: authorization and tokens.'''
+
+        if method == 'GET' and path == '/authorize':
+            if 'redirect_uri' not in params:
+                return 400, {'error': 'invalid_request',
+                    'error_description': 'Missing redirect_uri'}
+            # Every login is a new user who accepts at once
+            with self._lock:
+                self.logins += 1
+                code = f'fake-code-{self.logins}'
+                self._codes[code] = f'fake-user-{self.logins}'
+            query = {'code': code, **({'state': params['state']} if 'state' in params else {})}
+            separator = '&' if '?' in params['redirect_uri'] else '?'
+            return 302, None, {'Location': params['redirect_uri'] + separator + urlencode(query)}
+
+        if method == 'POST' and path == '/api/token':
+            grant_type = params.get('grant_type')
+            with self._lock:
+                self.token_requests += 1
+                if grant_type == 'authorization_code':
+                    user_id = self._codes.pop(params.get('code'), None)
+                    refresh_token = user_id and f'{user_id}-refresh'
+                elif grant_type == 'refresh_token':
+                    refresh_token = params.get('refresh_token', '')
+                    user_id = refresh_token.endswith('-refresh') and refresh_token[:-8]
+                else:
+                    return 400, {'error': 'unsupported_grant_type'}
+
+                if not user_id:
+                    return 400, {'error': 'invalid_grant',
+                        'error_description': 'Invalid authorization code'}
+
+                access_token = f'{user_id}-access-{self.token_requests}'
+                self._token_users[access_token] = user_id
+
+            body = {'access_token': access_token, 'token_type': 'Bearer',
+                'expires_in': self.token_lifetime,
+                'scope': 'user-library-read user-read-recently-played playlist-read-private'}
+            # Like Spotify, refreshing keeps the refresh token
+            if grant_type == 'authorization_code':
+                body['refresh_token'] = refresh_token
+            return 200, body
+
+        return 404, {'error': {'status': 404, 'message': 'Service not found'}}
+
+
+class _Server(ThreadingHTTPServer):
+    # The default backlog of 5 drops connections when many clients connect at once
+    request_queue_size = 1024
+    daemon_threads = True
+
+
+def _make_handler(fake):
+    class Handler(BaseHTTPRequestHandler):
+        '''Dispatches every request to FakeSpotify.route.'''
+
+        protocol_version = 'HTTP/1.1'
+        # Headers and body are written separately, so Nagle's algorithm would hold the
+        # body back for a delayed ACK on every reused connection
+        disable_nagle_algorithm = True
+
+        def _handle(self, method):
+            url = urlparse(self.path)
+            params = {key: values[0] for key, values in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                body = self.rfile.read(length)
+                if self.headers.get('Content-Type', '').startswith(
+                    'application/x-www-form-urlencoded'):
+                    params.update((key, values[0]) for key, values
+                        in parse_qs(body.decode('utf-8')).items())
+
+            status, body, *headers = fake.route(method, url.path, params, self.headers)
+
+            payload = b'' if body is None else json.dumps(body).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(payload)))
+            for name, value in (headers[0] if headers else {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
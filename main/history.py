@@ -0,0 +1,73 @@
+'''Each user's listening history, kept in the database for recency scoring.
+
+Spotify only reports a user's last 50 plays. Copying them into PlayHistory whenever
+the user queues songs builds up a much longer history, and passing the newest stored
+play as the `after` cursor means each sync only downloads plays that are new.'''
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from . import spotify_utils
+from .models import HistorySync, PlayHistory
+from .tracks import TrackRecord
+
+
+def sync(access_token, user_id, min_interval=None):
+    '''Store the plays the user made since the last sync.
+
+    Returns the number of plays downloaded. Does nothing if the history was synced less
+    than min_interval seconds ago.
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    user_id -- Spotify id of the user the access token belongs to.
+
+    min_interval -- seconds to wait between syncs.
+     (default: settings.HISTORY_SYNC_INTERVAL)'''
+
+    if min_interval is None:
+        min_interval = settings.HISTORY_SYNC_INTERVAL
+
+    state, _ = HistorySync.objects.get_or_create(user_id=user_id)
+    now = timezone.now()
+    if state.synced_at is not None and (now - state.synced_at).total_seconds() < min_interval:
+        return 0
+
+    plays = []
+    for item in spotify_utils.get_plays_after(access_token, after=state.cursor):
+        track = TrackRecord.from_item(item)
+        played_at = parse_datetime(item.get('played_at') or '')
+        if track is not None and played_at is not None:
+            plays.append(PlayHistory(user_id=user_id, track_uri=track.uri, played_at=played_at))
+
+    # Plays overlapping the last sync are skipped by the unique constraint
+    PlayHistory.objects.bulk_create(plays, ignore_conflicts=True)
+
+    if plays:
+        newest = max(play.played_at for play in plays)
+        state.cursor = max(state.cursor or 0, int(newest.timestamp() * 1000))
+    state.synced_at = now
+    state.save()
+
+    return len(plays)
+
+def recency_index(user_id, limit=None):
+    '''Build a recency index, like Shuffler.build_recency_index, from a user's stored plays.
+
+    Maps each track URI to how recently it was last played, 1 being the latest play.
+
+    user_id -- Spotify id of the user.
+
+    limit -- number of most recent plays to consider. (default: settings.HISTORY_RECENCY_LIMIT)'''
+
+    if limit is None:
+        limit = settings.HISTORY_RECENCY_LIMIT
+
+    plays = PlayHistory.objects.filter(user_id=user_id).order_by('-played_at') \
+        .values_list('track_uri', flat=True)[:limit]
+
+    index = {}
+    for rank, track_uri in enumerate(plays.iterator(), 1):
+        index.setdefault(track_uri, rank)
+
+    return index
@@ -0,0 +1,207 @@
+'''Background jobs for work too slow to do inside a request.
+
+Jobs are handed to the backend named by settings.JOB_BACKEND, by default a thread pool
+inside the web process. Their progress is stored in the Django cache named by
+settings.JOB_CACHE_ALIAS, which is file based by default so that whichever gunicorn
+worker receives a status request can answer it. Jobs started by the async views run as
+asyncio tasks on the worker's event loop instead, see submit_async.'''
+
+import asyncio
+import logging
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import caches
+from django.db import close_old_connections
+from django.utils.module_loading import import_string
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    '''Progress of a background job.
+
+    phase -- what the job is doing, e.g. 'fetching', 'queuing' or 'done'.
+
+    tracks_fetched -- number of tracks loaded from Spotify so far.
+
+    tracks_queued -- number of tracks added to the user's queue so far.
+
+    message -- result shown to the user once the job is done.'''
+
+    FIELDS = ('id', 'phase', 'tracks_fetched', 'tracks_queued', 'done', 'error', 'message')
+
+    def __init__(self, id, phase='pending', tracks_fetched=0, tracks_queued=0, done=False,
+     error=False, message=None):
+        self.id = id
+        self.phase = phase
+        self.tracks_fetched = tracks_fetched
+        self.tracks_queued = tracks_queued
+        self.done = done
+        self.error = error
+        self.message = message
+
+    @staticmethod
+    def _key(job_id):
+        return f'job:{job_id}'
+
+    @classmethod
+    def get(cls, job_id):
+        '''Return the job with the given id, or None if it does not exist or has expired.'''
+
+        fields = caches[settings.JOB_CACHE_ALIAS].get(cls._key(job_id))
+        if fields is None:
+            return None
+
+        return cls(**fields)
+
+    def to_dict(self):
+        '''Fields of the job as a dictionary.'''
+
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def save(self):
+        '''Store the job so status requests in any worker can see it.'''
+
+        caches[settings.JOB_CACHE_ALIAS].set(self._key(self.id), self.to_dict(),
+            timeout=settings.JOB_TIMEOUT)
+
+    def update(self, **fields):
+        '''Set the given fields and save the job.'''
+
+        for field, value in fields.items():
+            setattr(self, field, value)
+
+        self.save()
+
+    def finish(self, message, error=False):
+        '''Mark the job as done with a message for the user.'''
+
+        self.update(phase='failed' if error else 'done', done=True, error=error, message=message)
+
+
+class AsyncJob(Job):
+    '''Job of a task on an event loop, saved on a thread so the loop never waits on the
+    cache.
+
+    Saves run one at a time in the order they were made. Saves made while one is running
+    are folded into the next, so a job reporting progress per page writes at most twice
+    whatever the number of pages. save may also be called from threads working for the
+    task.'''
+
+    def __init__(self, id, **fields):
+        super().__init__(id, **fields)
+        self._loop = asyncio.get_running_loop()
+        self._dirty = False
+        self._writer = None
+
+    def save(self):
+        '''Schedule the job to be stored, see asave to wait for it.'''
+
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            self._loop.call_soon_threadsafe(self.save)
+            return
+
+        self._dirty = True
+        if self._writer is None or self._writer.done():
+            self._writer = self._loop.create_task(self._write())
+
+    async def asave(self):
+        '''Store the job and wait until every save made so far has been stored.'''
+
+        self.save()
+        await self._writer
+
+    async def _write(self):
+        while self._dirty:
+            self._dirty = False
+            # Fields are read on the loop, the file cache is written on a thread
+            await asyncio.to_thread(caches[settings.JOB_CACHE_ALIAS].set, self._key(self.id),
+                self.to_dict(), timeout=settings.JOB_TIMEOUT)
+
+
+class LocalBackend:
+    '''Runs jobs on a thread pool inside the web process.
+
+    Stand-in for an external task queue; another backend only needs the same submit method.'''
+
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=settings.JOB_WORKERS,
+            thread_name_prefix='job')
+
+    def submit(self, func):
+        '''Run func() in the background.'''
+
+        self._executor.submit(func)
+
+
+_backend = None
+
+def get_backend():
+    '''Return the process-wide job backend, creating it on first use.
+
+    Created lazily so that each forked gunicorn worker gets its own threads.'''
+
+    global _backend
+    if _backend is None:
+        _backend = import_string(settings.JOB_BACKEND)()
+
+    return _backend
+
+def submit(func, *args, **kwargs):
+    '''Start func(job, *args, **kwargs) in the background and return its Job at once.
+
+    Exceptions escaping func mark the job as failed.'''
+
+    job = Job(uuid.uuid4().hex)
+    job.save()
+
+    def run():
+        try:
+            func(job, *args, **kwargs)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Job %s failed', job.id)
+            job.finish('ERROR: Something went wrong.', error=True)
+        finally:
+            # Jobs run outside the request cycle that normally closes database connections
+            # and writes out metrics
+            close_old_connections()
+            metrics.flush()
+
+    get_backend().submit(run)
+
+    return job
+
+_tasks = set()
+
+async def submit_async(func, *args, **kwargs):
+    '''Start the coroutine func(job, *args, **kwargs) as a task on the running event loop
+    and return its AsyncJob once it has been stored.
+
+    For the async views, whose jobs wait on Spotify without holding a thread.
+    Exceptions escaping func mark the job as failed.'''
+
+    job = AsyncJob(uuid.uuid4().hex)
+    await job.asave()
+
+    async def run():
+        try:
+            await func(job, *args, **kwargs)
+        except Exception: # pylint: disable=broad-except
+            logger.exception('Job %s failed', job.id)
+            job.finish('ERROR: Something went wrong.', error=True)
+        finally:
+            await job.asave()
+            await asyncio.to_thread(metrics.flush)
+
+    # The loop only keeps weak references to its tasks
+    task = asyncio.get_running_loop().create_task(run())
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+    return job
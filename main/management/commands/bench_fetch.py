@@ -0,0 +1,81 @@
+'''Benchmarks fetching playlist tracks against the local Spotify stand-in.'''
+
+import time
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from main import spotify_utils, track_cache
+from main.fake_spotify import FakeSpotify
+from main.tracks import TrackRecord
+
+
+class Command(BaseCommand):
+    help = 'Compare sequential and concurrent playlist fetching against a fake Spotify API.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--playlists', type=int, default=8)
+        parser.add_argument('--playlist-size', type=int, default=2000)
+        parser.add_argument('--latency', type=float, default=0.05,
+            help='Simulated round trip time in seconds.')
+        parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 8, 16],
+            help='Concurrency levels to measure. 1 is the old sequential behaviour.')
+
+    def handle(self, *args, **options):
+        with FakeSpotify(playlist_count=options['playlists'],
+            playlist_size=options['playlist_size'], latency=options['latency']) as fake:
+            # Keep benchmark entries out of the shared track cache
+            with override_settings(SPOTIFY_API_URL=fake.url, TRACK_CACHE_ALIAS='default'):
+                self.stdout.write(f'{options["playlists"]} playlists x {options["playlist_size"]}'
+                    f' tracks, {options["latency"] * 1000:.0f} ms latency')
+                self.stdout.write('workers | requests | seconds')
+
+                for workers in options['workers']:
+                    fake.request_count = 0
+                    start = time.perf_counter()
+                    spotify_utils.get_tracks_from_playlists('fake-token', fake.playlist_ids(),
+                        max_workers=workers)
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f'{workers:7} | {fake.request_count:8} | {elapsed:7.2f}')
+
+                self.stdout.write('\nSnapshot cache, first and repeat shuffle')
+                self.stdout.write('   run | requests | seconds')
+                track_cache.clear()
+                snapshot_ids = [f'{playlist_id}-snapshot' for playlist_id in fake.playlist_ids()]
+
+                for run in ('cold', 'warm'):
+                    fake.request_count = 0
+                    start = time.perf_counter()
+                    spotify_utils.get_tracks_from_playlists('fake-token', fake.playlist_ids(),
+                        snapshot_ids=snapshot_ids)
+                    elapsed = time.perf_counter() - start
+                    self.stdout.write(f'{run:>6} | {fake.request_count:8} | {elapsed:7.2f}')
+
+                self.stdout.write(f'{track_cache.stats()}')
+                self.stdout.write(f'Shared session: {spotify_utils.connection_stats()}')
+
+                self.stdout.write('\nPer 1k tracks, full items against the field projection')
+                self.stdout.write('   request |     KB | parse (ms)')
+                for name, params in (('full', {}), ('projected', {
+                    'fields': spotify_utils.TRACK_PAGE_FIELDS, 'market': 'from_token'})):
+                    kilobytes, milliseconds = self.page_cost(fake, params)
+                    self.stdout.write(f'{name:>10} | {kilobytes:6.0f} | {milliseconds:10.2f}')
+
+    @staticmethod
+    def page_cost(fake, params):
+        '''Return the KB transferred and milliseconds spent parsing into TrackRecords,
+         per 1000 tracks, for the pages of one playlist.'''
+
+        session = spotify_utils.get_session()
+        transferred = 0
+        parse_time = 0.0
+        tracks = 0
+
+        for offset in range(0, fake.playlist_size, 100):
+            response = session.get(f'{fake.url}playlists/{fake.playlist_ids()[0]}/items',
+                params=dict(params, offset=offset, limit=100))
+            transferred += len(response.content)
+
+            start = time.perf_counter()
+            tracks += len(TrackRecord.from_items(response.json()['items']))
+            parse_time += time.perf_counter() - start
+
+        return transferred / tracks, parse_time * 1000 * 1000 / tracks
@@ -0,0 +1,71 @@
+'''Runs the Shuffler benchmark suite and checks it against a saved baseline.'''
+
+import os
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from main import benchmarks
+
+
+class Command(BaseCommand):
+    help = ('Time the Shuffler on synthetic playlists and fail if any case got slower or'
+        ' used more memory than the saved baseline.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--baseline', default=os.path.join(settings.BASE_DIR,
+            'bench_baseline.json'), help='JSON file holding the baseline results.')
+        parser.add_argument('--save', action='store_true',
+            help='Store this run as the new baseline instead of comparing against it.')
+        parser.add_argument('--require-baseline', action='store_true',
+            help='Fail if there is no baseline, or it has no result for one of the cases,'
+            ' instead of only printing the timings. For CI, where a missing baseline would'
+            ' otherwise let every regression through.')
+        parser.add_argument('--threshold', type=float, default=0.25,
+            help='Allowed slowdown or memory growth as a fraction. (default: 0.25)')
+        parser.add_argument('--repeat', type=int, default=5,
+            help='Runs per case; the fastest one is kept.')
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000])
+        parser.add_argument('--playlist-counts', type=int, nargs='+', default=[2, 8, 32])
+        parser.add_argument('--playlist-size', type=int, default=2000)
+        parser.add_argument('--interleave-counts', type=int, nargs='+', default=[8, 64, 512],
+            help='Numbers of small, uneven playlists to interleave.')
+
+    def handle(self, *args, **options):
+        cases = benchmarks.suite_cases(sizes=options['sizes'],
+            playlist_counts=options['playlist_counts'], playlist_size=options['playlist_size'],
+            interleave_counts=options['interleave_counts'])
+        results = benchmarks.run_suite(cases, repeat=options['repeat'])
+
+        baseline = {}
+        if not options['save'] and os.path.exists(options['baseline']):
+            baseline = benchmarks.load_baseline(options['baseline'])
+
+        self.stdout.write(f'{"case":55} | {"seconds":>9} | {"baseline":>9} | {"peak MB":>8}')
+        for name, result in results.items():
+            before = baseline.get(name, {}).get('seconds')
+            before = f'{before:9.4f}' if before is not None else f'{"-":>9}'
+            self.stdout.write(f'{name:55} | {result["seconds"]:9.4f} | {before} | '
+                f'{result["peak_bytes"] / 2 ** 20:8.2f}')
+
+        if options['save']:
+            benchmarks.save_baseline(options['baseline'], results)
+            self.stdout.write(f'Saved baseline to {options["baseline"]}')
+            return
+
+        if options['require_baseline']:
+            if not baseline:
+                raise CommandError(f'No baseline at {options["baseline"]}; run with --save'
+                    ' to create one.')
+            missing = [name for name in results if name not in baseline]
+            if missing:
+                raise CommandError('Cases missing from the baseline, run with --save to'
+                    ' add them:\n' + '\n'.join(missing))
+
+        if not baseline:
+            self.stdout.write(f'No baseline at {options["baseline"]}; run with --save to create one.')
+            return
+
+        regressions = benchmarks.compare(results, baseline, threshold=options['threshold'])
+        if regressions:
+            raise CommandError('Performance regressions:\n' + '\n'.join(regressions))
+
+        self.stdout.write(self.style.SUCCESS('No regressions.'))
@@ -0,0 +1,155 @@
+'''Microbenchmarks for the Shuffler.'''
+
+import random
+import time
+from django.core.management.base import BaseCommand
+from main.benchmarks import best_time, make_records, scored_queue, various_artists_queue
+from main.fake_spotify import make_playlist
+from main.shuffler import Shuffler
+
+
+def legacy_recency_match(song_list, recently_played):
+    '''The nested-loop matching shuffle_single_playlist used before build_recency_index.'''
+
+    queue = [{'song' : song, 'score': 0, 'recently_played': None} for song in song_list]
+
+    for i, recency_index in enumerate(recently_played):
+        for j, queue_track in enumerate(queue):
+            if recency_index['track']['uri'] == queue_track['song']['track']['uri']:
+                queue[j]['recently_played'] = i + 1
+                break
+
+    return queue
+
+def indexed_recency_match(song_list, recently_played):
+    '''Recency matching through build_recency_index.'''
+
+    recency_index = Shuffler.build_recency_index(recently_played)
+
+    return [{'song' : song, 'score': 0, 'recently_played': recency_index.get(song['track']['uri'])}
+        for song in song_list]
+
+def legacy_filter_double_artist(queue):
+    '''The swap loop Shuffler.filter_double_artist used before space_out.'''
+
+    for i in range(1, len(queue)-1):
+        cur_artist = queue[i]["song"]["track"]["artists"][0]["name"]
+        prev_artist = queue[i-1]["song"]["track"]["artists"][0]["name"]
+
+        if cur_artist == prev_artist:
+            for j in range(i+1, len(queue)):
+                j_artist = queue[j]["song"]["track"]["artists"][0]["name"]
+
+                if cur_artist != j_artist:
+                    temp = queue[j]
+                    queue[j] = queue[i]
+                    queue[i] = temp
+
+    return queue
+
+def legacy_artist_key(song_dict):
+    '''Artist of a legacy_queue entry.'''
+
+    return song_dict["song"]["track"]["artists"][0]["name"]
+
+def count_repeats(queue, key):
+    '''Count tracks that share a key with the track right before them.'''
+
+    return sum(1 for prev, cur in zip(queue, queue[1:]) if key(prev) == key(cur))
+
+def legacy_queue(queue):
+    '''Convert a scored_queue to the dictionaries the old filters worked on.'''
+
+    return [{'song': {'track': {'artists': [{'name': x.song.artist_name}],
+        'album': {'name': x.song.album_name}}}, 'score': x.score} for x in queue]
+
+
+class Command(BaseCommand):
+    help = 'Time Shuffler internals against their previous implementations.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('benchmark', choices=['recency', 'spacing', 'scoring'])
+        parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000, 10000, 50000],
+            help='Playlist sizes to measure.')
+        parser.add_argument('--playlists', type=int, default=8,
+            help='Playlists per shuffle; recency matching runs once per playlist.')
+        parser.add_argument('--min-gap', type=int, default=1,
+            help='Gap used by the spacing benchmark.')
+
+    def handle(self, *args, **options):
+        getattr(self, f'bench_{options["benchmark"]}')(options)
+
+    def bench_recency(self, options):
+        '''Match 50 recently played tracks against playlists of growing size.'''
+
+        self.stdout.write(f'Recency matching for {options["playlists"]} playlists, 50 recent plays')
+        self.stdout.write('   tracks | nested (s) | index (s) | speedup')
+
+        for size in options['sizes']:
+            song_list = make_playlist('bench', size)
+            # Half of the recent plays are in the playlist, half are not
+            recently_played = random.sample(song_list, 25) + make_playlist('elsewhere', 25)
+            random.shuffle(recently_played)
+
+            legacy = best_time(lambda: [legacy_recency_match(song_list, recently_played)
+                for _ in range(options['playlists'])])
+            indexed = best_time(lambda: [indexed_recency_match(song_list, recently_played)
+                for _ in range(options['playlists'])])
+
+            self.stdout.write(f'{size:9} | {legacy:10.4f} | {indexed:9.4f} | {legacy / indexed:6.1f}x')
+
+    def bench_spacing(self, options):
+        '''Space out tracks by artist with the old swap loop and with space_out.
+
+        The last column spaces out artists and albums where one artist spans an album for
+        every ten of its tracks, see various_artists_queue.'''
+
+        self.stdout.write('No double artist, old swap loop against space_out')
+        self.stdout.write('   tracks | swap (s) | repeats | space_out (s) | repeats | '
+            'artist+album (s) | various artists (s)')
+
+        for size in options['sizes']:
+            queue = scored_queue(make_playlist('bench', size))
+
+            start = time.perf_counter()
+            legacy = legacy_filter_double_artist(legacy_queue(queue))
+            legacy_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            spaced = Shuffler.space_out(list(queue), [Shuffler.artist_key],
+                min_gap=options['min_gap'])
+            spaced_time = time.perf_counter() - start
+
+            both_time = best_time(Shuffler.space_out, list(queue),
+                [Shuffler.artist_key, Shuffler.album_key], options['min_gap'])
+            various_time = best_time(Shuffler.space_out, various_artists_queue(size),
+                [Shuffler.artist_key, Shuffler.album_key], options['min_gap'])
+
+            self.stdout.write(f'{size:9} | {legacy_time:8.3f} | '
+                f'{count_repeats(legacy, legacy_artist_key):7} | {spaced_time:13.3f} | '
+                f'{count_repeats(spaced, Shuffler.artist_key):7} | {both_time:16.3f} | '
+                f'{various_time:19.3f}')
+
+    def bench_scoring(self, options):
+        '''Score and order a playlist with the Python and numpy backends.'''
+
+        rng = Shuffler.numpy_rng(0)
+        if rng is None:
+            self.stderr.write('numpy is not installed, only the Python backend is available.')
+
+        self.stdout.write('Score and sort one playlist, 50 recent plays')
+        self.stdout.write('   tracks | python (s) | numpy (s) | speedup')
+
+        for size in options['sizes']:
+            song_list = make_records(size)
+            recently_played = random.sample(song_list, min(50, size))
+            recency_index = Shuffler.build_recency_index(recently_played)
+
+            python_time = best_time(Shuffler.rank_playlist, song_list, recency_index)
+            if rng is None:
+                self.stdout.write(f'{size:9} | {python_time:10.4f} |')
+                continue
+
+            numpy_time = best_time(Shuffler.rank_playlist, song_list, recency_index, rng)
+            self.stdout.write(f'{size:9} | {python_time:10.4f} | {numpy_time:9.4f} | '
+                f'{python_time / numpy_time:6.1f}x')
@@ -0,0 +1,296 @@
+'''Drives simulated users through the app served like it is deployed, against the fake Spotify.'''
+
+import asyncio
+import importlib.util
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+import httpx
+from main.benchmarks import percentile
+from main.management.commands.loadtest import fake_spotify_process, free_port, wait_for_port
+
+# Modules each deployment mode needs, and whether it serves the async views
+MODES = {
+    'runserver': ((), False),
+    'gunicorn': (('gunicorn',), False),
+    'gunicorn-asgi': (('gunicorn', 'uvicorn'), True),
+    'uvicorn': (('uvicorn',), True),
+}
+
+STEPS = ('login', 'select', 'playlists', 'queue')
+
+_CSRF_TOKEN = re.compile(r'name="csrfmiddlewaretoken" value="([^"]+)"')
+
+
+def server_command(mode, port, options):
+    '''The command line that serves the app on the port in a deployment mode.'''
+
+    manage = str(settings.BASE_DIR / 'manage.py')
+    bind = f'127.0.0.1:{port}'
+    workers = str(options['workers'])
+
+    if mode == 'runserver':
+        return [sys.executable, manage, 'runserver', '--noreload', bind]
+    if mode == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', 'shuffler.wsgi:application', '--bind', bind,
+            '--workers', workers, '--threads', str(options['threads'])]
+    if mode == 'gunicorn-asgi':
+        return [sys.executable, '-m', 'gunicorn', 'shuffler.asgi:application', '--bind', bind,
+            '--workers', workers, '-k', 'uvicorn.workers.UvicornWorker']
+    return [sys.executable, '-m', 'uvicorn', 'shuffler.asgi:application', '--host', '127.0.0.1',
+        '--port', str(port), '--workers', workers, '--no-access-log']
+
+def worker_pids(pid):
+    '''The processes serving requests for a server: its children, or the server itself
+    if it has none. Linux only, returns [] elsewhere.'''
+
+    children = []
+    try:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f'/proc/{entry}/stat', encoding='utf-8') as file:
+                    # The name in brackets may contain spaces, so split after it
+                    fields = file.read().rsplit(')', 1)[1].split()
+            except OSError:
+                continue
+            if int(fields[1]) == pid:
+                children.append(int(entry))
+    except OSError:
+        return []
+
+    return children or [pid]
+
+def peak_rss(pid):
+    '''The most memory the process has had resident, in bytes, or None if unknown.'''
+
+    try:
+        with open(f'/proc/{pid}/status', encoding='utf-8') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return None
+
+@contextmanager
+def app_server(mode, fake_url, options):
+    '''Serve the app in a deployment mode, with its own database, caches and rate limit,
+    and yield its process and base URL.'''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        port = free_port()
+        env = dict(os.environ,
+            SPOTIFY_API_URL=f'{fake_url}v1/', SPOTIFY_ACCOUNTS_URL=fake_url,
+            CLIENT_ID='load-client', CLIENT_SECRET='load-secret',
+            REDIRECT_URI=f'http://127.0.0.1:{port}/callback',
+            ASYNC_VIEWS='1' if MODES[mode][1] else '0',
+            DATABASE_PATH=os.path.join(tmp, 'db.sqlite3'),
+            METRICS_DIR=os.path.join(tmp, 'metrics'),
+            SPOTIFY_RATE_LIMIT_FILE=os.path.join(tmp, 'ratelimit'),
+            **{f'{name}_CACHE_DIR': os.path.join(tmp, name.lower())
+                for name in ('TRACK', 'JOB', 'PLAYLIST', 'PLAN', 'TOKEN')})
+        if options['limiter_rate'] is not None:
+            env['SPOTIFY_RATE_LIMIT'] = str(options['limiter_rate'])
+            env['SPOTIFY_RATE_LIMIT_BURST'] = str(max(int(options['limiter_rate']), 1))
+
+        subprocess.run([sys.executable, str(settings.BASE_DIR / 'manage.py'), 'migrate'],
+            env=env, stdout=subprocess.DEVNULL, check=True)
+
+        with open(os.path.join(tmp, 'server.log'), 'w+', encoding='utf-8') as log:
+            process = subprocess.Popen(server_command(mode, port, options), env=env,
+                stdout=log, stderr=subprocess.STDOUT)
+            try:
+                if not wait_for_port(port, timeout=30):
+                    log.seek(0)
+                    raise CommandError(f'{mode} did not start:\n{log.read()[-2000:]}')
+                yield process, f'http://127.0.0.1:{port}'
+            finally:
+                process.terminate()
+                process.wait()
+
+
+class Command(BaseCommand):
+    help = ('Serve the app in each deployment mode and run many users through login, select'
+        ' and queue at once against a fake Spotify. Reports latency percentiles, throughput'
+        ' and the memory of each worker.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--modes', nargs='+', choices=list(MODES),
+            default=['runserver', 'gunicorn', 'uvicorn'],
+            help='Deployment modes to measure. Modes whose server is not installed are skipped.')
+        parser.add_argument('--users', type=int, default=50,
+            help='Simulated users, each logging in and queuing once.')
+        parser.add_argument('--ramp', type=float, default=0.0,
+            help='Seconds over which the users arrive. 0 has them arrive at once.')
+        parser.add_argument('--workers', type=int, default=2,
+            help='Worker processes, like gunicorn --workers.')
+        parser.add_argument('--threads', type=int, default=4,
+            help='Threads per worker in the gunicorn mode, like gunicorn --threads.')
+        parser.add_argument('--selected', type=int, default=2,
+            help='Playlists each user queues from.')
+        parser.add_argument('--queue-limit', type=int, default=20)
+        parser.add_argument('--timeout', type=float, default=120,
+            help='Seconds a user waits for any one step, and for their queue job, before'
+                ' giving up.')
+        parser.add_argument('--latency', type=float, default=0.05,
+            help='Simulated round trip time to Spotify in seconds.')
+        parser.add_argument('--playlists', type=int, default=20,
+            help='Playlists owned by each user.')
+        parser.add_argument('--playlist-size', type=int, default=500)
+        parser.add_argument('--error-rate', type=float, default=0.0,
+            help='Fraction of requests the fake answers with a 503.')
+        parser.add_argument('--throttle-every', type=int, default=0,
+            help='The fake answers every nth request with a 429.')
+        parser.add_argument('--rate-limit', type=int, default=0,
+            help='Requests the fake allows in any one second, answering the rest with a 429.')
+        parser.add_argument('--retry-after', type=int, default=1,
+            help='Retry-After seconds the fake sends with each 429.')
+        parser.add_argument('--token-lifetime', type=int, default=3600,
+            help='Seconds until the fake\'s access tokens expire.')
+        parser.add_argument('--limiter-rate', type=float,
+            help='SPOTIFY_RATE_LIMIT to serve with, with a burst of one second\'s worth.'
+                ' (default: the setting)')
+
+    def handle(self, *args, **options):
+        summaries = []
+
+        with fake_spotify_process(options) as fake_url:
+            self.stdout.write(f'{options["users"]} users, {options["playlists"]} playlists x '
+                f'{options["playlist_size"]} tracks, {options["latency"] * 1000:.0f} ms latency, '
+                f'{options["error_rate"]:.0%} errors')
+
+            for mode in options['modes']:
+                missing = [module for module in MODES[mode][0]
+                    if importlib.util.find_spec(module) is None]
+                if missing:
+                    self.stdout.write(f'\n{mode}: skipped, {", ".join(missing)} not installed')
+                    continue
+
+                with app_server(mode, fake_url, options) as (process, base_url):
+                    start = time.perf_counter()
+                    results = asyncio.run(self.run_users(base_url, options))
+                    elapsed = time.perf_counter() - start
+                    memory = [peak_rss(pid) for pid in worker_pids(process.pid)]
+
+                summaries.append(self.report(mode, options, results, elapsed, memory))
+
+        if summaries:
+            self.stdout.write(f'\n{"mode":>14} | completed | journeys/s | p50 (ms) | p95 (ms) | '
+                f'p99 (ms) | workers | peak RSS/worker (MB)')
+            for line in summaries:
+                self.stdout.write(line)
+
+    def report(self, mode, options, results, elapsed, memory):
+        '''Write a mode's latencies by step and return its line of the summary.'''
+
+        completed = [timings for timings, failed in results if failed is None]
+        failures = {}
+        for _, failed in results:
+            if failed is not None:
+                failures[failed] = failures.get(failed, 0) + 1
+
+        workers = options['workers'] if mode != 'runserver' else 1
+        self.stdout.write(f'\n{mode}, {workers} worker{"s" if workers > 1 else ""}'
+            + (f' x {options["threads"]} threads' if mode == 'gunicorn' else '')
+            + f': {len(completed)} of {len(results)} users done in {elapsed:.2f} s'
+            + (f', failed at {failures}' if failures else ''))
+        self.stdout.write(f'{"step":>10} | p50 (ms) | p95 (ms) | p99 (ms)')
+
+        for step in (*STEPS, 'journey'):
+            latencies = [timings[step] for timings, _ in results if step in timings]
+            self.stdout.write(f'{step:>10} | {percentile(latencies, 0.5) * 1000:8.0f} | '
+                f'{percentile(latencies, 0.95) * 1000:8.0f} | '
+                f'{percentile(latencies, 0.99) * 1000:8.0f}')
+
+        known = [rss / 2 ** 20 for rss in memory if rss is not None]
+        peak = f'{max(known):.1f}' if known else 'n/a'
+        if known:
+            self.stdout.write(f'peak RSS per worker: {", ".join(f"{rss:.1f}" for rss in known)} MB')
+
+        journeys = [timings['journey'] for timings in completed]
+        return (f'{mode:>14} | {len(completed):4} of {len(results):<3}| '
+            f'{len(completed) / elapsed:10.2f} | {percentile(journeys, 0.5) * 1000:8.0f} | '
+            f'{percentile(journeys, 0.95) * 1000:8.0f} | {percentile(journeys, 0.99) * 1000:8.0f} | '
+            f'{len(memory):7} | {peak:>20}')
+
+    async def run_users(self, base_url, options):
+        '''Run every user's journey and return a (timings, failed step) pair for each.'''
+
+        async def arrive(user):
+            if options['ramp']:
+                await asyncio.sleep(options['ramp'] * user / options['users'])
+            return await self.journey(base_url, options)
+
+        return await asyncio.gather(*(arrive(user) for user in range(options['users'])))
+
+    async def journey(self, base_url, options):
+        '''Log in through the fake accounts service, open the select page, load the first
+        page of playlists and queue from some of them, like a browser would.
+
+        Returns the seconds each step took, and the step that failed or None.'''
+
+        timings = {}
+        step = STEPS[0]
+        start = time.perf_counter()
+
+        async with httpx.AsyncClient(base_url=base_url, timeout=options['timeout']) as client:
+            try:
+                # /login -> the fake's /authorize -> /callback, which redirects to /select
+                step_start = time.perf_counter()
+                response = await client.get('/login')
+                while response.next_request is not None and response.url.path != '/callback':
+                    response = await client.send(response.next_request)
+                if 'refresh_token' not in client.cookies:
+                    return timings, step
+                timings[step] = time.perf_counter() - step_start
+
+                step = 'select'
+                step_start = time.perf_counter()
+                response = (await client.get('/select')).raise_for_status()
+                csrf_token = _CSRF_TOKEN.search(response.text).group(1)
+                timings[step] = time.perf_counter() - step_start
+
+                step = 'playlists'
+                step_start = time.perf_counter()
+                response = (await client.get('/playlists', params={'offset': 0, 'limit': 50}))
+                playlists = response.raise_for_status().json()['items'][:options['selected']]
+                timings[step] = time.perf_counter() - step_start
+
+                # Submitting the job and polling it until the tracks are queued
+                step = 'queue'
+                step_start = time.perf_counter()
+                response = await client.post('/queue', data={
+                    'selected_playlists[]': [playlist['id'] for playlist in playlists],
+                    'selected_snapshots[]': [playlist['snapshot_id'] for playlist in playlists],
+                    'queue_limit': str(options['queue_limit']),
+                    'csrfmiddlewaretoken': csrf_token,
+                })
+                job_id = response.raise_for_status().json()['job_id']
+
+                deadline = step_start + options['timeout']
+                while True:
+                    response = await client.get(f'/queue/status/{job_id}')
+                    status = response.raise_for_status().json()
+                    if status['done']:
+                        break
+                    if time.perf_counter() > deadline:
+                        return timings, step
+                    await asyncio.sleep(0.1)
+                if status['error']:
+                    return timings, step
+                timings[step] = time.perf_counter() - step_start
+            except (httpx.HTTPError, ValueError, KeyError, AttributeError):
+                return timings, step
+
+        timings['journey'] = time.perf_counter() - start
+
+        return timings, None
@@ -0,0 +1,45 @@
+'''Runs the local Spotify stand-in.'''
+
+from django.core.management.base import BaseCommand
+from main.fake_spotify import FakeSpotify
+
+
+class Command(BaseCommand):
+    help = ('Serve a fake Spotify Web API and accounts service. Point SPOTIFY_API_URL and'
+        ' SPOTIFY_ACCOUNTS_URL at the printed URLs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--port', type=int, default=8001)
+        parser.add_argument('--playlists', type=int, default=8,
+            help='Number of playlists the fake user owns.')
+        parser.add_argument('--playlist-size', type=int, default=2000,
+            help='Number of tracks in each playlist.')
+        parser.add_argument('--latency', type=float, default=0.05,
+            help='Seconds to wait before answering each request.')
+        parser.add_argument('--throttle-every', type=int, default=0,
+            help='Answer every nth request with a 429.')
+        parser.add_argument('--retry-after', type=int, default=1,
+            help='Retry-After seconds sent with each 429.')
+        parser.add_argument('--error-rate', type=float, default=0.0,
+            help='Fraction of requests answered with a 503.')
+        parser.add_argument('--rate-limit', type=int, default=0,
+            help='Requests allowed in any one second; the rest are answered with a 429.')
+        parser.add_argument('--saved', type=int, default=2000,
+            help='Number of tracks in the fake user\'s Liked Songs.')
+        parser.add_argument('--token-lifetime', type=int, default=3600,
+            help='Seconds until the access tokens handed out expire.')
+
+    def handle(self, *args, **options):
+        fake = FakeSpotify(playlist_count=options['playlists'],
+            playlist_size=options['playlist_size'], latency=options['latency'],
+            port=options['port'], throttle_every=options['throttle_every'],
+            retry_after=options['retry_after'], error_rate=options['error_rate'],
+            saved_count=options['saved'], rate_limit=options['rate_limit'],
+            token_lifetime=options['token_lifetime'])
+
+        self.stdout.write(f'Serving fake Spotify API at {fake.url}')
+        self.stdout.write(f'Serving fake Spotify accounts at {fake.accounts_url}')
+        try:
+            fake.serve_forever()
+        except KeyboardInterrupt:
+            fake.stop()
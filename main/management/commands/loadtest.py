@@ -0,0 +1,186 @@
+'''Compares the sync and async request paths under concurrent users.'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from contextlib import contextmanager
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.http import HttpResponse
+from django.test import RequestFactory, override_settings
+from main import async_views, jobs, metrics, spotify_async, views
+from main.benchmarks import percentile
+
+
+def free_port():
+    '''A port on 127.0.0.1 that nothing is listening on.'''
+
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def wait_for_port(port, timeout=10):
+    '''Wait until something listens on the port. Returns whether it did in time.'''
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return True
+        except OSError:
+            time.sleep(0.1)
+
+    return False
+
+# fake_spotify options passed on by fake_spotify_process, when they are given
+FAKE_OPTIONS = ('playlists', 'playlist_size', 'latency', 'rate_limit', 'throttle_every',
+    'retry_after', 'error_rate', 'saved', 'token_lifetime')
+
+@contextmanager
+def fake_spotify_process(options):
+    '''Run the fake Spotify API in a process of its own and yield its base URL, which
+    is its SPOTIFY_ACCOUNTS_URL. Its SPOTIFY_API_URL is the base URL followed by v1/.
+
+    Serving it from this process would have it compete with the views for the GIL.'''
+
+    port = free_port()
+    args = [sys.executable, str(settings.BASE_DIR / 'manage.py'), 'fake_spotify',
+        '--port', str(port)]
+    for option in FAKE_OPTIONS:
+        if options.get(option) is not None:
+            args += ['--' + option.replace('_', '-'), str(options[option])]
+
+    process = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+
+    try:
+        wait_for_port(port)
+        yield f'http://127.0.0.1:{port}/'
+    finally:
+        process.terminate()
+        process.wait()
+
+
+class Command(BaseCommand):
+    help = ('Send many users through the sync and async views at once, against a fake'
+        ' Spotify API, and compare latency and throughput.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=['playlists', 'queue'],
+            help='playlists pages every playlist of each user; queue runs a whole queue job.')
+        parser.add_argument('--users', type=int, default=50,
+            help='Users whose requests arrive at the same time.')
+        parser.add_argument('--threads', type=int, default=4,
+            help='Requests the sync path serves at once, like gunicorn --threads.')
+        parser.add_argument('--latency', type=float, default=0.1,
+            help='Simulated round trip time to Spotify in seconds.')
+        parser.add_argument('--playlists', type=int, default=200,
+            help='Playlists owned by each user.')
+        parser.add_argument('--playlist-size', type=int, default=500,
+            help='Tracks in each playlist, for the queue scenario.')
+        parser.add_argument('--queue-limit', type=int, default=20)
+        parser.add_argument('--rate-limit', type=int, default=0,
+            help='Requests the fake API allows in any one second, answering the rest with a 429.')
+        parser.add_argument('--limiter-rate', type=float,
+            help='SPOTIFY_RATE_LIMIT to run with, with a burst of one second\'s worth like'
+                ' the fake\'s window. 0 only honours Retry-After. (default: the setting)')
+
+    def handle(self, *args, **options):
+        limiter_rate = options['limiter_rate']
+        if limiter_rate is None:
+            limiter_rate = settings.SPOTIFY_RATE_LIMIT
+
+        with fake_spotify_process(options) as fake_url, tempfile.TemporaryDirectory() as tmp:
+            # Keep load test entries out of the shared caches and rate limit
+            with override_settings(SPOTIFY_API_URL=f'{fake_url}v1/', PLAYLIST_CACHE_ALIAS='default',
+                JOB_CACHE_ALIAS='default', TRACK_CACHE_ALIAS='default',
+                SPOTIFY_RATE_LIMIT=limiter_rate, SPOTIFY_RATE_LIMIT_BURST=max(int(limiter_rate), 1),
+                SPOTIFY_RATE_LIMIT_FILE=os.path.join(tmp, 'ratelimit')):
+                self.stdout.write(f'{options["scenario"]}: {options["users"]} users, '
+                    f'{options["latency"] * 1000:.0f} ms latency, '
+                    f'limiter at {limiter_rate:g}/s against a limit of {options["rate_limit"]}/s')
+                self.stdout.write(f'{"path":>24} | requests | 429s | seconds | req/s | '
+                    f'p50 (ms) | p95 (ms)')
+
+                for name, run in ((f'sync, {options["threads"]} threads', self.run_sync),
+                     ('async, 1 event loop', self.run_async)):
+                    calls, throttled = self.spotify_calls()
+                    start = time.perf_counter()
+                    latencies = run(options)
+                    elapsed = time.perf_counter() - start
+                    calls_after, throttled_after = self.spotify_calls()
+
+                    self.stdout.write(f'{name:>24} | {calls_after - calls:8} | '
+                        f'{throttled_after - throttled:4} | '
+                        f'{elapsed:7.2f} | {len(latencies) / elapsed:5.1f} | '
+                        f'{percentile(latencies, 0.5) * 1000:8.0f} | '
+                        f'{percentile(latencies, 0.95) * 1000:8.0f}')
+
+    @staticmethod
+    def spotify_calls():
+        '''Responses from Spotify so far, and how many of them were 429s.'''
+
+        counters = [(dict(labels), value) for name, labels, value
+            in metrics.snapshot()['counters'] if name == 'spotify_requests_total']
+
+        return (sum(value for _, value in counters),
+            sum(value for labels, value in counters if labels['status'] == '429'))
+
+    @staticmethod
+    def work(options):
+        '''One request per user for the playlists scenario, one playlist id for queue.'''
+
+        factory = RequestFactory()
+        factory.cookies['access_token'] = 'fake-token'
+        factory.cookies['refresh_token'] = 'fake-refresh'
+
+        for user in range(options['users']):
+            # A user id per user keeps their cache entries apart. Only a signed one is
+            # trusted, so it is signed the way callback signs it.
+            response = HttpResponse()
+            response.set_signed_cookie('user_id', f'load-user-{user}')
+            factory.cookies['user_id'] = response.cookies['user_id'].value
+            if options['scenario'] == 'playlists':
+                yield factory.get('/playlists', {'refresh': '1'})
+            else:
+                yield f'fake{user % options["playlists"]}'
+
+    # Latencies are measured from when every user arrived, so they include time spent
+    # waiting for a free thread
+
+    def run_sync(self, options):
+        def one(work):
+            if options['scenario'] == 'playlists':
+                views.playlists(work)
+            else:
+                views.queue_job(jobs.Job('load'), 'fake-token', [work], None,
+                    options['queue_limit'])
+            return time.perf_counter() - start
+
+        work = list(self.work(options))
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=options['threads']) as executor:
+            return list(executor.map(one, work))
+
+    def run_async(self, options):
+        async def one(work):
+            if options['scenario'] == 'playlists':
+                await async_views.playlists(work)
+            else:
+                await async_views.queue_job(jobs.Job('load'), 'fake-token', [work], None,
+                    options['queue_limit'])
+            return time.perf_counter() - start
+
+        async def run_all():
+            try:
+                return await asyncio.gather(*(one(work) for work in self.work(options)))
+            finally:
+                await spotify_async.aclose()
+
+        start = time.perf_counter()
+
+        return asyncio.run(run_all())
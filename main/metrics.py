@@ -0,0 +1,323 @@
+'''Timing and call-count instrumentation.
+
+Code marks the phases it wants timed with span:
+
+    with metrics.span('playlist_tracks'):
+        ...
+
+Every span is observed in the phase_seconds histogram. Spans that run while
+ServerTimingMiddleware handles a request are also reported to the browser in that
+response's Server-Timing header. Requests sent to Spotify through the shared session are
+counted by count_spotify_response.
+
+Each process keeps its own registry and writes it to a JSON file in settings.METRICS_DIR
+at most every settings.METRICS_FLUSH_INTERVAL seconds. The /metrics view adds up the
+files of every live worker and renders them in the Prometheus text format.'''
+
+import asyncio
+from contextlib import contextmanager
+from contextvars import ContextVar
+import glob
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+from django.conf import settings
+
+try:
+    from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+except ImportError: # asgiref < 3.6
+    from asyncio import iscoroutinefunction
+
+    def markcoroutinefunction(func):
+        func._is_coroutine = asyncio.coroutines._is_coroutine # pylint: disable=protected-access
+        return func
+
+# Upper bounds, in seconds, of the histogram buckets
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+PREFIX = 'shuffler_'
+
+HELP = {
+    'phase_seconds': 'Time spent in each instrumented phase.',
+    'http_request_seconds': 'Time taken to answer requests, by view.',
+    'spotify_requests_total': 'Responses received from the Spotify API, by endpoint and status.',
+    'spotify_request_seconds': 'Time taken by Spotify to answer, by endpoint.',
+}
+
+_timings = ContextVar('timings', default=None)
+_lock = threading.Lock()
+_counters = {}
+_histograms = {}
+_last_flush = 0.0
+
+
+def _series(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def inc(name, amount=1, **labels):
+    '''Add amount to the counter with the given name and labels.'''
+
+    key = _series(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+def observe(name, seconds, **labels):
+    '''Record a duration in the histogram with the given name and labels.'''
+
+    key = _series(name, labels)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0}
+
+        for idx, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                histogram['buckets'][idx] += 1
+                break
+        histogram['sum'] += seconds
+        histogram['count'] += 1
+
+def record(phase, seconds):
+    '''Record a phase that took the given number of seconds, as span does.'''
+
+    observe('phase_seconds', seconds, phase=phase)
+
+    timings = _timings.get()
+    if timings is not None:
+        timings[phase] = timings.get(phase, 0.0) + seconds
+
+@contextmanager
+def span(phase):
+    '''Time the body of a with statement as the given phase.'''
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(phase, time.perf_counter() - start)
+
+def timed(phase, iterator):
+    '''Yield from iterator, recording the time spent producing its items as one phase.
+
+    For lazy pipelines, where work happens between the consumer's own steps.'''
+
+    elapsed = 0.0
+    iterator = iter(iterator)
+
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        record(phase, elapsed)
+
+@contextmanager
+def collect():
+    '''Collect the time of every span in the body of a with statement.
+
+    Yields a dictionary that maps each phase to its total seconds.'''
+
+    timings = {}
+    token = _timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _timings.reset(token)
+
+_ID_AFTER = re.compile(r'/(playlists|tracks|albums|artists|users)/[^/]+')
+
+def count_spotify_call(url, status, seconds):
+    '''Count a response from Spotify and record how long it took.
+
+    Ids are replaced in the url's path so that each endpoint is a single series.'''
+
+    path = re.sub(r'^https?://[^/]+', '', str(url).split('?', 1)[0])
+    endpoint = _ID_AFTER.sub(r'/\1/{id}', path)
+
+    inc('spotify_requests_total', endpoint=endpoint, status=str(status))
+    observe('spotify_request_seconds', seconds, endpoint=endpoint)
+
+def count_spotify_response(response, *args, **kwargs):
+    '''requests response hook calling count_spotify_call.'''
+
+    count_spotify_call(response.url, response.status_code, response.elapsed.total_seconds())
+
+    return response
+
+
+def snapshot():
+    '''This process's registry as a JSON-serializable dictionary.'''
+
+    with _lock:
+        return {
+            'counters': [[name, list(labels), value]
+                for (name, labels), value in _counters.items()],
+            'histograms': [[name, list(labels), dict(histogram, buckets=list(histogram['buckets']))]
+                for (name, labels), histogram in _histograms.items()],
+        }
+
+def flush(force=False):
+    '''Write this process's registry to its file in METRICS_DIR.
+
+    Skipped if the last write was less than METRICS_FLUSH_INTERVAL seconds ago,
+    unless force is set.'''
+
+    global _last_flush
+
+    now = time.monotonic()
+    if not force and now - _last_flush < settings.METRICS_FLUSH_INTERVAL:
+        return
+    _last_flush = now
+
+    directory = settings.METRICS_DIR
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f'metrics-{os.getpid()}.json')
+
+    # Written to a temporary file first so readers never see half of it
+    with tempfile.NamedTemporaryFile('w', dir=directory, delete=False, suffix='.tmp') as file:
+        json.dump(snapshot(), file)
+    os.replace(file.name, path)
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+def collect_all():
+    '''Add up the registries of every live process that wrote one.
+
+    Files left behind by processes that have exited are removed.'''
+
+    flush(force=True)
+
+    counters = {}
+    histograms = {}
+
+    for path in glob.glob(os.path.join(settings.METRICS_DIR, 'metrics-*.json')):
+        pid = int(re.search(r'metrics-(\d+)\.json$', path).group(1))
+        if not _alive(pid):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+
+        try:
+            with open(path, encoding='utf-8') as file:
+                data = json.load(file)
+        except (OSError, ValueError):
+            continue
+
+        for name, labels, value in data['counters']:
+            key = _series(name, dict(labels))
+            counters[key] = counters.get(key, 0) + value
+
+        for name, labels, histogram in data['histograms']:
+            key = _series(name, dict(labels))
+            total = histograms.setdefault(key, {'buckets': [0] * len(BUCKETS), 'sum': 0.0, 'count': 0})
+            total['buckets'] = [a + b for a, b in zip(total['buckets'], histogram['buckets'])]
+            total['sum'] += histogram['sum']
+            total['count'] += histogram['count']
+
+    return counters, histograms
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in pairs) + '}'
+
+def render():
+    '''Every worker's metrics in the Prometheus text exposition format.'''
+
+    counters, histograms = collect_all()
+    lines = []
+
+    for name in sorted({name for name, _ in counters}):
+        lines.append(f'# HELP {PREFIX}{name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {PREFIX}{name} counter')
+        for (series_name, labels), value in sorted(counters.items()):
+            if series_name == name:
+                lines.append(f'{PREFIX}{name}{_labels(labels)} {value}')
+
+    for name in sorted({name for name, _ in histograms}):
+        lines.append(f'# HELP {PREFIX}{name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {PREFIX}{name} histogram')
+        for (series_name, labels), histogram in sorted(histograms.items()):
+            if series_name != name:
+                continue
+
+            cumulative = 0
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                cumulative += count
+                lines.append(f'{PREFIX}{name}_bucket{_labels(labels, le=bound)} {cumulative}')
+            lines.append(f'{PREFIX}{name}_bucket{_labels(labels, le="+Inf")} {histogram["count"]}')
+            lines.append(f'{PREFIX}{name}_sum{_labels(labels)} {histogram["sum"]}')
+            lines.append(f'{PREFIX}{name}_count{_labels(labels)} {histogram["count"]}')
+
+    return '\n'.join(lines) + '\n'
+
+
+class ServerTimingMiddleware:
+    '''Times each request, reports its spans in a Server-Timing header, and records
+    the request's duration in the http_request_seconds histogram.
+
+    Works around sync and async views alike, so it doesn't push async views onto a thread.'''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self.get_response):
+            return self._acall(request)
+
+        start = time.perf_counter()
+        with collect() as timings:
+            response = self.get_response(request)
+
+        return self._finish(request, response, start, timings)
+
+    async def _acall(self, request):
+        start = time.perf_counter()
+        with collect() as timings:
+            response = await self.get_response(request)
+
+        return self._finish(request, response, start, timings)
+
+    @staticmethod
+    def _finish(request, response, start, timings):
+        elapsed = time.perf_counter() - start
+        match = getattr(request, 'resolver_match', None)
+        view = match.url_name if match is not None and match.url_name else 'unmatched'
+        observe('http_request_seconds', elapsed, view=view, method=request.method,
+            status=str(response.status_code))
+
+        entries = [f'{phase};dur={seconds * 1000:.1f}' for phase, seconds in timings.items()]
+        entries.append(f'total;dur={elapsed * 1000:.1f}')
+        response['Server-Timing'] = ', '.join(entries)
+
+        flush()
+
+        return response
@@ -0,0 +1,35 @@
+# Generated by Django 4.0 on 2026-10-18 14:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='HistorySync',
+            fields=[
+                ('user_id', models.CharField(max_length=255, primary_key=True, serialize=False)),
+                ('cursor', models.BigIntegerField(null=True)),
+                ('synced_at', models.DateTimeField(null=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='PlayHistory',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('user_id', models.CharField(max_length=255)),
+                ('track_uri', models.CharField(db_index=True, max_length=255)),
+                ('played_at', models.DateTimeField()),
+            ],
+            options={
+                'indexes': [models.Index(fields=['user_id', '-played_at'], name='play_user_recent')],
+                'constraints': [models.UniqueConstraint(fields=('user_id', 'played_at'), name='unique_play')],
+            },
+        ),
+    ]
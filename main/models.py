@@ -1,3 +1,37 @@
 from django.db import models
 
 # Create your models here.
+
+class PlayHistory(models.Model):
+    '''One play of a track by a user, copied from Spotify's recently played tracks.'''
+
+    user_id = models.CharField(max_length=255)
+    track_uri = models.CharField(max_length=255, db_index=True)
+    played_at = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user_id', 'played_at'], name='unique_play'),
+        ]
+        indexes = [
+            models.Index(fields=['user_id', '-played_at'], name='play_user_recent'),
+        ]
+
+    def __str__(self):
+        return f'{self.user_id} played {self.track_uri} at {self.played_at}'
+
+
+class HistorySync(models.Model):
+    '''How far a user's PlayHistory has been synced.
+
+    cursor -- Unix time in milliseconds of the newest play stored, passed to Spotify
+     as `after` so that the next sync only downloads newer plays.
+
+    synced_at -- when the history was last synced.'''
+
+    user_id = models.CharField(max_length=255, primary_key=True)
+    cursor = models.BigIntegerField(null=True)
+    synced_at = models.DateTimeField(null=True)
+
+    def __str__(self):
+        return f'{self.user_id} synced at {self.synced_at}'
@@ -0,0 +1,135 @@
+'''Stored shuffles that later queue requests continue from.
+
+The first time a user queues from a selection of playlists, every song in it is
+shuffled into a ShufflePlan. Later requests for the same selection queue the plan's next
+songs from its cursor, so nothing is fetched or scored again and batches never repeat a
+song. A plan remembers the snapshot ids it was built from and is dropped once any of the
+playlists changes, which queue jobs check against snapshot ids read from Spotify.
+Plans live in the Django cache named by settings.PLAN_CACHE_ALIAS for
+settings.PLAN_TIMEOUT seconds.
+
+The cursor is kept under a key of its own, so moving it doesn't rewrite the songs.
+Each batch is claimed by reading and moving the cursor while holding a lock, a thread
+lock together with an fcntl lock on settings.PLAN_LOCK_FILE, so two jobs running at
+once on the machine get different batches whatever the cache backend. Without fcntl
+that only holds between the threads of one process.'''
+
+from contextlib import contextmanager
+import hashlib
+import os
+import threading
+from django.conf import settings
+from django.core.cache import caches
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows
+    fcntl = None
+
+_lock = threading.Lock()
+_file = None
+
+
+@contextmanager
+def _locked():
+    '''Hold the lock that claims are made under.'''
+
+    global _file
+
+    with _lock:
+        if fcntl is None:
+            yield
+            return
+
+        # Opened again after a fork or when the setting changes
+        path = settings.PLAN_LOCK_FILE
+        if _file is None or _file[0] != (path, os.getpid()):
+            if _file is not None and _file[0][1] == os.getpid():
+                os.close(_file[1])
+            _file = ((path, os.getpid()), os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+
+        fcntl.flock(_file[1], fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(_file[1], fcntl.LOCK_UN)
+
+
+class ShufflePlan:
+    '''A user's shuffle of a selection of playlists and how far into it they have queued.
+
+    snapshot_ids -- snapshot ids of the playlists when the plan was built.
+
+    tracks -- every song of the selection as TrackRecords, in shuffled order.
+
+    cursor -- index in tracks of the next song to queue, when the plan was loaded.'''
+
+    def __init__(self, key, snapshot_ids, tracks, cursor=0):
+        self.key = key
+        self.snapshot_ids = snapshot_ids
+        self.tracks = tracks
+        self.cursor = cursor
+
+    @staticmethod
+    def _key(user_id, playlist_ids):
+        # Which order the playlists were selected in doesn't change the selection
+        selection = hashlib.sha1(','.join(sorted(playlist_ids)).encode('utf-8')).hexdigest()
+        return f'plan:{user_id}:{selection}'
+
+    @staticmethod
+    def _snapshots(playlist_ids, snapshot_ids):
+        return dict(zip(playlist_ids, snapshot_ids))
+
+    @classmethod
+    def get(cls, user_id, playlist_ids, snapshot_ids):
+        '''Return the user's plan for the playlists, or None if there is none or one of
+        the playlists has changed since it was built, in which case it is deleted.'''
+
+        cache = caches[settings.PLAN_CACHE_ALIAS]
+        key = cls._key(user_id, playlist_ids)
+        fields = cache.get_many([key, f'{key}:cursor'])
+        if key not in fields or f'{key}:cursor' not in fields:
+            return None
+
+        plan = cls(key, cursor=fields[f'{key}:cursor'], **fields[key])
+        if plan.snapshot_ids != cls._snapshots(playlist_ids, snapshot_ids):
+            cache.delete_many([key, f'{key}:cursor'])
+            return None
+
+        return plan
+
+    @classmethod
+    def create(cls, user_id, playlist_ids, snapshot_ids, tracks, claimed=0):
+        '''Store a new plan for the playlists, replacing any older one, and return it.
+
+        claimed -- number of songs at the start of tracks that were queued already.
+         (default: 0)'''
+
+        plan = cls(cls._key(user_id, playlist_ids), cls._snapshots(playlist_ids, snapshot_ids),
+            list(tracks), claimed)
+
+        caches[settings.PLAN_CACHE_ALIAS].set_many({
+            plan.key: {'snapshot_ids': plan.snapshot_ids, 'tracks': plan.tracks},
+            f'{plan.key}:cursor': claimed,
+        }, timeout=settings.PLAN_TIMEOUT)
+
+        return plan
+
+    def claim(self, count):
+        '''Move the cursor past the next count songs and return them.
+
+        Songs that can't be queued after all are not offered again. Returns fewer songs
+        once the plan is running out, and an empty list once every song has been claimed
+        or if the plan has expired.'''
+
+        cache = caches[settings.PLAN_CACHE_ALIAS]
+        with _locked():
+            start = cache.get(f'{self.key}:cursor')
+            if start is None:
+                return []
+
+            end = min(start + count, len(self.tracks))
+            cache.set(f'{self.key}:cursor', end, timeout=settings.PLAN_TIMEOUT)
+
+        self.cursor = end
+        return self.tracks[start:end]
@@ -0,0 +1,77 @@
+'''Per-user cache of the playlists listed on the select page.
+
+The select page asks for playlists a page at a time, filtered by name, so the whole list
+is fetched from Spotify once and then served from the Django cache named by
+settings.PLAYLIST_CACHE_ALIAS until settings.PLAYLIST_CACHE_TIMEOUT seconds have passed.
+Only the fields the page uses are stored.'''
+
+import hashlib
+from django.conf import settings
+from django.core.cache import caches
+from . import spotify_utils
+
+
+def _key(access_token, user_id):
+    if user_id:
+        return f'playlists:user:{user_id}'
+
+    # Without a user id the token stands in, hashed so it is not written to disk
+    return 'playlists:token:' + hashlib.sha256(access_token.encode('utf-8')).hexdigest()
+
+def get(access_token, user_id=None, refresh=False):
+    '''Return the user's playlists as dictionaries with id, name, snapshot_id and
+    track_count, fetching them from Spotify if they are not cached.
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    user_id -- Spotify id of the user, which keys the cache when given. (default: None)
+
+    refresh -- fetch the playlists from Spotify even if they are cached. (default: False)'''
+
+    cache = caches[settings.PLAYLIST_CACHE_ALIAS]
+    key = _key(access_token, user_id)
+
+    playlists = None if refresh else cache.get(key)
+    if playlists is None:
+        playlists = _trim(spotify_utils.get_playlists(access_token))
+        cache.set(key, playlists, timeout=settings.PLAYLIST_CACHE_TIMEOUT)
+
+    return playlists
+
+async def aget(access_token, user_id=None, refresh=False):
+    '''Async get, fetching through spotify_async.'''
+
+    from . import spotify_async # Only the async views need httpx
+
+    cache = caches[settings.PLAYLIST_CACHE_ALIAS]
+    key = _key(access_token, user_id)
+
+    playlists = None if refresh else await cache.aget(key)
+    if playlists is None:
+        playlists = _trim(await spotify_async.get_playlists(access_token))
+        await cache.aset(key, playlists, timeout=settings.PLAYLIST_CACHE_TIMEOUT)
+
+    return playlists
+
+def _trim(playlists):
+    return [{
+        'id': playlist['id'],
+        'name': playlist.get('name') or '',
+        'snapshot_id': playlist.get('snapshot_id'),
+        'track_count': (playlist.get('tracks') or {}).get('total'),
+    } for playlist in playlists if playlist]
+
+def page(playlists, offset=0, limit=50, query=None):
+    '''Return one page of playlists whose names contain query, ignoring case.
+
+    Returns a dictionary with the page's 'items', the 'total' number of matching
+    playlists, and the 'next' offset, which is None on the last page.'''
+
+    if query:
+        query = query.casefold()
+        playlists = [playlist for playlist in playlists if query in playlist['name'].casefold()]
+
+    items = playlists[offset:offset + limit]
+    next_offset = offset + limit if offset + limit < len(playlists) else None
+
+    return {'items': items, 'total': len(playlists), 'offset': offset, 'next': next_offset}
@@ -0,0 +1,190 @@
+'''Adds tracks to a user's Spotify queue, riding out rate limits and transient errors.'''
+
+import asyncio
+import random
+import time
+from django.conf import settings
+import requests
+from . import ratelimit
+
+try:
+    import httpx
+except ImportError: # Only needed by the async views
+    httpx = None
+
+
+class QueueDispatchError(Exception):
+    '''Raised when not every track could be queued.
+
+    queued -- number of tracks that were queued before the failure.
+
+    status -- HTTP status of the failing response, None if Spotify could not be reached.
+
+    reason -- Spotify's reason for the failure, e.g. 'NO_ACTIVE_DEVICE', if it sent one.'''
+
+    def __init__(self, message, queued, status=None, reason=None):
+        super().__init__(message)
+        self.queued = queued
+        self.status = status
+        self.reason = reason
+
+
+class QueueDispatcher:
+    '''Sends add-to-queue requests for a list of tracks, strictly in order.
+
+    Spotify appends tracks in the order their requests arrive, so requests are not sent
+    concurrently; instead they all go over one kept-alive connection. A 429 waits for the
+    Retry-After the response asks for, and 5xx responses and connection errors back off
+    exponentially. Either way the dispatcher resumes at the track that failed. If the
+    shared circuit breaker is open, it gives up at once.
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    session -- requests.Session to send with. A new one is used if None. (default: None)
+
+    max_retries -- consecutive failures allowed for one track before giving up. (default: 5)
+
+    backoff -- seconds to wait after the first failure, doubling after each one. (default: 0.5)
+
+    max_wait -- longest single wait in seconds, including Retry-After. (default: 30)
+
+    timeout -- seconds to wait for each response. (default: 10)'''
+
+    def __init__(self, access_token, session=None, max_retries=5, backoff=0.5, max_wait=30,
+     timeout=10):
+        self.access_token = access_token
+        self.session = session if session is not None else requests.Session()
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+    def dispatch(self, uris, progress=None):
+        '''Queue every track URI in order and return how many were queued.
+
+        Raises QueueDispatchError, carrying the number queued so far, if a track could
+        not be queued.
+
+        uris -- track URIs to queue.
+
+        progress -- function called with the number of tracks queued so far after each one.'''
+
+        url = f'{settings.SPOTIFY_API_URL}me/player/queue'
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        queued = 0
+
+        for uri in uris:
+            failures = 0
+
+            while True:
+                error = None
+                try:
+                    response = self.session.post(url, params={'uri': uri}, headers=headers,
+                        timeout=self.timeout)
+                except requests.RequestException as exc:
+                    response = None
+                    error = exc
+                except ratelimit.SpotifyUnavailable as exc:
+                    raise QueueDispatchError(str(exc), queued) from exc
+
+                if response is not None and response.ok:
+                    break
+
+                failures += 1
+                time.sleep(self._retry(response, error, failures, queued))
+
+            queued += 1
+            if progress is not None:
+                progress(queued)
+
+        return queued
+
+    def _wait(self, response, failures):
+        '''Seconds to wait before retrying after the given number of failures.'''
+
+        if response is not None and response.status_code == 429:
+            retry_after = response.headers.get('Retry-After')
+            if retry_after is not None and retry_after.isdigit():
+                return min(int(retry_after), self.max_wait)
+
+        # Full jitter keeps workers that failed together from retrying together
+        return random.uniform(0, min(self.backoff * 2 ** (failures - 1), self.max_wait))
+
+    def _retry(self, response, error, failures, queued):
+        '''Raise QueueDispatchError if a failed request must not be retried,
+        otherwise return the seconds to wait before retrying it.'''
+
+        status = response.status_code if response is not None else None
+
+        if status is not None and status != 429 and status < 500:
+            raise QueueDispatchError(self._message(response), queued, status,
+                self._reason(response))
+
+        if failures > self.max_retries:
+            message = self._message(response) if response is not None else str(error)
+            raise QueueDispatchError(message, queued, status)
+
+        return self._wait(response, failures)
+
+    @staticmethod
+    def _error(response):
+        try:
+            error = response.json().get('error', {})
+        except ValueError:
+            return {}
+
+        return error if isinstance(error, dict) else {'message': error}
+
+    @staticmethod
+    def _message(response):
+        return QueueDispatcher._error(response).get('message') or f'HTTP {response.status_code}'
+
+    @staticmethod
+    def _reason(response):
+        return QueueDispatcher._error(response).get('reason')
+
+
+class AsyncQueueDispatcher(QueueDispatcher):
+    '''QueueDispatcher for the async views, sending over an httpx.AsyncClient.
+
+    Takes the same arguments as QueueDispatcher, except that client, an
+    httpx.AsyncClient, replaces session.'''
+
+    def __init__(self, access_token, client, max_retries=5, backoff=0.5, max_wait=30,
+     timeout=10):
+        super().__init__(access_token, session=client, max_retries=max_retries,
+            backoff=backoff, max_wait=max_wait, timeout=timeout)
+
+    async def dispatch(self, uris, progress=None):
+        '''Async QueueDispatcher.dispatch.'''
+
+        url = f'{settings.SPOTIFY_API_URL}me/player/queue'
+        headers = {'Authorization': f'Bearer {self.access_token}'}
+        queued = 0
+
+        for uri in uris:
+            failures = 0
+
+            while True:
+                error = None
+                try:
+                    response = await self.session.post(url, params={'uri': uri},
+                        headers=headers, timeout=self.timeout)
+                except httpx.TransportError as exc:
+                    await ratelimit.afailure()
+                    response = None
+                    error = exc
+                except ratelimit.SpotifyUnavailable as exc:
+                    raise QueueDispatchError(str(exc), queued) from exc
+
+                if response is not None and response.is_success:
+                    break
+
+                failures += 1
+                await asyncio.sleep(self._retry(response, error, failures, queued))
+
+            queued += 1
+            if progress is not None:
+                progress(queued)
+
+        return queued
@@ -0,0 +1,237 @@
+'''Rate limiting and circuit breaking shared by every call to Spotify.
+
+Every worker process on the machine draws from one token bucket, kept along with the
+circuit breaker in a small file, settings.SPOTIFY_RATE_LIMIT_FILE, that is locked with
+fcntl while it is read and updated. Each call reserves a token first and sleeps for as
+long as the bucket says. A 429 holds every worker off until its Retry-After has passed.
+
+settings.SPOTIFY_CIRCUIT_FAILURES consecutive 5xx responses or connection errors open
+the circuit. Calls then fail at once with SpotifyUnavailable for
+settings.SPOTIFY_CIRCUIT_COOLDOWN seconds, after which a single call is let through to
+find out whether Spotify has recovered.
+
+Without fcntl the state is only shared by the threads of one process.
+
+The a-prefixed functions are for event loops. They take the file lock on a thread, so a
+worker waiting for it never stalls the other coroutines on its loop.'''
+
+import asyncio
+from contextlib import contextmanager
+import math
+import os
+import struct
+import threading
+import time
+from django.conf import settings
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import fcntl
+except ImportError: # Not available on Windows
+    fcntl = None
+
+# Tokens, the time they were counted at, consecutive failures and the time the circuit
+# stays open until. The time the tokens were counted at is pushed forward by Retry-After.
+_STATE = struct.Struct('4d')
+
+_lock = threading.Lock()
+_file = None
+_memory = None
+
+
+class SpotifyUnavailable(Exception):
+    '''Raised instead of calling Spotify while the circuit breaker is open, or when the
+    rate limit would hold a call for more than settings.SPOTIFY_RATE_LIMIT_MAX_WAIT.
+
+    retry_after -- seconds until Spotify may be called again.'''
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _open():
+    '''Open the state file, again after a fork or when the setting changes.'''
+
+    global _file
+
+    path = settings.SPOTIFY_RATE_LIMIT_FILE
+    if _file is not None and _file[0] == (path, os.getpid()):
+        return _file[1]
+
+    if _file is not None and _file[0][1] == os.getpid():
+        os.close(_file[1])
+
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    _file = ((path, os.getpid()), fd)
+
+    return fd
+
+@contextmanager
+def _state(now):
+    '''Lock the shared state and yield it as a list, to be updated in place.'''
+
+    global _memory
+
+    with _lock:
+        if fcntl is None:
+            if _memory is None:
+                _memory = [settings.SPOTIFY_RATE_LIMIT_BURST, now, 0, 0]
+            yield _memory
+            return
+
+        fd = _open()
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            data = os.pread(fd, _STATE.size, 0)
+            if len(data) == _STATE.size:
+                state = list(_STATE.unpack(data))
+            else:
+                state = [settings.SPOTIFY_RATE_LIMIT_BURST, now, 0, 0]
+
+            yield state
+
+            os.pwrite(fd, _STATE.pack(*state), 0)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+
+def reserve():
+    '''Take a token for one call to Spotify and return the seconds to wait before sending it.
+
+    Raises SpotifyUnavailable if the circuit is open or the wait would be longer than
+    settings.SPOTIFY_RATE_LIMIT_MAX_WAIT. No token is taken then.'''
+
+    rate = settings.SPOTIFY_RATE_LIMIT
+    now = time.time()
+
+    with _state(now) as state:
+        tokens, updated, failures, open_until = state
+
+        if failures >= settings.SPOTIFY_CIRCUIT_FAILURES:
+            if now < open_until:
+                raise SpotifyUnavailable('Spotify is unavailable, please try again in '
+                    f'{math.ceil(open_until - now)} seconds.', open_until - now)
+            # Let this call probe Spotify and hold the others off until it reports back
+            state[3] = now + settings.SPOTIFY_CIRCUIT_COOLDOWN
+
+        if now > updated:
+            tokens = min(settings.SPOTIFY_RATE_LIMIT_BURST, tokens + (now - updated) * rate)
+            updated = now
+
+        # Tokens may go below 0, each call waiting for its turn
+        wait = updated - now
+        if rate > 0:
+            wait += max(0.0, 1 - tokens) / rate
+
+        if wait > settings.SPOTIFY_RATE_LIMIT_MAX_WAIT:
+            raise SpotifyUnavailable('Spotify is busy, please try again in '
+                f'{math.ceil(wait)} seconds.', wait)
+
+        state[0] = tokens - 1 if rate > 0 else tokens
+        state[1] = updated
+
+    return max(wait, 0.0)
+
+def acquire():
+    '''Reserve a token and sleep until it may be used.'''
+
+    wait = reserve()
+    if wait:
+        time.sleep(wait)
+
+async def aacquire():
+    '''Async acquire.'''
+
+    wait = await asyncio.to_thread(reserve)
+    if wait:
+        await asyncio.sleep(wait)
+
+def _retry_after_seconds(retry_after):
+    return int(retry_after) if retry_after is not None and str(retry_after).isdigit() else 1
+
+def check_retry_after(retry_after):
+    '''Raise SpotifyUnavailable if a 429's Retry-After is longer than
+    settings.SPOTIFY_RATE_LIMIT_MAX_WAIT, for callers to fail rather than wait for it.'''
+
+    seconds = _retry_after_seconds(retry_after)
+    if seconds > settings.SPOTIFY_RATE_LIMIT_MAX_WAIT:
+        raise SpotifyUnavailable('Spotify is busy, please try again in '
+            f'{seconds} seconds.', seconds)
+
+def observe(status, retry_after=None):
+    '''Update the limiter and circuit breaker with the status of a response from Spotify.
+
+    A 429 holds every call off for its Retry-After, 1 second if it has none.
+    A 5xx counts as a failure, and anything else closes the circuit.'''
+
+    if status == 429:
+        now = time.time()
+        seconds = _retry_after_seconds(retry_after)
+        with _state(now) as state:
+            state[0] = min(state[0], 0)
+            state[1] = max(state[1], now + seconds)
+    elif status >= 500:
+        failure()
+    else:
+        now = time.time()
+        with _state(now) as state:
+            state[2] = 0
+            state[3] = 0
+
+async def aobserve(status, retry_after=None):
+    '''Async observe.'''
+
+    await asyncio.to_thread(observe, status, retry_after)
+
+def failure():
+    '''Count a 5xx response or a connection error, opening the circuit after
+    settings.SPOTIFY_CIRCUIT_FAILURES in a row.'''
+
+    now = time.time()
+    with _state(now) as state:
+        state[2] += 1
+        if state[2] >= settings.SPOTIFY_CIRCUIT_FAILURES:
+            state[3] = now + settings.SPOTIFY_CIRCUIT_COOLDOWN
+
+async def afailure():
+    '''Async failure.'''
+
+    await asyncio.to_thread(failure)
+
+
+class RateLimitedRetry(Retry):
+    '''urllib3 Retry that reports each failed attempt to the limiter and takes a token
+    for the next one. A 429 asking for a longer wait than
+    settings.SPOTIFY_RATE_LIMIT_MAX_WAIT raises SpotifyUnavailable instead of retrying.'''
+
+    def sleep(self, response=None):
+        if response is None:
+            failure()
+        else:
+            observe(response.status, response.headers.get('Retry-After'))
+            if response.status == 429:
+                check_retry_after(response.headers.get('Retry-After'))
+
+        super().sleep(response)
+        acquire()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    '''HTTPAdapter that takes a token before each request and reports its outcome.
+
+    Use it with RateLimitedRetry so that retries are limited too.'''
+
+    def send(self, request, **kwargs): # pylint: disable=arguments-differ
+        acquire()
+
+        try:
+            response = super().send(request, **kwargs)
+        except (requests.ConnectionError, requests.Timeout):
+            failure()
+            raise
+
+        observe(response.status_code, response.headers.get('Retry-After'))
+
+        return response
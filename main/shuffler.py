@@ -1,152 +1,604 @@
 """Shuffler Module"""
-from typing import List
+from typing import Dict, Iterator, List
+import heapq
+import itertools
 import random
 import math
 import logging
+from . import metrics
+from . import trace
+from .tracks import TrackRecord
+
+try:
+    import numpy
+except ImportError: # The vectorized scoring backend is optional
+    numpy = None
+
+class ScoredSong:
+    '''A track along with how recently it was played and its shuffle score.'''
+
+    __slots__ = ('song', 'score', 'recently_played')
+
+    def __init__(self, song: TrackRecord, score=0, recently_played=None):
+        self.song = song
+        self.score = score
+        self.recently_played = recently_played
+
+class WeightedSampler:
+    '''Picks indexes at random in proportion to weights that may change between picks.
+
+    The weights are kept in a Fenwick tree, so a pick and a weight update each cost
+    O(log n) and nothing is rebuilt when a weight changes or drops to 0.'''
+
+    __slots__ = ('weights', 'tree', 'total', 'active', 'step')
+
+    def __init__(self, weights: List):
+        if any(weight < 0 for weight in weights):
+            raise ValueError('Weights must not be negative.')
+
+        self.weights = list(weights)
+        self.tree = [0] + self.weights
+        for idx in range(1, len(self.tree)):
+            parent = idx + (idx & -idx)
+            if parent < len(self.tree):
+                self.tree[parent] += self.tree[idx]
+
+        self.total = sum(self.weights)
+        self.active = sum(1 for weight in self.weights if weight > 0)
+        # Highest power of two that is at most the number of weights
+        self.step = 1 << (len(self.weights).bit_length() - 1) if self.weights else 0
+
+    def __bool__(self):
+        return self.active > 0
+
+    def pick(self) -> int:
+        '''Return a random index with probability weight / total. Indexes with a weight
+         of 0 are never picked. Raises IndexError when every weight is 0.'''
+
+        if not self.active:
+            raise IndexError('Every weight is 0.')
+
+        while True:
+            target = random.random() * self.total
+            idx = 0
+            step = self.step
+
+            # Descend to the first index whose prefix sum exceeds target
+            while step:
+                if idx + step < len(self.tree) and self.tree[idx + step] <= target:
+                    idx += step
+                    target -= self.tree[idx]
+                step >>= 1
+
+            # Rounding in float totals can land past the end or on an empty index
+            if idx < len(self.weights) and self.weights[idx] > 0:
+                return idx
+
+    def update(self, idx: int, weight):
+        '''Change the weight of an index.'''
+
+        if weight < 0:
+            raise ValueError('Weights must not be negative.')
+
+        delta = weight - self.weights[idx]
+        self.active += (weight > 0) - (self.weights[idx] > 0)
+        self.weights[idx] = weight
+        self.total += delta
+
+        idx += 1
+        while idx < len(self.tree):
+            self.tree[idx] += delta
+            idx += idx & -idx
 
 class Shuffler:
-    '''Utility class containing methods to shuffle list of Spotify track API objects'''
+    '''Utility class containing methods to shuffle lists of tracks.
+
+    Tracks may be TrackRecords or Spotify API track objects. Either way they are
+    returned as TrackRecords.'''
 
     @staticmethod
+    @metrics.span('shuffle')
     def shuffle_multiple_playlists(playlists: List, recently_played: List, queue_limit=20,
-     no_double_artist=False, no_double_album=False, debug=False) -> List:
+     no_double_artist=False, no_double_album=False, min_gap=1, rng=None, recency_index=None,
+     weights=None, debug=False) -> List:
         '''Shuffle songs from different playlists weighed against what was recently played
          with several optional modifications.
 
         recently_played -- list of tracks obtained from the Spotify API
          that have been played recently
 
+        queue_limit -- number of songs to return, or None to order every song. (default: 20)
+
         no_double_artist -- flag that suggests shuffler should avoid playing
          the same artist back to back. (default: False)
 
         no_double_album -- flag that suggests shuffler should avoid playing
          the same album back to back. (default: False)
 
-        debug -- flag that writes the shuffled queue to queue.log file'''
+        min_gap -- number of tracks that must play between two by the same artist or
+         from the same album when the matching flag is set. (default: 1)
+
+        rng -- numpy.random.Generator used to score every playlist in one batch,
+         see numpy_rng. Scores one song at a time with the random module if None.
+         (default: None)
+
+        recency_index -- dictionary mapping track URIs to how recently they were played,
+         such as one built by history.recency_index. Built from recently_played if None.
+         (default: None)
+
+        weights -- list with a weight for each playlist. Each song is drawn from a playlist
+         with probability proportional to its weight until that playlist runs out, so
+         [1] * len(playlists) takes from every playlist equally often. If None, songs are
+         drawn in proportion to how many each playlist has left, so every song is equally
+         likely to come next. (default: None)
+
+        debug -- flag that traces this shuffle even if it isn't sampled, see log'''
 
         queue = []
-        bag_factor = 2 # Put this many songs from each playlist into a bag and select them at random
+        sources = []
+        if recency_index is None:
+            recency_index = Shuffler.build_recency_index(recently_played)
 
-        for i, _ in enumerate(playlists):
-            playlists[i] = Shuffler.shuffle_single_playlist(playlists[i], recently_played,
-                no_double_artist=no_double_artist, no_double_album=no_double_album, debug=debug)
+        # Songs in more than one playlist are only scored and queued from the first,
+        # so everything the loop below takes is unique
+        playlists = Shuffler.assign_sources(playlists)
 
-        while len(queue) < queue_limit and sum([len(x) for x in playlists]) > 0:
-            rand_index = []
+        if queue_limit is None:
+            queue_limit = sum(len(song_list) for song_list in playlists)
 
-            for _ in range(bag_factor):
-                rand_index.extend([*range(0, len(playlists))])
+        for scored_song, source in itertools.islice(Shuffler._iter_shuffled(playlists,
+         recency_index, no_double_artist, no_double_album, min_gap, rng, weights), queue_limit):
+            queue.append(scored_song)
+            sources.append(source)
 
-            random.shuffle(rand_index)
+        if debug or trace.sampled():
+            Shuffler.log(queue, recency_index, sources=sources,
+                playlist_sizes=[len(song_list) for song_list in playlists], queue_limit=queue_limit,
+                no_double_artist=no_double_artist, no_double_album=no_double_album,
+                min_gap=min_gap, rng=rng, weights=weights)
 
-            for i in rand_index:
-                if len(playlists[i]) > 0:
-                    queue.append(playlists[i].pop(0))
+        return [x.song for x in queue]
 
-                if len(queue) >= queue_limit:
-                    break
+    @staticmethod
+    def iter_multiple_playlists(playlists: List, recently_played: List, no_double_artist=False,
+     no_double_album=False, min_gap=1, rng=None, recency_index=None, weights=None) -> Iterator:
+        '''Lazily yield every song in the order shuffle_multiple_playlists would return them.
+
+        Taking the first k songs costs what shuffle_multiple_playlists with a queue_limit
+        of k does, and the rest can be taken later without scoring anything again.
+        Arguments are those of shuffle_multiple_playlists.'''
 
-        # Remove Duplicate Tracks based on URI
-        queue = list({ track_data['track']['uri'] : track_data for track_data in queue }.values())
+        if recency_index is None:
+            recency_index = Shuffler.build_recency_index(recently_played)
 
-        return queue
+        playlists = Shuffler.assign_sources(playlists)
+
+        for scored_song, _ in Shuffler._iter_shuffled(playlists, recency_index,
+         no_double_artist, no_double_album, min_gap, rng, weights):
+            yield scored_song.song
 
     @staticmethod
-    def shuffle_single_playlist(song_list: List, recently_played: List,
-     no_double_artist=False, no_double_album=False, debug=False) -> List:
+    def _iter_shuffled(playlists, recency_index, no_double_artist, no_double_album, min_gap,
+     rng, weights):
+        '''Yield (ScoredSong, index of its playlist) pairs for shuffle_multiple_playlists,
+        from playlists that went through assign_sources.'''
+
+        # Each playlist only scores its tracks once and then yields them best first,
+        # so the loop below never orders more tracks than it takes.
+        shuffled_playlists = [Shuffler.iter_scored_playlist(song_list, recency_index,
+            no_double_artist=no_double_artist, no_double_album=no_double_album,
+            min_gap=min_gap, rng=rng) for song_list in playlists]
+
+        by_size = weights is None
+        if by_size:
+            weights = [len(song_list) for song_list in playlists]
+        elif len(weights) != len(playlists):
+            raise ValueError('There must be one weight for each playlist.')
+
+        sampler = WeightedSampler([weight if song_list else 0
+            for weight, song_list in zip(weights, playlists)])
+
+        while sampler:
+            i = sampler.pick()
+
+            scored_song = next(shuffled_playlists[i], None)
+            if scored_song is None:
+                sampler.update(i, 0)
+                continue
+
+            if by_size:
+                sampler.update(i, sampler.weights[i] - 1)
+
+            yield scored_song, i
+
+    @staticmethod
+    def assign_sources(playlists: List) -> List:
+        '''Give every song to the first playlist it appears in.
+
+        Returns each playlist as a list of TrackRecords, keeping only the songs whose URI
+        was not seen earlier in it or in a previous playlist.
+
+        playlists -- lists of TrackRecords or tracks obtained from the Spotify API'''
+
+        seen = set()
+        assigned = []
+
+        for song_list in playlists:
+            songs = []
+            for song in TrackRecord.from_items(song_list):
+                if song.uri not in seen:
+                    seen.add(song.uri)
+                    songs.append(song)
+            assigned.append(songs)
+
+        return assigned
+
+    @staticmethod
+    def shuffle_single_playlist(song_list: List, recently_played: List, recency_index=None,
+     no_double_artist=False, no_double_album=False, min_gap=1, rng=None, debug=False) -> List:
         '''Shuffle list of songs weighed against what was recently played
          with several optional modifications.
 
-        song_list -- list of tracks obtained from the Spotify API
+        song_list -- list of TrackRecords or tracks obtained from the Spotify API
 
         recently_played -- list of tracks obtained from the Spotify API
          that have been played recently
 
+        recency_index -- dictionary built by build_recency_index from recently_played.
+         Built here if not given. (default: None)
+
         no_double_artist -- flag that suggests shuffler should avoid playing
          the same artist back to back. (default: False)
 
         no_double_album -- flag that suggests shuffler should avoid playing
          the same album back to back. (default: False)
 
-        debug -- flag that writes the shuffled queue to queue.log file'''
+        min_gap -- number of tracks that must play between two by the same artist or
+         from the same album when the matching flag is set. (default: 1)
 
-        queue = []
-        queue.extend([{'song' : song, 'score': 0, 'recently_played': None} for song in song_list])
+        rng -- numpy.random.Generator used to score the playlist in one batch. (default: None)
 
-        for i, recency_index in enumerate(recently_played):
-            for j, queue_track in enumerate(queue):
-                if recency_index['track']['uri'] == queue_track['song']['track']['uri']:
-                    queue[j]['recently_played'] = i + 1
-                    break
+        debug -- flag that traces this shuffle even if it isn't sampled, see log'''
+
+        if recency_index is None:
+            recency_index = Shuffler.build_recency_index(recently_played)
+
+        with metrics.span('shuffle_score'):
+            queue = Shuffler.rank_playlist(song_list, recency_index, rng=rng)
+
+        with metrics.span('shuffle_spacing'):
+            queue = Shuffler.space_out(queue,
+                Shuffler.spacing_keys(no_double_artist, no_double_album), min_gap=min_gap)
+
+        if debug or trace.sampled():
+            Shuffler.log(queue, recency_index, playlist_sizes=[len(song_list)],
+                no_double_artist=no_double_artist, no_double_album=no_double_album,
+                min_gap=min_gap, rng=rng)
+
+        return [x.song for x in queue]
+
+    @staticmethod
+    def iter_single_playlist(song_list: List, recency_index: Dict,
+     no_double_artist=False, no_double_album=False, min_gap=1, rng=None) -> Iterator:
+        '''Lazily yield the songs of a playlist in the order shuffle_single_playlist
+         would return them.
+
+        Takes the same arguments as iter_scored_playlist.'''
+
+        for scored_song in Shuffler.iter_scored_playlist(song_list, recency_index,
+         no_double_artist=no_double_artist, no_double_album=no_double_album, min_gap=min_gap,
+         rng=rng):
+            yield scored_song.song
+
+    @staticmethod
+    def iter_scored_playlist(song_list: List, recency_index: Dict,
+     no_double_artist=False, no_double_album=False, min_gap=1, rng=None) -> Iterator:
+        '''Like iter_single_playlist, but yield each song as its ScoredSong.
+
+        Scoring is O(n) and each yielded song costs O(log n), so taking the first k songs
+        is O(n + k log n) instead of ordering the whole playlist.
+
+        song_list -- list of TrackRecords or tracks obtained from the Spotify API
+
+        recency_index -- dictionary built by build_recency_index
+
+        no_double_artist -- flag that suggests shuffler should avoid playing
+         the same artist back to back. (default: False)
+
+        no_double_album -- flag that suggests shuffler should avoid playing
+         the same album back to back. (default: False)
 
-        for idx, song_dict in enumerate(queue):
-            queue[idx]['score'] = Shuffler.get_score(song_dict)
+        min_gap -- number of tracks that must play between two by the same artist or
+         from the same album when the matching flag is set. (default: 1)
 
-        queue = sorted(queue, key= lambda x: -x['score'])
+        rng -- numpy.random.Generator used to score the playlist in one batch.
+         The batch is argsorted up front, which is cheaper than heap selection in Python.
+         (default: None)'''
 
+        keys = Shuffler.spacing_keys(no_double_artist, no_double_album)
+
+        with metrics.span('shuffle_score'):
+            if rng is None:
+                queue = Shuffler.score_playlist(song_list, recency_index)
+            else:
+                queue = Shuffler.rank_playlist(song_list, recency_index, rng=rng)
+
+        yield from metrics.timed('shuffle_spacing',
+            Shuffler.iter_spaced(queue, keys, min_gap=min_gap, by_score=rng is None))
+
+    @staticmethod
+    def score_playlist(song_list: List, recency_index: Dict, rng=None) -> List:
+        '''Wrap each song in a ScoredSong with how recently it was played and its score.
+
+        Songs without a playable track are dropped.
+
+        song_list -- list of TrackRecords or tracks obtained from the Spotify API
+
+        recency_index -- dictionary built by build_recency_index
+
+        rng -- numpy.random.Generator used to score every song at once with score_batch.
+         Songs are scored one at a time with get_score if None. (default: None)'''
+
+        songs = TrackRecord.from_items(song_list)
+
+        if rng is None:
+            queue = [ScoredSong(song, recently_played=recency_index.get(song.uri)) for song in songs]
+            for scored_song in queue:
+                scored_song.score = Shuffler.get_score(scored_song)
+            return queue
+
+        ranks = [recency_index.get(song.uri) for song in songs]
+        scores = Shuffler.score_batch(ranks, rng).tolist()
+
+        return [ScoredSong(*fields) for fields in zip(songs, scores, ranks)]
+
+    @staticmethod
+    def rank_playlist(song_list: List, recency_index: Dict, rng=None) -> List:
+        '''Score a playlist like score_playlist and sort it, best first.
+
+        With an rng the score array is argsorted by numpy before any ScoredSong is built.'''
+
+        if rng is None:
+            return sorted(Shuffler.score_playlist(song_list, recency_index), key= lambda x: -x.score)
+
+        songs = TrackRecord.from_items(song_list)
+        ranks = [recency_index.get(song.uri) for song in songs]
+        scores = Shuffler.score_batch(ranks, rng)
+        order = numpy.argsort(-scores, kind='stable').tolist()
+        scores = scores.tolist()
+
+        return [ScoredSong(songs[idx], scores[idx], ranks[idx]) for idx in order]
+
+    @staticmethod
+    def spacing_keys(no_double_artist=False, no_double_album=False) -> List:
+        '''Keys for space_out matching the no_double_artist and no_double_album flags.'''
+
+        keys = []
         if no_double_artist:
-            queue = Shuffler.filter_double_artist(queue)
-        elif no_double_album:
-            queue = Shuffler.filter_double_album(queue)
+            keys.append(Shuffler.artist_key)
+        if no_double_album:
+            keys.append(Shuffler.album_key)
+
+        return keys
+
+    @staticmethod
+    def build_recency_index(recently_played: List) -> Dict:
+        '''Map the URI of each recently played track to how recently it was played,
+         1 being the most recent play.
+
+        recently_played -- list of tracks obtained from the Spotify API
+         that have been played recently, most recent first'''
+
+        recency_index = {}
 
-        if debug:
-            Shuffler.log(queue, recently_played)
+        for idx, track in enumerate(TrackRecord.from_items(recently_played)):
+            recency_index.setdefault(track.uri, idx + 1)
 
-        return [x['song'] for x in queue]
+        return recency_index
 
     @staticmethod
-    def filter_double_artist(queue: List):
+    def filter_double_artist(queue: List, min_gap=1):
         '''Filter queue to avoid the same artist playing twice in a row.
 
-        queue -- list of tracks'''
+        queue -- list of ScoredSongs
 
-        for i in range(1, len(queue)-1):
-            cur_artist = queue[i]["song"]["track"]["artists"][0]["name"]
-            prev_artist = queue[i-1]["song"]["track"]["artists"][0]["name"]
+        min_gap -- number of tracks that must play between two by the same artist. (default: 1)'''
 
-            if cur_artist == prev_artist:
-                for j in range(i+1, len(queue)):
-                    j_artist = queue[j]["song"]["track"]["artists"][0]["name"]
+        return Shuffler.space_out(queue, [Shuffler.artist_key], min_gap=min_gap)
 
-                    if cur_artist != j_artist:
-                        temp = queue[j]
-                        queue[j] = queue[i]
-                        queue[i] = temp
+    @staticmethod
+    def filter_double_album(queue, min_gap=1):
+        '''Filter queue to avoid the same album playing twice in a row.
+
+        queue -- list of ScoredSongs
+
+        min_gap -- number of tracks that must play between two from the same album. (default: 1)'''
 
-        return queue
+        return Shuffler.space_out(queue, [Shuffler.album_key], min_gap=min_gap)
 
     @staticmethod
-    def filter_double_album(queue):
-        '''Filter queue to avoid the same album playing twice in a row.
+    def artist_key(scored_song):
+        '''Key used to space out tracks by the same artist.'''
+
+        return scored_song.song.artist_name
 
-        queue -- list of tracks'''
+    @staticmethod
+    def album_key(scored_song):
+        '''Key used to space out tracks from the same album.'''
 
-        for i in range(1, len(queue)-1):
-            cur_album = queue[i]["song"]["track"]["album"]["name"]
-            prev_album = queue[i-1]["song"]["track"]["album"]["name"]
+        return scored_song.song.album_name
 
-            if cur_album == prev_album:
-                for j in range(i+1, len(queue)):
-                    j_artist = queue[j]["song"]["track"]["album"]["name"]
+    @staticmethod
+    def space_out(queue: List, keys: List, min_gap=1) -> List:
+        '''Reorder a queue sorted by score so that no two tracks sharing a key play
+         within min_gap tracks of each other.
 
-                    if cur_album != j_artist:
-                        temp = queue[j]
-                        queue[j] = queue[i]
-                        queue[i] = temp
+        Each position takes the highest scored track that does not break a rule, so the
+        score order is kept wherever the rules allow it. When no remaining track can be
+        placed without breaking a rule, the one that would be allowed soonest is placed
+        anyway, the highest scored of those if several would.
 
-        return queue
+        queue -- list of ScoredSongs sorted by score, best first
+
+        keys -- list of functions, each mapping a track to a value that must not repeat
+         within min_gap tracks, e.g. [Shuffler.artist_key, Shuffler.album_key]
+
+        min_gap -- number of tracks that must play between two sharing a key. (default: 1)'''
+
+        if not keys or min_gap < 1 or len(queue) < 2:
+            return queue
+
+        return list(Shuffler.iter_spaced(queue, keys, min_gap=min_gap))
 
     @staticmethod
-    def get_recency_bias(song_dict):
+    def iter_spaced(queue: List, keys: List, min_gap=1, by_score=False) -> Iterator:
+        '''Lazily yield the tracks of queue in the order space_out would return them.
+
+        Tracks are grouped by the values of every key and each group is kept as a heap.
+        Tracks of a group are blocked by the same earlier tracks, so only the best track of
+        each group competes for the next position. Blocking is tracked per key value
+        rather than per group: each group is parked under one of its values, and a value
+        that is blocked waits as a single entry however many groups are parked under it,
+        e.g. every album of an artist. Setup is O(n) and each yielded track costs
+        O(k log n) amortized for k keys.
+
+        queue -- list of ScoredSongs, sorted best first unless by_score is set
+
+        keys -- list of functions, each mapping a track to a value that must not repeat
+         within min_gap tracks. No spacing is done when empty.
+
+        min_gap -- number of tracks that must play between two sharing a key. (default: 1)
+
+        by_score -- rank tracks by their score instead of their position in queue,
+         so queue does not need to be sorted. (default: False)'''
+
+        if by_score:
+            ranks = [(-scored_song.score, idx) for idx, scored_song in enumerate(queue)]
+        else:
+            ranks = [(idx,) for idx in range(len(queue))]
+
+        if not keys or min_gap < 1:
+            heapq.heapify(ranks)
+            while ranks:
+                yield queue[heapq.heappop(ranks)[-1]]
+            return
+
+        groups = {}
+        for rank in ranks:
+            scored_song = queue[rank[-1]]
+            groups.setdefault(tuple(key(scored_song) for key in keys), []).append(rank)
+
+        for group in groups.values():
+            heapq.heapify(group)
+
+        # Position each key value is free from, once a track with it has been placed
+        free_from = [{} for _ in keys]
+        key_indexes = range(len(keys))
+
+        # Groups parked under a key value, by their best track's rank, and whether the
+        # value is in ready, waiting or neither. Entries carry a sequence number so that
+        # values are never compared.
+        parked = {}
+        state = {}
+        # Values believed free, by the rank of their best parked group. Entries go stale
+        # as groups come and go and are checked when they come out.
+        ready = []
+        # Values that are blocked, by the position they are free at when pushed
+        waiting = []
+        sequence = itertools.count()
+
+        def park(group_key, now):
+            # Under the value that blocks the group longest, the first key's if it is free
+            key_idx = 0
+            free_at = free_from[0].get(group_key[0], 0)
+            for idx in key_indexes:
+                idx_free_at = free_from[idx].get(group_key[idx], 0)
+                if idx_free_at > free_at:
+                    key_idx, free_at = idx, idx_free_at
+            source = (key_idx, group_key[key_idx])
+            rank = groups[group_key][0]
+            heapq.heappush(parked.setdefault(source, []), (rank, group_key))
+
+            if source not in state:
+                if free_at > now:
+                    state[source] = 'waiting'
+                    heapq.heappush(waiting, (free_at, next(sequence), source))
+                else:
+                    state[source] = 'ready'
+                    heapq.heappush(ready, (rank, next(sequence), source))
+            elif state[source] == 'ready' and parked[source][0][0] == rank:
+                heapq.heappush(ready, (rank, next(sequence), source))
+
+        for group_key in groups:
+            park(group_key, 0)
+
+        position = 0
+        while state:
+            # Tracks are looked for as if it were position now, or the first position after
+            # it that frees one when none is free, to place the one allowed soonest
+            now = position
+            while True:
+                while waiting and waiting[0][0] <= now:
+                    _, _, source = heapq.heappop(waiting)
+                    free_at = free_from[source[0]].get(source[1], 0)
+                    if free_at > now:
+                        # Placed again through a group parked elsewhere
+                        heapq.heappush(waiting, (free_at, next(sequence), source))
+                    else:
+                        state[source] = 'ready'
+                        heapq.heappush(ready, (parked[source][0][0], next(sequence), source))
+
+                group_key = None
+                while ready:
+                    rank, _, source = heapq.heappop(ready)
+                    if state.get(source) != 'ready' or parked[source][0][0] != rank:
+                        continue
+
+                    free_at = free_from[source[0]].get(source[1], 0)
+                    if free_at > now:
+                        state[source] = 'waiting'
+                        heapq.heappush(waiting, (free_at, next(sequence), source))
+                        continue
+
+                    _, candidate = heapq.heappop(parked[source])
+                    if parked[source]:
+                        heapq.heappush(ready, (parked[source][0][0], next(sequence), source))
+                    else:
+                        del parked[source]
+                        del state[source]
+
+                    if any(free_from[idx].get(candidate[idx], 0) > now for idx in key_indexes):
+                        park(candidate, now)
+                        continue
+
+                    group_key = candidate
+                    break
+
+                if group_key is not None:
+                    break
+                now = waiting[0][0]
+
+            group = groups[group_key]
+            yield queue[heapq.heappop(group)[-1]]
+
+            for key_idx, value in enumerate(group_key):
+                free_from[key_idx][value] = position + min_gap + 1
+            position += 1
+
+            if group:
+                park(group_key, position)
+
+    @staticmethod
+    def get_recency_bias(scored_song):
         '''Get penalty to apply to score based on how recently a song was played.
 
-        song_dict -- dictionary of {'song': json track data, 'score': integer denoting score,
-         'recently_played': integer denoting how recently it was played}'''
+        scored_song -- ScoredSong whose recently_played is an integer denoting
+         how recently it was played, or None'''
 
-        if song_dict['recently_played'] is None:
+        if scored_song.recently_played is None:
             return 0
 
-        recent_idx = song_dict['recently_played']
+        recent_idx = scored_song.recently_played
         if recent_idx == 0:
             logging.warning('Recent Index should never be 0!')
             return 0
@@ -157,45 +609,92 @@ class Shuffler:
 
     @staticmethod
     def get_random():
-        '''Get random value to add to song's score.
-
-        song_dict -- dictionary of {'song': json track data, 'score': integer denoting score,
-         'recently_played': integer denoting how recently it was played}. Default None.'''
+        '''Get random value to add to song's score.'''
 
         return random.randint(0, 1000)
 
     @staticmethod
-    def get_score(song_dict):
+    def get_score(scored_song):
         '''Assign score to each song to be used in shuffling.
 
         Arguments:
 
-        song_dict -- dictionary of {'song': json track data, 'score': integer denoting score,
-         'recently_played': integer denoting how recently it was played}.
+        scored_song -- ScoredSong whose recently_played is an integer denoting
+         how recently it was played, or None
         '''
         score = 0
 
-        score += Shuffler.get_recency_bias(song_dict)
+        score += Shuffler.get_recency_bias(scored_song)
         score += Shuffler.get_random()
 
         return score
 
     @staticmethod
-    def log(queue, recently_played, filename='queue.log'):
-        '''Log the queue and recently played tracks to a file.'''
+    def numpy_rng(seed=None):
+        '''Return a numpy.random.Generator for the vectorized scoring backend,
+         or None when numpy is not installed.
+
+        seed -- seed for reproducible shuffles. (default: None)'''
+
+        if numpy is None:
+            return None
+
+        return numpy.random.default_rng(seed)
+
+    @staticmethod
+    def recency_bias_batch(recently_played: List):
+        '''Vectorized get_recency_bias.
+
+        recently_played -- list with, for each song, an integer denoting how recently
+         it was played, or None'''
+
+        ranks = numpy.fromiter((0 if rank is None else rank for rank in recently_played),
+            dtype=float, count=len(recently_played))
+        bias = numpy.zeros(len(ranks))
+        played = ranks > 0
+        bias[played] = -500 * numpy.tanh(20 / ranks[played])
+
+        return numpy.minimum(bias, 0)
+
+    @staticmethod
+    def score_batch(recently_played: List, rng):
+        '''Vectorized get_score, returning a numpy array with one score per song.
+
+        recently_played -- list with, for each song, an integer denoting how recently
+         it was played, or None
+
+        rng -- numpy.random.Generator drawing the same 0 to 1000 jitter as get_random'''
+
+        bias = Shuffler.recency_bias_batch(recently_played)
+
+        return bias + rng.integers(0, 1000, size=len(bias), endpoint=True)
+
+    @staticmethod
+    def log(queue, recency_index, sources=None, playlist_sizes=None, queue_limit=None,
+     no_double_artist=False, no_double_album=False, min_gap=1, rng=None, weights=None):
+        '''Trace a shuffle, with the score and recency rank of every queued song.
+
+        The record is written in the background by trace.emit, as one JSON line holding
+        the shuffle's settings and, for each song in queue order, the fields named in
+        its track_fields, enough to replay the spacing offline.
+
+        queue -- list of ScoredSongs in the order they were queued.
+
+        recency_index -- dictionary the songs were scored against.
+
+        sources -- index of the playlist each song came from. (default: None)
+
+        The other arguments are the settings of the shuffle being traced.'''
 
-        with open(filename, 'a',encoding='utf-8') as file:
-            file.write('-' * 15)
-            file.write('\nRECENTLY PLAYED TRACKS\n')
-            for idx, track in enumerate(recently_played):
-                file.write(f'{idx+1} | {track["track"]["name"]}\n')
+        if sources is None:
+            sources = [0] * len(queue)
 
-            file.write("\nSHUFFLED LIST\n")
-            file.write('Index | Recently Played | Song | Artist\n')
+        tracks = [[x.song.uri, source, round(float(x.score), 3), x.recently_played,
+            x.song.artist_id, x.song.album_id] for x, source in zip(queue, sources)]
 
-            for idx, queue_track in enumerate(queue):
-                recency_index =  queue_track['recently_played']
-                if recency_index is None:
-                    recency_index = "NA"
-                file.write(f'{idx} | {recency_index} | {queue_track["song"]["track"]["name"]} |\
-                {queue_track["song"]["track"]["artists"][0]["name"]} \n')
+        trace.emit('shuffle', backend='python' if rng is None else 'numpy',
+            queue_limit=queue_limit, no_double_artist=no_double_artist,
+            no_double_album=no_double_album, min_gap=min_gap, playlist_sizes=playlist_sizes,
+            weights=weights, recency_index_size=len(recency_index),
+            track_fields=['uri', 'playlist', 'score', 'recency_rank', 'artist_id', 'album_id'],
+            tracks=tracks)
@@ -0,0 +1,200 @@
+'''Async counterparts of the spotify_utils helpers used by the async views.
+
+Requests go through httpx.AsyncClients shared by everything on an event loop, so a
+single ASGI worker can wait on Spotify for many users at once. Pages are fanned out with asyncio.gather, limited
+by a semaphore of settings.SPOTIFY_FETCH_WORKERS per call, and GETs are retried like the
+shared requests session retries them. Every request goes through the shared rate limit
+and circuit breaker of ratelimit.'''
+
+import asyncio
+import random
+import time
+import weakref
+from asgiref.sync import sync_to_async
+from django.conf import settings
+import httpx
+from . import metrics
+from . import ratelimit
+from . import track_cache
+from .queue_dispatcher import AsyncQueueDispatcher
+from .spotify_utils import TRACK_PAGE_FIELDS
+from .tracks import TrackRecord
+
+# Connections per httpx.AsyncClient. Finding a free connection costs httpcore time in
+# proportion to the size of the pool, so big pools are split over several clients.
+CLIENT_POOL_SIZE = 20
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def get_client():
+    '''Return an httpx.AsyncClient for calls to Spotify on the running loop.
+
+    Each loop has enough clients, used in turn, for settings.SPOTIFY_ASYNC_POOL_SIZE
+    connections in all. Their timeout is settings.SPOTIFY_HTTP_TIMEOUT.'''
+
+    loop = asyncio.get_running_loop()
+    clients = _clients.get(loop)
+
+    if clients is None:
+        count = max(1, -(-settings.SPOTIFY_ASYNC_POOL_SIZE // CLIENT_POOL_SIZE))
+        size = -(-settings.SPOTIFY_ASYNC_POOL_SIZE // count)
+        limits = httpx.Limits(max_connections=size, max_keepalive_connections=size)
+        hooks = {'request': [_limit_request], 'response': [_count_response]}
+        clients = _clients[loop] = [httpx.AsyncClient(limits=limits,
+            timeout=settings.SPOTIFY_HTTP_TIMEOUT, event_hooks=hooks) for _ in range(count)]
+
+    clients.append(clients.pop(0))
+    return clients[-1]
+
+async def _limit_request(request):
+    await ratelimit.aacquire()
+    request.extensions['shuffler_start'] = time.perf_counter()
+
+async def _count_response(response):
+    start = response.request.extensions.get('shuffler_start', time.perf_counter())
+    metrics.count_spotify_call(response.request.url, response.status_code,
+        time.perf_counter() - start)
+    await ratelimit.aobserve(response.status_code, response.headers.get('Retry-After'))
+
+async def aclose():
+    '''Close the running loop's clients, for loops that end with the caller, like asyncio.run's.'''
+
+    for client in _clients.pop(asyncio.get_running_loop(), []):
+        await client.aclose()
+
+async def get(access_token, path, **params):
+    '''GET a Web API path and return its JSON.
+
+    429 and 5xx responses and connection errors are retried up to SPOTIFY_HTTP_RETRIES
+    times, waiting for Retry-After or backing off exponentially. Raises
+    httpx.HTTPStatusError for a response that is still an error, and SpotifyUnavailable
+    for a 429 whose Retry-After is longer than SPOTIFY_RATE_LIMIT_MAX_WAIT.'''
+
+    url = f'{settings.SPOTIFY_API_URL}{path}'
+    headers = {'Authorization': f'Bearer {access_token}'}
+    params = {key: value for key, value in params.items() if value is not None}
+
+    for attempt in range(settings.SPOTIFY_HTTP_RETRIES + 1):
+        try:
+            response = await get_client().get(url, params=params, headers=headers)
+        except httpx.TransportError:
+            await ratelimit.afailure()
+            if attempt == settings.SPOTIFY_HTTP_RETRIES:
+                raise
+            await asyncio.sleep(settings.SPOTIFY_HTTP_BACKOFF * 2 ** attempt)
+            continue
+
+        if response.status_code != 429 and response.status_code < 500:
+            break
+        if attempt == settings.SPOTIFY_HTTP_RETRIES:
+            break
+
+        retry_after = response.headers.get('Retry-After', '')
+        if response.status_code == 429:
+            ratelimit.check_retry_after(retry_after or None)
+        if retry_after.isdigit():
+            await asyncio.sleep(int(retry_after))
+        else:
+            await asyncio.sleep(random.uniform(0, settings.SPOTIFY_HTTP_BACKOFF * 2 ** attempt))
+
+    response.raise_for_status()
+    return response.json()
+
+async def gather_limited(coroutines, limit=None):
+    '''asyncio.gather the coroutines, running at most limit of them at a time.
+
+    limit -- (default: settings.SPOTIFY_FETCH_WORKERS)'''
+
+    semaphore = asyncio.Semaphore(limit or settings.SPOTIFY_FETCH_WORKERS)
+
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+async def get_playlists(access_token):
+    '''Async spotify_utils.get_playlists.'''
+
+    offset_difference = 50
+
+    with metrics.span('spotify_playlists'):
+        first_page = await get(access_token, 'me/playlists', limit=offset_difference)
+        offsets = range(offset_difference, first_page.get('total') or 0, offset_difference)
+
+        pages = await gather_limited(get(access_token, 'me/playlists', limit=offset_difference,
+            offset=offset) for offset in offsets)
+
+    return [playlist for page in [first_page, *pages] for playlist in page['items']]
+
+async def get_tracks_from_playlists(access_token, playlist_ids, snapshot_ids=None, progress=None):
+    '''Async spotify_utils.get_tracks_from_playlists.
+
+    Every first page is requested at once, then every remaining page of every playlist,
+    at most settings.SPOTIFY_FETCH_WORKERS at a time.'''
+
+    offset_difference = 100
+    playlists_tracks = [None] * len(playlist_ids)
+    tracks_fetched = 0
+
+    async def fetch_page(playlist_id, offset):
+        nonlocal tracks_fetched
+
+        results = await get(access_token, f'playlists/{playlist_id}/items',
+            fields=TRACK_PAGE_FIELDS, limit=offset_difference, offset=offset,
+            market=settings.SPOTIFY_MARKET)
+        tracks = TrackRecord.from_items(results['items'])
+
+        tracks_fetched += len(tracks)
+        if progress is not None:
+            progress(tracks_fetched)
+
+        return tracks, results['total']
+
+    with metrics.span('spotify_playlist_tracks'):
+        if snapshot_ids is not None:
+            for idx, playlist_id in enumerate(playlist_ids):
+                playlists_tracks[idx] = await sync_to_async(track_cache.get)(playlist_id,
+                    snapshot_ids[idx])
+
+        missing = [idx for idx, tracks in enumerate(playlists_tracks) if tracks is None]
+        tracks_fetched = sum(len(tracks) for tracks in playlists_tracks if tracks is not None)
+
+        first_pages = await gather_limited(fetch_page(playlist_ids[idx], 0) for idx in missing)
+
+        other_pages = [(idx, offset) for idx, (_, total) in zip(missing, first_pages)
+            for offset in range(offset_difference, total, offset_difference)]
+        pages = await gather_limited(fetch_page(playlist_ids[idx], offset)
+            for idx, offset in other_pages)
+
+    for idx, (tracks, _) in zip(missing, first_pages):
+        playlists_tracks[idx] = list(tracks)
+    # gather keeps the order of other_pages, which is each playlist's pages in order
+    for (idx, _), (tracks, _) in zip(other_pages, pages):
+        playlists_tracks[idx].extend(tracks)
+
+    if snapshot_ids is not None:
+        for idx in missing:
+            await sync_to_async(track_cache.store)(playlist_ids[idx], snapshot_ids[idx],
+                playlists_tracks[idx])
+
+    return playlists_tracks
+
+async def get_recently_played(access_token):
+    '''Async spotify_utils.get_recently_played.'''
+
+    with metrics.span('spotify_recently_played'):
+        results = await get(access_token, 'me/player/recently-played', limit=50)
+
+    return TrackRecord.from_items(results['items'])
+
+async def queue_tracks(access_token, tracks, queue_limit=None, progress=None):
+    '''Async spotify_utils.queue_tracks.'''
+
+    uris = [track.uri for track in TrackRecord.from_items(tracks)][:queue_limit]
+    dispatcher = AsyncQueueDispatcher(access_token, client=get_client(),
+        timeout=settings.SPOTIFY_HTTP_TIMEOUT)
+
+    with metrics.span('spotify_add_to_queue'):
+        return await dispatcher.dispatch(uris, progress=progress)
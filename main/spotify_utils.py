@@ -1,36 +1,128 @@
 '''Helper functions to interact with the Spotify API.'''
 
+from bisect import bisect_right
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import accumulate, islice
+import random
+import threading
+from django.conf import settings
+import requests
 import spotipy
+from . import metrics
+from . import track_cache
+from .queue_dispatcher import QueueDispatcher
+from .ratelimit import RateLimitedAdapter, RateLimitedRetry
+from .tracks import TrackRecord
 
-def get_playlists(access_token):
+# Only the parts of a playlist item that TrackRecord keeps. Everything else, mostly
+# market lists and images, is left out of the response.
+TRACK_PAGE_FIELDS = 'total,items(track(uri,name,duration_ms,artists(id,name),album(id,name)))'
+
+_session = None
+_session_lock = threading.Lock()
+
+def get_session():
+    '''Return the requests.Session shared by every call to Spotify in this process.
+
+    Its connection pools keep connections to api.spotify.com and accounts.spotify.com
+    alive across requests and users, since tokens are sent per request rather than per
+    session. Idempotent requests are retried with backoff, honouring Retry-After.
+    Pool size, timeouts and retries come from the SPOTIFY_HTTP_* settings. Every
+    request and retry goes through the shared rate limit and circuit breaker of ratelimit.
+
+    Created on first use so that each forked gunicorn worker gets its own pools.'''
+
+    global _session
+
+    with _session_lock:
+        if _session is None:
+            retry = RateLimitedRetry(total=settings.SPOTIFY_HTTP_RETRIES,
+                backoff_factor=settings.SPOTIFY_HTTP_BACKOFF,
+                status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=True,
+                raise_on_status=False)
+            adapter = RateLimitedAdapter(pool_connections=4,
+                pool_maxsize=settings.SPOTIFY_HTTP_POOL_SIZE, max_retries=retry)
+
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.hooks['response'].append(metrics.count_spotify_response)
+            _session = session
+
+    return _session
+
+def connection_stats():
+    '''Count requests sent through the shared session and the connections opened for them.
+
+    Returns a dictionary with 'requests', 'connections_opened' and 'connections_reused',
+    the number of requests that went over an already open connection.'''
+
+    sent = opened = 0
+
+    for adapter in set(get_session().adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+            pool = pools.get(key)
+            if pool is not None:
+                sent += pool.num_requests
+                opened += pool.num_connections
+
+    return {'requests': sent, 'connections_opened': opened,
+        'connections_reused': max(sent - opened, 0)}
+
+class _SharedSessionSpotify(spotipy.Spotify):
+    '''spotipy client that leaves its session open when garbage collected.
+
+    spotipy.Spotify closes its session in __del__, which would drop the pooled
+    connections of the shared session every time a request's client goes away.'''
+
+    def __del__(self):
+        pass
+
+def _connect(access_token):
+    '''Build a spotipy client for the given token that talks to SPOTIFY_API_URL
+     over the shared session.'''
+
+    spotify_conn = _SharedSessionSpotify(auth=access_token, requests_session=get_session(),
+        requests_timeout=settings.SPOTIFY_HTTP_TIMEOUT)
+    spotify_conn.prefix = settings.SPOTIFY_API_URL
+
+    return spotify_conn
+
+@metrics.span('spotify_playlists')
+def get_playlists(access_token, max_workers=None):
     """Gets a user's playlists.
 
-    Assumes spotipy.spotify object passed in is already authenticated with a user.
+    The first page reports how many playlists there are, and the remaining pages
+    are then requested concurrently.
 
     Arguments:
 
-    access_token -- access token obtained from authenticating with Spotify after a user logs in."""
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
 
-    playlists = []
-    offset = 0
-    offset_difference = 50
+    max_workers -- maximum number of pages requested at the same time.
+     (default: settings.SPOTIFY_FETCH_WORKERS)"""
 
-    spotify_conn = spotipy.Spotify(auth=access_token)
+    if max_workers is None:
+        max_workers = settings.SPOTIFY_FETCH_WORKERS
 
-    while True:
-        results = spotify_conn.current_user_playlists(offset=offset)
+    offset_difference = 50
 
-        if not results['items']:
-            break
+    spotify_conn = _connect(access_token)
 
-        playlists.extend(results['items'])
+    first_page = spotify_conn.current_user_playlists(limit=offset_difference)
+    offsets = range(offset_difference, first_page.get('total') or 0, offset_difference)
+    if not offsets:
+        return list(first_page['items'])
 
-        if len(results['items']) < offset_difference:
-            break
+    def fetch_page(offset):
+        return spotify_conn.current_user_playlists(limit=offset_difference, offset=offset)['items']
 
-        offset += offset_difference
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pages = list(executor.map(fetch_page, offsets))
 
-    return playlists
+    return [playlist for page in [first_page['items'], *pages] for playlist in page]
 
 
 def get_tracks_from_playlist(access_token, playlist_id):
@@ -38,7 +130,7 @@ def get_tracks_from_playlist(access_token, playlist_id):
 
     Assumes spotipy.Spotify object passed in is already authenticated with a user
 
-    Returns list of track dictionary objects from Spotify API.
+    Returns list of TrackRecords.
     Returns empty list if playlist is empty or the playlist was not found.
 
     Arguments:
@@ -47,51 +139,408 @@ def get_tracks_from_playlist(access_token, playlist_id):
 
     playlist_id -- spotify id of the playlist to get the songs from"""
 
-    playlist_tracks = []
-    offset = 0
+    return get_tracks_from_playlists(access_token, [playlist_id])[0]
+
+@metrics.span('spotify_playlist_tracks')
+def get_tracks_from_playlists(access_token, playlist_ids, snapshot_ids=None, max_workers=None,
+    progress=None):
+    """Get tracks from several playlists, requesting their pages concurrently.
+
+    Playlists whose snapshot is in the track cache are served from it without any requests.
+    For the rest, the first page of every playlist is requested at once. As each one arrives,
+    the `total` it reports is used to request all of that playlist's remaining pages,
+    so pages from every selected playlist are in flight together.
+
+    Returns one list of TrackRecords per playlist, in the order of playlist_ids,
+    with each playlist's tracks in playlist order. Items without a playable track are dropped.
+
+    Arguments:
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    playlist_ids -- spotify ids of the playlists to get the songs from
+
+    snapshot_ids -- snapshot ids of the playlists, in the same order as playlist_ids.
+     Tracks are only cached when these are given. (default: None)
+
+    max_workers -- maximum number of pages requested at the same time.
+     (default: settings.SPOTIFY_FETCH_WORKERS)
+
+    progress -- function called with the number of tracks loaded so far,
+     after the cache lookups and after each page. (default: None)"""
+
+    if max_workers is None:
+        max_workers = settings.SPOTIFY_FETCH_WORKERS
+
+    playlists_tracks = [None] * len(playlist_ids)
+    if snapshot_ids is not None:
+        for idx, playlist_id in enumerate(playlist_ids):
+            playlists_tracks[idx] = track_cache.get(playlist_id, snapshot_ids[idx])
+
+    missing = [idx for idx, tracks in enumerate(playlists_tracks) if tracks is None]
+    tracks_fetched = sum(len(tracks) for tracks in playlists_tracks if tracks is not None)
+    if progress is not None:
+        progress(tracks_fetched)
+
+    if not missing:
+        return playlists_tracks
+
     offset_difference = 100
+    spotify_conn = _connect(access_token)
+    pages = {idx: {} for idx in missing}
 
-    spotify_conn = spotipy.Spotify(auth=access_token)
+    def fetch_page(playlist_id, offset):
+        results = spotify_conn.playlist_items(playlist_id, fields=TRACK_PAGE_FIELDS,
+            limit=offset_difference, offset=offset, market=settings.SPOTIFY_MARKET)
+        return TrackRecord.from_items(results['items']), results['total']
 
-    while True:
-        results = spotify_conn.user_playlist_tracks(playlist_id=playlist_id, offset=offset)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        first_pages = {executor.submit(fetch_page, playlist_ids[idx], 0): idx for idx in missing}
+        other_pages = {}
 
-        if not results['items']:
-            break
+        try:
+            for future in as_completed(first_pages):
+                idx = first_pages[future]
+                pages[idx][0], total = future.result()
+                tracks_fetched += len(pages[idx][0])
+                if progress is not None:
+                    progress(tracks_fetched)
 
-        playlist_tracks.extend(results['items'])
+                for offset in range(offset_difference, total, offset_difference):
+                    future = executor.submit(fetch_page, playlist_ids[idx], offset)
+                    other_pages[future] = (idx, offset)
 
-        if len(results['items']) < offset_difference:
-            break
+            for future in as_completed(other_pages):
+                idx, offset = other_pages[future]
+                pages[idx][offset] = future.result()[0]
+                tracks_fetched += len(pages[idx][offset])
+                if progress is not None:
+                    progress(tracks_fetched)
+        except:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    for idx, playlist_pages in pages.items():
+        playlists_tracks[idx] = [track for offset in sorted(playlist_pages)
+            for track in playlist_pages[offset]]
+
+        if snapshot_ids is not None:
+            track_cache.store(playlist_ids[idx], snapshot_ids[idx], playlists_tracks[idx])
 
-        offset += offset_difference
+    return playlists_tracks
 
-    return playlist_tracks
+def sample_positions(totals, sample_size, rng=None):
+    '''Pick sample_size distinct tracks uniformly at random from several playlists.
+
+    Every track of every playlist has the same chance of being picked, so a playlist
+    gets a share of the sample in proportion to its size.
+
+    Returns one sorted list of positions per playlist, in the order of totals.
+
+    Arguments:
 
-def queue_tracks(access_token, tracks, queue_limit=None):
-    '''Queues tracks.
+    totals -- number of tracks in each playlist.
+
+    sample_size -- number of tracks to pick. All of them are picked if there are fewer.
+
+    rng -- random.Random used to pick. (default: the random module)'''
+
+    if rng is None:
+        rng = random
+
+    ends = list(accumulate(totals))
+    track_count = ends[-1] if ends else 0
+    positions = [[] for _ in totals]
+
+    for index in sorted(rng.sample(range(track_count), min(sample_size, track_count))):
+        playlist = bisect_right(ends, index)
+        positions[playlist].append(index - (ends[playlist] - totals[playlist]))
+
+    return positions
+
+@metrics.span('spotify_playlist_sample')
+def sample_tracks_from_playlists(access_token, playlist_ids, sample_size, snapshot_ids=None,
+    max_workers=None, rng=None, progress=None):
+    """Get a uniform random sample of the tracks of several playlists.
+
+    Only the first page of each playlist, for its `total`, and the pages holding a
+    sampled track are requested, so the number of requests grows with sample_size
+    rather than with the size of the playlists. Playlists found in the track cache
+    are sampled without any request. Sampled tracks are not cached.
+
+    Returns one list of TrackRecords per playlist, in the order of playlist_ids, with
+    each playlist's sampled tracks in playlist order. Sampled items without a playable
+    track are dropped, so slightly fewer than sample_size tracks may be returned.
+
+    Arguments:
 
     access_token -- access token obtained from authenticating with Spotify after a user logs in.
 
-    tracks -- list of Spotify API track objects.
+    playlist_ids -- spotify ids of the playlists to get the songs from
 
-    queue_limit -- Specifies how many tracks to add. Will add all of them if unspecified.'''
+    sample_size -- number of tracks to pick across all of the playlists.
 
-    spotify_conn = spotipy.Spotify(auth=access_token)
+    snapshot_ids -- snapshot ids of the playlists, in the same order as playlist_ids,
+     used to look them up in the track cache. (default: None)
 
-    for idx, track in enumerate(tracks):
-        spotify_conn.add_to_queue(track['track']['uri'])
-        if queue_limit is not None and idx + 1 >= queue_limit:
-            break
+    max_workers -- maximum number of pages requested at the same time.
+     (default: settings.SPOTIFY_FETCH_WORKERS)
+
+    rng -- random.Random used to pick the tracks. (default: the random module)
+
+    progress -- function called with the number of tracks sampled so far,
+     after the first pages and after each other page. (default: None)"""
+
+    if max_workers is None:
+        max_workers = settings.SPOTIFY_FETCH_WORKERS
+
+    cached = [None] * len(playlist_ids)
+    if snapshot_ids is not None:
+        for idx, playlist_id in enumerate(playlist_ids):
+            cached[idx] = track_cache.get(playlist_id, snapshot_ids[idx])
 
+    missing = [idx for idx, tracks in enumerate(cached) if tracks is None]
+    totals = [len(tracks) if tracks is not None else 0 for tracks in cached]
+
+    offset_difference = 100
+    spotify_conn = _connect(access_token)
+    pages = {idx: {} for idx in missing}
+
+    def fetch_page(playlist_id, offset):
+        results = spotify_conn.playlist_items(playlist_id, fields=TRACK_PAGE_FIELDS,
+            limit=offset_difference, offset=offset, market=settings.SPOTIFY_MARKET)
+        # Items are kept in place, unplayable ones included, so positions line up
+        return results['items'], results['total']
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            first_pages = {executor.submit(fetch_page, playlist_ids[idx], 0): idx
+                for idx in missing}
+            for future in as_completed(first_pages):
+                idx = first_pages[future]
+                pages[idx][0], totals[idx] = future.result()
+
+            positions = sample_positions(totals, sample_size, rng)
+            page_samples = {idx: Counter(position - position % offset_difference
+                for position in positions[idx]) for idx in missing}
+
+            tracks_fetched = sum(len(positions[idx]) for idx, tracks in enumerate(cached)
+                if tracks is not None)
+            tracks_fetched += sum(page_samples[idx][0] for idx in missing)
+            if progress is not None:
+                progress(tracks_fetched)
+
+            other_pages = {}
+            for idx in missing:
+                for offset in sorted(page_samples[idx]):
+                    if offset != 0:
+                        future = executor.submit(fetch_page, playlist_ids[idx], offset)
+                        other_pages[future] = (idx, offset)
+
+            for future in as_completed(other_pages):
+                idx, offset = other_pages[future]
+                pages[idx][offset] = future.result()[0]
+                tracks_fetched += page_samples[idx][offset]
+                if progress is not None:
+                    progress(tracks_fetched)
+        except:
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+    playlists_tracks = []
+    for idx, tracks in enumerate(cached):
+        if tracks is not None:
+            playlists_tracks.append([tracks[position] for position in positions[idx]])
+            continue
+
+        items = []
+        for position in positions[idx]:
+            page = pages[idx][position - position % offset_difference]
+            if position % offset_difference < len(page):
+                items.append(page[position % offset_difference])
+        playlists_tracks.append(TrackRecord.from_items(items))
+
+    return playlists_tracks
+
+def iter_saved_tracks(access_token, max_workers=None):
+    """Stream the user's Liked Songs, yielding one list of TrackRecords per page as it arrives.
+
+    The first page gives the library's `total`. After it, at most max_workers pages are
+    requested ahead of the one being consumed, so only that many pages are held at once
+    however large the library is. Pages are yielded in library order, most recently
+    liked first. Items without a playable track are dropped.
+
+    Arguments:
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    max_workers -- maximum number of pages requested at the same time.
+     (default: settings.SPOTIFY_FETCH_WORKERS)"""
+
+    if max_workers is None:
+        max_workers = settings.SPOTIFY_FETCH_WORKERS
+
+    offset_difference = 50
+    spotify_conn = _connect(access_token)
+
+    def fetch_page(offset):
+        results = spotify_conn.current_user_saved_tracks(limit=offset_difference, offset=offset,
+            market=settings.SPOTIFY_MARKET)
+        return TrackRecord.from_items(results['items']), results['total']
+
+    first_page, total = fetch_page(0)
+    yield first_page
+
+    offsets = iter(range(offset_difference, total, offset_difference))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            pending = deque(executor.submit(fetch_page, offset)
+                for offset in islice(offsets, max_workers))
+
+            while pending:
+                tracks, _ = pending.popleft().result()
+                offset = next(offsets, None)
+                if offset is not None:
+                    pending.append(executor.submit(fetch_page, offset))
+                yield tracks
+        except:
+            # Also reached when the consumer stops early and the generator is closed
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+
+def sample_stream(pages, sample_size, rng=None, progress=None):
+    '''Pick sample_size tracks uniformly at random from pages of tracks, in one pass.
+
+    Tracks go through a reservoir as each page arrives, so memory stays in proportion
+    to sample_size however many pages there are.
+
+    Returns (tracks, total): the sampled tracks, in no particular order, and the number
+    of tracks read.
+
+    Arguments:
+
+    pages -- iterable of lists of tracks, such as iter_saved_tracks.
+
+    sample_size -- number of tracks to keep.
+
+    rng -- random.Random used to pick the tracks. (default: the random module)
+
+    progress -- function called with the number of tracks read so far, after each page.
+     (default: None)'''
+
+    if rng is None:
+        rng = random
+
+    sample = []
+    total = 0
+
+    for page in pages:
+        for track in page:
+            total += 1
+            if len(sample) < sample_size:
+                sample.append(track)
+                continue
+
+            idx = rng.randrange(total)
+            if idx < sample_size:
+                sample[idx] = track
+
+        if progress is not None:
+            progress(total)
+
+    return sample, total
+
+@metrics.span('spotify_saved_tracks')
+def sample_saved_tracks(access_token, sample_size, max_workers=None, rng=None, progress=None):
+    """Get a uniform random sample of the user's Liked Songs, streamed by iter_saved_tracks
+    through sample_stream.
+
+    Returns (tracks, total): the sampled TrackRecords, in no particular order, and the
+    number of playable tracks in the library.
+
+    Arguments:
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    sample_size -- number of tracks to keep.
+
+    max_workers -- maximum number of pages requested at the same time.
+     (default: settings.SPOTIFY_FETCH_WORKERS)
+
+    rng -- random.Random used to pick the tracks. (default: the random module)
+
+    progress -- function called with the number of tracks read so far, after each page.
+     (default: None)"""
+
+    return sample_stream(iter_saved_tracks(access_token, max_workers=max_workers),
+        sample_size, rng=rng, progress=progress)
+
+@metrics.span('spotify_add_to_queue')
+def queue_tracks(access_token, tracks, queue_limit=None, progress=None):
+    '''Queues tracks in order, waiting out rate limits and retrying transient errors.
+
+    Returns the number of tracks queued. Raises queue_dispatcher.QueueDispatchError,
+    which carries the number queued before the failure, if a track could not be queued.
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    tracks -- list of TrackRecords or Spotify API track objects.
+
+    queue_limit -- Specifies how many tracks to add. Will add all of them if unspecified.
+
+    progress -- function called with the number of tracks queued so far after each one.'''
+
+    uris = [track.uri for track in TrackRecord.from_items(tracks)][:queue_limit]
+
+    dispatcher = QueueDispatcher(access_token, session=get_session(),
+        timeout=settings.SPOTIFY_HTTP_TIMEOUT)
+
+    return dispatcher.dispatch(uris, progress=progress)
+
+@metrics.span('spotify_recently_played')
 def get_recently_played(access_token):
-    '''Get a user's recently played tracks.
+    '''Get a user's recently played tracks as TrackRecords, most recent first.
 
     access_token -- access token obtained from authenticating with Spotify after a user logs in.
     It is associated with the logged-in user.'''
 
-    spotify_conn = spotipy.Spotify(auth=access_token)
+    spotify_conn = _connect(access_token)
     results = spotify_conn.current_user_recently_played(limit=50)
-    recent_track_list = results['items']
+    recent_track_list = TrackRecord.from_items(results['items'])
 
     return recent_track_list
+
+def get_user_id(access_token):
+    '''Get the Spotify id of the user the access token belongs to.
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.'''
+
+    return _connect(access_token).current_user()['id']
+
+@metrics.span('spotify_recently_played')
+def get_plays_after(access_token, after=None):
+    '''Get a user's plays newer than a cursor, as recently played items with played_at.
+
+    Follows Spotify's paging until every play after the cursor has been fetched.
+    Spotify only keeps a user's last 50 plays, so older ones are never returned.
+
+    access_token -- access token obtained from authenticating with Spotify after a user logs in.
+
+    after -- Unix time in milliseconds. Only plays after it are returned, or the
+     latest page of plays if None. (default: None)'''
+
+    spotify_conn = _connect(access_token)
+    items = []
+
+    while True:
+        results = spotify_conn.current_user_recently_played(limit=50, after=after)
+        items.extend(results['items'])
+
+        cursors = results.get('cursors') or {}
+        if after is None or not results.get('next') or not cursors.get('after'):
+            break
+
+        after = cursors['after']
+
+    return items
@@ -1,3 +1,1315 @@
-from django.test import TestCase
+import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+import io
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import re
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from . import async_views
+from . import history
+from . import jobs
+from . import metrics
+from . import ratelimit
+from . import spotify_async
+from . import spotify_utils
+from . import tokens
+from . import trace
+from . import track_cache
+from . import views
+from .fake_spotify import FakeSpotify, make_playlist
+from .models import PlayHistory
+from .plans import ShufflePlan
+from .spotify_utils import sample_positions, sample_tracks_from_playlists
+from .queue_dispatcher import QueueDispatcher, QueueDispatchError
+from .shuffler import ScoredSong, Shuffler, WeightedSampler, numpy
+from .tracks import TrackRecord
+from .views import queue_job, queue_job_args
 
-# Create your tests here.
+
+def signed_user_id(user_id):
+    '''The value of the user_id cookie callback sets for a user.'''
+
+    response = HttpResponse()
+    response.set_signed_cookie('user_id', user_id)
+
+    return response.cookies['user_id'].value
+
+def make_records(count, artists=20):
+    '''Build count TrackRecords spread over the given number of artists.'''
+
+    return [TrackRecord(f'spotify:track:{idx}', f'Track {idx}', artist_name=f'Artist {idx % artists}',
+        album_name=f'Album {idx % (artists * 2)}') for idx in range(count)]
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+class NumpyScoringTests(SimpleTestCase):
+    '''The numpy scoring backend must score songs like get_score does.'''
+
+    def test_recency_bias_matches_python(self):
+        ranks = [None, 1, 2, 5, 20, 50, 1000]
+        expected = [Shuffler.get_recency_bias(ScoredSong(None, recently_played=rank))
+            for rank in ranks]
+
+        numpy.testing.assert_allclose(Shuffler.recency_bias_batch(ranks), expected)
+
+    def test_score_distribution_matches_python(self):
+        samples = 20000
+        random.seed(7)
+
+        for rank in (None, 1, 10, 50):
+            python_scores = sorted(Shuffler.get_score(ScoredSong(None, recently_played=rank))
+                for _ in range(samples))
+            numpy_scores = numpy.sort(Shuffler.score_batch([rank] * samples,
+                Shuffler.numpy_rng(7)))
+
+            bias = Shuffler.get_recency_bias(ScoredSong(None, recently_played=rank))
+            self.assertGreaterEqual(numpy_scores[0], bias)
+            self.assertLessEqual(numpy_scores[-1], bias + 1000)
+
+            # Deciles of two uniform samples of this size agree to within a few points
+            for decile in range(1, 10):
+                idx = samples * decile // 10
+                self.assertAlmostEqual(numpy_scores[idx], python_scores[idx], delta=15)
+
+    def test_seeded_shuffles_repeat(self):
+        songs = make_records(500)
+        recency_index = {songs[0].uri: 1, songs[1].uri: 2}
+
+        first = Shuffler.shuffle_single_playlist(songs, [], recency_index=recency_index,
+            no_double_artist=True, rng=Shuffler.numpy_rng(3))
+        second = Shuffler.shuffle_single_playlist(songs, [], recency_index=recency_index,
+            no_double_artist=True, rng=Shuffler.numpy_rng(3))
+
+        self.assertEqual(first, second)
+        self.assertCountEqual(first, songs)
+
+
+class QueueDispatcherTests(SimpleTestCase):
+    '''The dispatcher must queue every track in order despite 429s and 5xx responses.'''
+
+    uris = [f'spotify:track:{idx}' for idx in range(12)]
+
+    def dispatch(self, fake, **kwargs):
+        with override_settings(SPOTIFY_API_URL=fake.url):
+            return QueueDispatcher('token', backoff=0.01, **kwargs).dispatch(self.uris)
+
+    def test_retries_rate_limited_requests_in_order(self):
+        with FakeSpotify(latency=0.005, throttle_every=3, retry_after=0) as fake:
+            self.assertEqual(self.dispatch(fake), len(self.uris))
+
+        self.assertEqual(fake.queued, self.uris)
+        self.assertGreater(fake.throttled, 0)
+
+    def test_resumes_after_server_errors(self):
+        with FakeSpotify(latency=0.005, error_rate=0.3) as fake:
+            self.assertEqual(self.dispatch(fake, max_retries=10), len(self.uris))
+
+        self.assertEqual(fake.queued, self.uris)
+        self.assertGreater(fake.failed, 0)
+
+    def test_gives_up_after_max_retries(self):
+        with FakeSpotify(throttle_every=1, retry_after=0) as fake:
+            with self.assertRaises(QueueDispatchError) as context:
+                self.dispatch(fake, max_retries=2)
+
+        self.assertEqual(context.exception.status, 429)
+        self.assertEqual(context.exception.queued, 0)
+
+    def test_no_active_device_fails_fast(self):
+        with FakeSpotify(active_device=False) as fake:
+            with self.assertRaises(QueueDispatchError) as context:
+                self.dispatch(fake)
+
+        self.assertEqual(context.exception.status, 404)
+        self.assertEqual(context.exception.reason, 'NO_ACTIVE_DEVICE')
+        self.assertEqual(fake.request_count, 1)
+
+
+class SkewedFakeSpotify(FakeSpotify):
+    '''FakeSpotify that answers later pages of a playlist sooner than earlier ones, and
+    records how many requests it served at once and the order pages finished in.'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.finished = []
+
+    def route(self, method, path, params, headers=None):
+        with self._lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+        offset = int(params.get('offset', 0))
+        time.sleep(0.005 * (self.playlist_size - offset) / 100)
+        try:
+            return super().route(method, path, params, headers)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+                self.finished.append(offset)
+
+
+class ConcurrentFetchTests(SimpleTestCase):
+    '''Pages must be put back in playlist order and never exceed the worker cap.'''
+
+    def test_out_of_order_pages_keep_playlist_order(self):
+        with SkewedFakeSpotify(playlist_count=2, playlist_size=1000) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                playlists_tracks = spotify_utils.get_tracks_from_playlists('token',
+                    fake.playlist_ids(), max_workers=3)
+
+        self.assertNotEqual(fake.finished, sorted(fake.finished))
+        self.assertEqual(fake.max_in_flight, 3)
+        for playlist_id, tracks in zip(fake.playlist_ids(), playlists_tracks):
+            self.assertEqual([track.uri for track in tracks],
+                [item['track']['uri'] for item in make_playlist(playlist_id, 1000)])
+
+
+class SharedSessionTests(SimpleTestCase):
+    '''Calls to Spotify must reuse the shared session's pooled connections.'''
+
+    def test_connections_are_reused(self):
+        # A session of its own, since only the pools still open are counted and other
+        # tests' pools get evicted
+        with mock.patch.object(spotify_utils, '_session', None), \
+         FakeSpotify(playlist_count=1, playlist_size=10) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                for _ in range(5):
+                    spotify_utils.get_recently_played('token')
+                stats = spotify_utils.connection_stats()
+
+        self.assertEqual(stats, {'requests': 5, 'connections_opened': 1,
+            'connections_reused': 4})
+
+
+class TrackPageFieldsTests(SimpleTestCase):
+    '''Track pages must be asked for with only the fields used, and still parse into
+    complete TrackRecords.'''
+
+    def assert_projected(self, fake, playlists_tracks):
+        page_requests = [params for method, path, params in fake.request_log
+            if re.fullmatch(r'/v1/playlists/[^/]+/(tracks|items)', path)]
+        self.assertEqual(len(page_requests), 4)
+        for params in page_requests:
+            self.assertEqual(params['fields'], spotify_utils.TRACK_PAGE_FIELDS)
+            self.assertEqual(params['market'], settings.SPOTIFY_MARKET)
+
+        expected = [TrackRecord.from_items(make_playlist(playlist_id, 150))
+            for playlist_id in fake.playlist_ids()]
+        self.assertEqual(playlists_tracks, expected)
+        for field in TrackRecord.__slots__:
+            self.assertIsNotNone(getattr(playlists_tracks[0][0], field), field)
+
+    def test_sync_pages_are_projected(self):
+        with FakeSpotify(playlist_count=2, playlist_size=150) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                playlists_tracks = spotify_utils.get_tracks_from_playlists('token',
+                    fake.playlist_ids())
+
+        self.assert_projected(fake, playlists_tracks)
+
+    async def test_async_pages_are_projected(self):
+        with FakeSpotify(playlist_count=2, playlist_size=150) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                playlists_tracks = await spotify_async.get_tracks_from_playlists('token',
+                    fake.playlist_ids())
+                await spotify_async.aclose()
+
+        self.assert_projected(fake, playlists_tracks)
+
+
+@override_settings(TRACK_CACHE_ALIAS='default')
+class TrackCacheTests(SimpleTestCase):
+    '''Snapshots must be served from the cache, evicting least recently used ones.'''
+
+    def setUp(self):
+        track_cache.clear()
+
+    def test_least_recently_used_is_evicted(self):
+        tracks = make_records(50)
+        size = len(pickle.dumps(tracks, pickle.HIGHEST_PROTOCOL))
+
+        with override_settings(TRACK_CACHE_MAX_BYTES=size * 2):
+            track_cache.store('a', 's', tracks)
+            track_cache.store('b', 's', tracks)
+            self.assertIsNotNone(track_cache.get('a', 's'))
+            track_cache.store('c', 's', tracks)
+
+        self.assertIsNotNone(track_cache.get('a', 's'))
+        self.assertIsNone(track_cache.get('b', 's'))
+        self.assertIsNotNone(track_cache.get('c', 's'))
+        self.assertEqual(track_cache.stats()['bytes'], size * 2)
+
+    def test_entries_over_the_budget_are_not_cached(self):
+        with override_settings(TRACK_CACHE_MAX_BYTES=100):
+            track_cache.store('a', 's', make_records(50))
+
+        self.assertIsNone(track_cache.get('a', 's'))
+        self.assertEqual(track_cache.stats()['entries'], 0)
+
+    def test_hits_and_misses_are_counted(self):
+        track_cache.get('a', 's')
+        track_cache.store('a', 's', make_records(5))
+        track_cache.get('a', 's')
+        track_cache.get('a', 's')
+        # A new snapshot of the same playlist is a miss
+        track_cache.get('a', 't')
+
+        stats = track_cache.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['entries']), (2, 2, 1))
+
+    def test_repeat_shuffle_requests_no_pages(self):
+        with FakeSpotify(playlist_count=2, playlist_size=250) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                snapshot_ids = [f'{playlist_id}-snapshot' for playlist_id in fake.playlist_ids()]
+                first = spotify_utils.get_tracks_from_playlists('token', fake.playlist_ids(),
+                    snapshot_ids)
+                requests_made = fake.request_count
+                second = spotify_utils.get_tracks_from_playlists('token', fake.playlist_ids(),
+                    snapshot_ids)
+
+        self.assertEqual(requests_made, 6)
+        self.assertEqual(fake.request_count, requests_made)
+        self.assertEqual(second, first)
+
+    @override_settings(JOB_CACHE_ALIAS='default', PLAYLIST_CACHE_ALIAS='default')
+    def test_stale_snapshot_from_page_is_not_a_key(self):
+        with FakeSpotify(playlist_count=1, playlist_size=30) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                queue_job(jobs.Job('snapshot-test'), 'token', ['fake0'], ['stale'], 20)
+
+        self.assertIsNone(track_cache.get('fake0', 'stale'))
+        self.assertEqual(len(track_cache.get('fake0', 'fake0-snapshot')), 30)
+
+    @override_settings(PLAYLIST_CACHE_ALIAS='default')
+    def test_only_the_users_playlists_have_snapshots(self):
+        with FakeSpotify(playlist_count=2, playlist_size=10) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                self.assertEqual(views.current_snapshots('token', None, ['fake1', 'fake0']),
+                    ['fake1-snapshot', 'fake0-snapshot'])
+                # Another user's private playlist is fetched without the track cache
+                self.assertIsNone(views.current_snapshots('token', None, ['fake0', 'private']))
+
+
+class SampledFetchTests(SimpleTestCase):
+    '''Sampled mode must pick every track with the same probability and fetch few pages.'''
+
+    def test_selection_is_uniform(self):
+        totals = [3, 12, 0, 25]
+        track_count = sum(totals)
+        sample_size = 8
+        trials = 20000
+        rng = random.Random(11)
+        counts = [[0] * total for total in totals]
+
+        for _ in range(trials):
+            positions = sample_positions(totals, sample_size, rng)
+            self.assertEqual(sum(map(len, positions)), sample_size)
+            for playlist, playlist_positions in enumerate(positions):
+                self.assertEqual(len(set(playlist_positions)), len(playlist_positions))
+                for position in playlist_positions:
+                    counts[playlist][position] += 1
+
+        # Pearson's chi-squared over every track; 73.4 is the p = 0.001 cut-off for 39
+        # degrees of freedom, so a uniform sampler fails this one time in a thousand
+        expected = trials * sample_size / track_count
+        chi_squared = sum((count - expected) ** 2 / expected
+            for playlist_counts in counts for count in playlist_counts)
+        self.assertLess(chi_squared, 73.4)
+
+    def test_small_playlists_are_taken_whole(self):
+        self.assertEqual(sample_positions([2, 3], 10), [[0, 1], [0, 1, 2]])
+        self.assertEqual(sample_positions([], 10), [])
+
+    def test_requests_scale_with_sample_size(self):
+        with FakeSpotify(playlist_count=2, playlist_size=5000) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                playlists_tracks = sample_tracks_from_playlists('token', fake.playlist_ids(),
+                    20, rng=random.Random(5))
+
+        self.assertEqual(sum(map(len, playlists_tracks)), 20)
+        # Two first pages, then at most one page per sampled track, out of 100 pages
+        self.assertLessEqual(fake.request_count, 2 + 20)
+        for tracks in playlists_tracks:
+            self.assertEqual(len({track.uri for track in tracks}), len(tracks))
+
+
+class LikedSongsTests(SimpleTestCase):
+    '''Liked Songs must be streamed into a uniform sample without holding the library.'''
+
+    def test_sample_is_uniform(self):
+        pages = [list(range(start, start + 50)) for start in range(0, 200, 50)]
+        sample_size = 10
+        trials = 4000
+        rng = random.Random(3)
+        counts = Counter()
+
+        for _ in range(trials):
+            sample, total = spotify_utils.sample_stream(iter(pages), sample_size, rng=rng)
+            self.assertEqual(total, 200)
+            self.assertEqual(len(set(sample)), sample_size)
+            counts.update(sample)
+
+        # Pearson's chi-squared over every track; 266.4 is the p = 0.001 cut-off for 199
+        # degrees of freedom
+        expected = trials * sample_size / total
+        chi_squared = sum((counts[track] - expected) ** 2 / expected for track in range(total))
+        self.assertLess(chi_squared, 266.4)
+
+    def test_pages_are_requested_as_consumed(self):
+        with FakeSpotify(saved_count=30000) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                pages = spotify_utils.iter_saved_tracks('token', max_workers=4)
+                for _ in range(3):
+                    next(pages)
+                pages.close()
+
+        # The first page, the two consumed after it, and at most four in flight, of 600
+        self.assertLessEqual(fake.request_count, 1 + 2 + 4)
+
+    @override_settings(JOB_CACHE_ALIAS='default', TRACK_CACHE_ALIAS='default',
+        PLAYLIST_CACHE_ALIAS='default')
+    def test_queue_with_liked_songs(self):
+        caches['default'].clear()
+        request = RequestFactory().post('/queue', {'selected_playlists[]': ['fake0', 'liked'],
+            'selected_snapshots[]': ['fake0-snapshot', ''], 'queue_limit': '20'})
+        request.COOKIES.update(access_token='token', refresh_token='token')
+        job_args = queue_job_args(request)
+        self.assertEqual(job_args[1:3], (['fake0'], ['fake0-snapshot']))
+        self.assertTrue(job_args[-1])
+
+        job = jobs.Job('liked-test')
+        with FakeSpotify(playlist_count=1, playlist_size=100, saved_count=900) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                queue_job(job, *job_args)
+                liked = {track.uri for page in spotify_utils.iter_saved_tracks('token')
+                    for track in page}
+
+        self.assertEqual(job.message, 'Success!')
+        self.assertEqual(len(set(fake.queued)), 20)
+        # Weighed by library size, Liked Songs has 9 in 10 of the picks
+        self.assertGreater(len(liked.intersection(fake.queued)), 10)
+
+
+class RateLimitTests(SimpleTestCase):
+    '''Workers must share one token bucket and stop calling Spotify while it is failing.'''
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        settings_override = override_settings(SPOTIFY_RATE_LIMIT=100,
+            SPOTIFY_RATE_LIMIT_BURST=5, SPOTIFY_RATE_LIMIT_MAX_WAIT=10,
+            SPOTIFY_CIRCUIT_FAILURES=3, SPOTIFY_CIRCUIT_COOLDOWN=0.2,
+            SPOTIFY_RATE_LIMIT_FILE=os.path.join(directory.name, 'ratelimit'))
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_bucket_spaces_calls(self):
+        # A fixed clock, so no tokens come back between the calls however slow they are
+        with mock.patch.object(ratelimit, 'time') as clock:
+            clock.time.return_value = 1000.0
+            waits = [ratelimit.reserve() for _ in range(15)]
+
+        self.assertEqual(waits[:5], [0.0] * 5)
+        self.assertAlmostEqual(waits[5], 0.01)
+        self.assertAlmostEqual(waits[14], 0.1)
+
+    @override_settings(SPOTIFY_RATE_LIMIT=1)
+    def test_bucket_is_shared_between_processes(self):
+        # Slow enough that no token comes back while the child exits
+        process = multiprocessing.get_context('fork').Process(
+            target=lambda: [ratelimit.reserve() for _ in range(5)])
+        process.start()
+        process.join()
+
+        self.assertGreater(ratelimit.reserve(), 0)
+
+    def test_retry_after_holds_every_call(self):
+        ratelimit.observe(429, '2')
+        self.assertGreater(ratelimit.reserve(), 1.9)
+
+        with override_settings(SPOTIFY_RATE_LIMIT_MAX_WAIT=1):
+            with self.assertRaises(ratelimit.SpotifyUnavailable):
+                ratelimit.reserve()
+
+    @override_settings(SPOTIFY_RATE_LIMIT_MAX_WAIT=1)
+    def test_long_retry_after_fails_fast(self):
+        with FakeSpotify(playlist_count=1, playlist_size=50, throttle_every=1,
+         retry_after=20) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                start = time.monotonic()
+                with self.assertRaises(ratelimit.SpotifyUnavailable):
+                    spotify_utils.get_tracks_from_playlists('token', fake.playlist_ids())
+                self.assertLess(time.monotonic() - start, 5)
+
+        # The 429 holds the limiter off too, so the async path gets a limiter of its own
+        with FakeSpotify(playlist_count=1, playlist_size=50, throttle_every=1,
+         retry_after=20) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url, SPOTIFY_RATE_LIMIT_FILE=
+             os.path.join(os.path.dirname(settings.SPOTIFY_RATE_LIMIT_FILE), 'async')):
+                async def fetch():
+                    try:
+                        await spotify_async.get_tracks_from_playlists('token',
+                            fake.playlist_ids())
+                    finally:
+                        await spotify_async.aclose()
+
+                start = time.monotonic()
+                with self.assertRaises(ratelimit.SpotifyUnavailable):
+                    asyncio.run(fetch())
+                self.assertLess(time.monotonic() - start, 5)
+
+    def test_circuit_opens_and_probes(self):
+        for _ in range(3):
+            ratelimit.failure()
+        with self.assertRaises(ratelimit.SpotifyUnavailable):
+            ratelimit.reserve()
+
+        time.sleep(0.25)
+        ratelimit.reserve()
+        # Only the one probe goes through until it reports back
+        with self.assertRaises(ratelimit.SpotifyUnavailable):
+            ratelimit.reserve()
+
+        ratelimit.observe(200)
+        ratelimit.reserve()
+
+    def test_open_circuit_does_not_log_users_out(self):
+        for _ in range(3):
+            ratelimit.failure()
+
+        request = RequestFactory().get('/playlists')
+        request.COOKIES.update(access_token='token', user_id=signed_user_id('rate-limit-test'))
+        with override_settings(PLAYLIST_CACHE_ALIAS='default'):
+            response = views.playlists(request)
+
+        self.assertEqual(response.status_code, 503)
+        self.assertIn('Spotify is unavailable', json.loads(response.content)['message'])
+
+    def test_stub_limit_is_not_exceeded(self):
+        # At most 4 + 14 requests in any one second, leaving the stub's window of 20 room
+        # for requests that are sent on time but arrive together
+        with override_settings(SPOTIFY_RATE_LIMIT=14, SPOTIFY_RATE_LIMIT_BURST=4):
+            with FakeSpotify(playlist_count=4, playlist_size=750, rate_limit=20,
+             retry_after=0) as fake:
+                with override_settings(SPOTIFY_API_URL=fake.url):
+                    playlists_tracks = spotify_utils.get_tracks_from_playlists('token',
+                        fake.playlist_ids())
+
+        self.assertEqual([len(tracks) for tracks in playlists_tracks], [750] * 4)
+        self.assertEqual(fake.throttled, 0)
+
+
+@override_settings(TOKEN_CACHE_ALIAS='default')
+class TokenManagerTests(SimpleTestCase):
+    '''Access tokens must be refreshed ahead of expiry, once per login however many ask.'''
+
+    def setUp(self):
+        caches['default'].clear()
+        self.requests = []
+
+    def request_token(self, data):
+        self.requests.append(data)
+        time.sleep(0.1)
+        return {'access_token': f'access-{len(self.requests)}', 'expires_in': 3600}
+
+    def test_fresh_token_is_not_refreshed(self):
+        tokens.store('refresh', {'access_token': 'access-0', 'expires_in': 3600})
+
+        with mock.patch.object(tokens, 'request_token', self.request_token):
+            self.assertEqual(tokens.get('refresh'), 'access-0')
+        self.assertEqual(self.requests, [])
+        self.assertIsNone(tokens.get('someone-else'))
+
+    def test_expiring_token_is_refreshed_in_background(self):
+        tokens.store('refresh', {'access_token': 'access-0', 'expires_in': 100})
+
+        with mock.patch.object(tokens, 'request_token', self.request_token):
+            start = time.perf_counter()
+            self.assertEqual(tokens.get('refresh'), 'access-0')
+            self.assertLess(time.perf_counter() - start, 0.05)
+
+            self.assertEqual(tokens.refresh('refresh').result(), 'access-1')
+            self.assertEqual(tokens.get('refresh'), 'access-1')
+
+        self.assertEqual(self.requests, [{'grant_type': 'refresh_token',
+            'refresh_token': 'refresh'}])
+
+    def test_concurrent_requests_share_one_refresh(self):
+        tokens.store('refresh', {'access_token': 'access-0', 'expires_in': 0})
+
+        with mock.patch.object(tokens, 'request_token', self.request_token):
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                results = list(executor.map(lambda _: tokens.get('refresh'), range(10)))
+
+        self.assertEqual(results, ['access-1'] * 10)
+        self.assertEqual(len(self.requests), 1)
+
+    def test_refused_refresh_forgets_login(self):
+        tokens.store('refresh', {'access_token': 'access-0', 'expires_in': 0})
+
+        def refuse(data):
+            raise tokens.TokenError('invalid_grant', 400)
+
+        with mock.patch.object(tokens, 'request_token', refuse):
+            with self.assertLogs('main.tokens', 'WARNING'):
+                self.assertIsNone(tokens.get('refresh'))
+        self.assertIsNone(caches['default'].get(tokens._key('refresh'))) # pylint: disable=protected-access
+
+    def test_requests_use_the_managed_token(self):
+        tokens.store('refresh', {'access_token': 'managed', 'expires_in': 3600})
+
+        request = RequestFactory().post('/queue', {'selected_playlists[]': ['fake0'],
+            'queue_limit': '20'})
+        request.COOKIES.update(access_token='expired', refresh_token='refresh')
+
+        self.assertEqual(queue_job_args(request)[0], 'managed')
+
+
+@override_settings(TOKEN_CACHE_ALIAS='default')
+@mock.patch.dict(os.environ, CLIENT_ID='client', CLIENT_SECRET='secret',
+    REDIRECT_URI='http://testserver/callback')
+class FakeAccountsTests(SimpleTestCase):
+    '''Logging in and refreshing must work against the fake accounts service.'''
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def log_in(self, fake):
+        response = self.client.get('/login')
+        response = spotify_utils.get_session().get(response['Location'], allow_redirects=False)
+        self.assertTrue(response.headers['Location'].startswith('http://testserver/callback?code='))
+
+        return self.client.get(response.headers['Location'].removeprefix('http://testserver'))
+
+    def test_login_reaches_select(self):
+        with FakeSpotify(playlist_count=1, playlist_size=10) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url,
+                SPOTIFY_ACCOUNTS_URL=fake.accounts_url):
+                response = self.log_in(fake)
+
+        self.assertRedirects(response, '/select', fetch_redirect_response=False)
+        request = RequestFactory().get('/select')
+        request.COOKIES['user_id'] = response.cookies['user_id'].value
+        self.assertEqual(views.get_user_id(request), 'fake-user-1')
+        self.assertEqual(tokens.get(response.cookies['refresh_token'].value),
+            response.cookies['access_token'].value)
+        self.assertEqual(fake.token_requests, 1)
+
+    def test_expired_token_is_refreshed(self):
+        with FakeSpotify(playlist_count=1, playlist_size=10, token_lifetime=0) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url,
+                SPOTIFY_ACCOUNTS_URL=fake.accounts_url):
+                response = self.log_in(fake)
+                access_token = tokens.get(response.cookies['refresh_token'].value)
+
+        self.assertNotEqual(access_token, response.cookies['access_token'].value)
+        self.assertTrue(access_token.startswith('fake-user-1-access-'))
+        self.assertEqual(fake.token_requests, 2)
+
+
+class HistorySyncTests(TestCase):
+    '''Listening history must sync incrementally and rank tracks by their latest play.'''
+
+    def test_forged_user_id_is_ignored(self):
+        request = RequestFactory().post('/queue', {'selected_playlists[]': ['fake0'],
+            'queue_limit': '20'})
+        request.COOKIES.update(access_token='token', refresh_token='refresh', user_id='victim')
+        self.assertIsNone(queue_job_args(request)[5])
+
+        request.COOKIES['user_id'] = signed_user_id('victim')
+        self.assertEqual(queue_job_args(request)[5], 'victim')
+
+    def sync(self, fake):
+        with override_settings(SPOTIFY_API_URL=fake.url):
+            return history.sync('token', 'user', min_interval=0)
+
+    def test_only_new_plays_are_downloaded(self):
+        with FakeSpotify(play_count=80) as fake:
+            self.assertEqual(self.sync(fake), 50)
+
+            fake.play(120)
+            requests_before = fake.request_count
+            self.assertEqual(self.sync(fake), 120)
+            # 120 new plays come in pages of 50, 50 and 20
+            self.assertEqual(fake.request_count - requests_before, 3)
+
+            requests_before = fake.request_count
+            self.assertEqual(self.sync(fake), 0)
+            self.assertEqual(fake.request_count - requests_before, 1)
+
+        self.assertEqual(PlayHistory.objects.filter(user_id='user').count(), 170)
+
+    def test_recency_index_ranks_latest_play(self):
+        with FakeSpotify(playlist_size=30, play_count=50) as fake:
+            self.sync(fake)
+            newest = [track['uri'] for _, track in reversed(fake.plays)]
+
+        index = history.recency_index('user')
+
+        # Tracks repeat every 30 plays, so each keeps the rank of its latest play
+        self.assertEqual(len(index), 30)
+        for rank, uri in enumerate(newest[:30], 1):
+            self.assertEqual(index[uri], rank)
+        self.assertEqual(len(history.recency_index('user', limit=10)), 10)
+
+    @override_settings(JOB_CACHE_ALIAS='default', TRACK_CACHE_ALIAS='default')
+    def test_failed_sync_uses_stored_plays(self):
+        with FakeSpotify(playlist_count=1, playlist_size=30, play_count=50) as fake:
+            self.sync(fake)
+            expected = history.recency_index('user')
+
+            job = jobs.Job('history-test')
+            unavailable = ratelimit.SpotifyUnavailable('Spotify is unavailable.', 30)
+            with mock.patch.object(history, 'sync', side_effect=unavailable), \
+             self.assertLogs('main.views', 'WARNING'):
+                self.assertEqual(views.synced_recency_index('token', 'user'), expected)
+                with override_settings(SPOTIFY_API_URL=fake.url):
+                    queue_job(job, 'token', fake.playlist_ids(), None, 20, user_id='user')
+
+        self.assertEqual(job.message, 'Success!')
+        self.assertEqual(len(fake.queued), 20)
+
+    def test_recent_sync_is_skipped(self):
+        with FakeSpotify() as fake:
+            self.sync(fake)
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                self.assertEqual(history.sync('token', 'user', min_interval=60), 0)
+
+            self.assertEqual(fake.request_count, 1)
+
+
+@override_settings(PLAYLIST_CACHE_ALIAS='default')
+class PlaylistEndpointTests(SimpleTestCase):
+    '''/playlists must serve pages from the cache, filter by name, and 401 without a token.'''
+
+    def get(self, fake, **params):
+        self.client.cookies['access_token'] = 'token'
+        self.client.cookies['user_id'] = signed_user_id('paging-user')
+        with override_settings(SPOTIFY_API_URL=fake.url):
+            return self.client.get('/playlists', params)
+
+    def test_pages_come_from_the_cache(self):
+        with FakeSpotify(playlist_count=130) as fake:
+            first = self.get(fake, offset=0, limit=50, refresh=1).json()
+            requests_after_first = fake.request_count
+            last = self.get(fake, offset=100, limit=50).json()
+
+        self.assertEqual(requests_after_first, 3)
+        self.assertEqual(fake.request_count, requests_after_first)
+        self.assertEqual(first['total'], 130)
+        self.assertEqual(first['next'], 50)
+        self.assertEqual([playlist['id'] for playlist in last['items']], fake.playlist_ids()[100:])
+        self.assertIsNone(last['next'])
+
+    def test_filters_by_name(self):
+        with FakeSpotify(playlist_count=30) as fake:
+            page = self.get(fake, q='FAKE2', refresh=1).json()
+
+        self.assertEqual([playlist['id'] for playlist in page['items']],
+            ['fake2'] + [f'fake2{idx}' for idx in range(10)])
+
+    def test_missing_token_is_unauthorized(self):
+        self.assertEqual(self.client.get('/playlists').status_code, 401)
+
+    def test_forged_user_id_misses_the_cache(self):
+        with FakeSpotify(playlist_count=3) as fake:
+            self.get(fake, refresh=1)
+            requests_before = fake.request_count
+
+            self.client.cookies['access_token'] = 'garbage'
+            self.client.cookies['user_id'] = 'paging-user'
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                self.client.get('/playlists')
+
+        self.assertEqual(fake.request_count, requests_before + 1)
+
+
+class InlineBackend:
+    '''Job backend that runs each job before submit returns.'''
+
+    def submit(self, func):
+        func()
+
+
+@override_settings(JOB_CACHE_ALIAS='default', TOKEN_CACHE_ALIAS='default',
+    TRACK_CACHE_ALIAS='default', PLAYLIST_CACHE_ALIAS='default')
+class QueueEndpointTests(SimpleTestCase):
+    '''/queue must start a job whose progress /queue/status/<id> reports.'''
+
+    def setUp(self):
+        caches['default'].clear()
+        backend_patch = mock.patch.object(jobs, '_backend', InlineBackend())
+        backend_patch.start()
+        self.addCleanup(backend_patch.stop)
+
+    def queue(self, fake, **data):
+        self.client.cookies['access_token'] = 'token'
+        self.client.cookies['refresh_token'] = 'refresh'
+        snapshots = [f'{playlist_id}-snapshot' for playlist_id in fake.playlist_ids()]
+        data = {'selected_playlists[]': fake.playlist_ids(), 'selected_snapshots[]': snapshots,
+            'queue_limit': '10', **data}
+        with override_settings(SPOTIFY_API_URL=fake.url):
+            return self.client.post('/queue', data)
+
+    def test_status_reports_progress(self):
+        with FakeSpotify(playlist_count=2, playlist_size=60) as fake:
+            response = self.queue(fake)
+
+        self.assertEqual(response.status_code, 200)
+        status = self.client.get(f'/queue/status/{response.json()["job_id"]}')
+        self.assertEqual(status.status_code, 200)
+        self.assertEqual(status.json(), {'id': response.json()['job_id'], 'phase': 'done',
+            'tracks_fetched': 120, 'tracks_queued': 10, 'done': True, 'error': False,
+            'message': 'Success!'})
+
+    def test_failed_job_is_marked(self):
+        with FakeSpotify(playlist_count=1, playlist_size=30, active_device=False) as fake:
+            response = self.queue(fake)
+
+        status = self.client.get(f'/queue/status/{response.json()["job_id"]}').json()
+        self.assertEqual((status['phase'], status['done'], status['error']),
+            ('failed', True, True))
+        self.assertIn('device is actively playing', status['message'])
+
+    def test_unknown_job_is_404(self):
+        response = self.client.get('/queue/status/unknown')
+
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'message': 'ERROR: Unknown job.'})
+
+    def test_incomplete_request_starts_no_job(self):
+        with FakeSpotify(playlist_count=1, playlist_size=30) as fake:
+            response = self.queue(fake, queue_limit=[])
+
+        self.assertEqual(response.content,
+            b'ERROR: Selected playlists or queue limit not received.')
+        self.assertEqual(fake.request_count, 0)
+
+
+class BenchRegressionTests(SimpleTestCase):
+    '''bench_regression --require-baseline must fail without a baseline to compare with.'''
+
+    def bench(self, *args):
+        call_command('bench_regression', *args, '--baseline', self.path, '--repeat', '1',
+            '--sizes', '50', '--playlist-counts', '2', '--playlist-size', '20',
+            '--interleave-counts', '2', stdout=io.StringIO())
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'baseline.json')
+
+    def test_missing_baseline_fails(self):
+        self.bench()
+        with self.assertRaisesMessage(CommandError, 'No baseline'):
+            self.bench('--require-baseline')
+
+        self.bench('--save')
+        self.bench('--require-baseline', '--threshold', '1000')
+
+
+class MetricsTests(SimpleTestCase):
+    '''Spans must reach the Server-Timing header and /metrics must add up every worker.'''
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        settings_override = override_settings(METRICS_DIR=directory.name,
+            PLAYLIST_CACHE_ALIAS='default')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.directory = directory.name
+
+    def test_spans_are_reported(self):
+        self.client.cookies['access_token'] = 'token'
+        self.client.cookies['user_id'] = signed_user_id('metrics-user')
+
+        with FakeSpotify(playlist_count=3) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                response = self.client.get('/playlists', {'refresh': 1})
+
+        self.assertRegex(response['Server-Timing'],
+            r'^spotify_playlists;dur=[\d.]+, total;dur=[\d.]+$')
+
+        text = self.client.get('/metrics').content.decode()
+        self.assertIn('shuffler_spotify_requests_total{endpoint="/v1/me/playlists",status="200"}',
+            text)
+        self.assertIn('shuffler_phase_seconds_bucket{phase="spotify_playlists",le="+Inf"}', text)
+        self.assertIn('shuffler_http_request_seconds_count{method="GET",status="200",'
+            'view="playlists"}', text)
+
+    def test_workers_are_added_up(self):
+        metrics.inc('spotify_requests_total', endpoint='/test', status='200')
+        metrics.flush(force=True)
+        own = metrics.collect_all()[0][('spotify_requests_total',
+            (('endpoint', '/test'), ('status', '200')))]
+
+        # The test runner's parent stands in for a live worker; pid 999999999 is a dead one
+        other_worker = {'counters': [['spotify_requests_total',
+            [['endpoint', '/test'], ['status', '200']], 5]], 'histograms': []}
+        for pid in (os.getppid(), 999999999):
+            with open(os.path.join(self.directory, f'metrics-{pid}.json'), 'w',
+             encoding='utf-8') as file:
+                json.dump(other_worker, file)
+
+        self.assertIn(f'shuffler_spotify_requests_total{{endpoint="/test",status="200"}} {own + 5}',
+            metrics.render())
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'metrics-999999999.json')))
+
+
+class TraceTests(SimpleTestCase):
+    '''Sampled shuffles must be traced with the scores and ranks of their queue.'''
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, f'trace-{os.getpid()}.jsonl')
+
+        settings_override = override_settings(TRACE_DIR=directory.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        # Start with the listener stopped, and stop it again before the directory is removed
+        self.addCleanup(trace.flush)
+        trace.flush()
+
+    def shuffle(self, **kwargs):
+        playlists = [make_records(200), make_records(300)[200:]]
+        recency_index = {playlists[0][0].uri: 1, playlists[1][0].uri: 2}
+        queue = Shuffler.shuffle_multiple_playlists(playlists, [], queue_limit=30,
+            no_double_artist=True, recency_index=recency_index, **kwargs)
+        trace.flush()
+        return queue
+
+    def test_sampled_shuffle_is_traced(self):
+        with override_settings(TRACE_SAMPLE_RATE=1):
+            queue = self.shuffle()
+
+        with open(self.path, encoding='utf-8') as file:
+            records = [json.loads(line) for line in file]
+
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['event'], 'shuffle')
+        self.assertEqual(records[0]['playlist_sizes'], [200, 100])
+        self.assertEqual(records[0]['recency_index_size'], 2)
+
+        fields = records[0]['track_fields']
+        tracks = [dict(zip(fields, track)) for track in records[0]['tracks']]
+        self.assertEqual([track['uri'] for track in tracks], [track.uri for track in queue])
+        for track in tracks:
+            self.assertLessEqual(track['score'], 1000)
+            if track['uri'] == 'spotify:track:0':
+                self.assertEqual(track['recency_rank'], 1)
+
+    def test_unsampled_shuffle_is_not_traced(self):
+        with override_settings(TRACE_SAMPLE_RATE=0):
+            self.shuffle()
+        self.assertFalse(os.path.exists(self.path))
+
+        with override_settings(TRACE_SAMPLE_RATE=0):
+            self.shuffle(debug=True)
+        self.assertTrue(os.path.exists(self.path))
+
+
+@override_settings(PLAN_CACHE_ALIAS='default', JOB_CACHE_ALIAS='default',
+    TRACK_CACHE_ALIAS='default', PLAYLIST_CACHE_ALIAS='default')
+class ShufflePlanTests(TestCase):
+    '''Later queue jobs must continue the stored plan until a playlist changes.'''
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def queue(self, fake, snapshots, queue_limit=20):
+        job = jobs.Job('plan-test')
+        with override_settings(SPOTIFY_API_URL=fake.url):
+            queue_job(job, 'token', fake.playlist_ids(), snapshots, queue_limit, user_id='user')
+        return job
+
+    def test_batches_continue_without_refetching(self):
+        with FakeSpotify(playlist_count=2, playlist_size=150) as fake:
+            snapshots = [f'{playlist_id}-snapshot' for playlist_id in fake.playlist_ids()]
+            self.assertEqual(self.queue(fake, snapshots).message, 'Success!')
+
+            requests_before = fake.request_count
+            self.assertEqual(self.queue(fake, snapshots).message, 'Success!')
+            # Only the playlist list, for the snapshots, and the 20 add-to-queue requests
+            self.assertEqual(fake.request_count - requests_before, 1 + 20)
+
+        plan = ShufflePlan.get('user', fake.playlist_ids(), snapshots)
+        self.assertEqual(fake.queued, [track.uri for track in plan.tracks[:40]])
+        self.assertEqual(plan.cursor, 40)
+        self.assertEqual(len(set(fake.queued)), 40)
+
+    def test_edited_playlist_drops_plan(self):
+        with FakeSpotify(playlist_count=2, playlist_size=150) as fake:
+            # The select page keeps sending the snapshots it loaded before the edit
+            snapshots = [f'{playlist_id}-snapshot' for playlist_id in fake.playlist_ids()]
+            self.queue(fake, snapshots)
+            fake.edit('fake1')
+
+            requests_before = fake.request_count
+            self.assertEqual(self.queue(fake, snapshots).message, 'Success!')
+            # The list, the edited playlist's 2 pages and the 20 add-to-queue requests
+            self.assertEqual(fake.request_count - requests_before, 1 + 2 + 20)
+
+        # A new plan from the first 20 songs, built from the edited snapshot
+        plan = ShufflePlan.get('user', fake.playlist_ids(), ['fake0-snapshot', 'fake1-snapshot-1'])
+        self.assertEqual(plan.cursor, 20)
+
+    def test_changed_snapshot_drops_plan(self):
+        playlist_ids = ['a', 'b']
+        ShufflePlan.create('user', playlist_ids, ['a1', 'b1'], make_records(10))
+
+        self.assertIsNotNone(ShufflePlan.get('user', ['b', 'a'], ['b1', 'a1']))
+        self.assertIsNone(ShufflePlan.get('user', playlist_ids, ['a1', 'b2']))
+        self.assertIsNone(ShufflePlan.get('user', playlist_ids, ['a1', 'b1']))
+
+    def test_concurrent_jobs_claim_different_batches(self):
+        # The file based cache the plans are kept in, whose incr is not atomic
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        plans_cache = dict(settings.CACHES['plans'], LOCATION=directory.name)
+
+        with override_settings(CACHES=dict(settings.CACHES, plans=plans_cache),
+         PLAN_CACHE_ALIAS='plans', PLAN_LOCK_FILE=os.path.join(directory.name, 'lock')):
+            ShufflePlan.create('user', ['a'], ['a1'], make_records(200))
+
+            def claim(_):
+                return ShufflePlan.get('user', ['a'], ['a1']).claim(20)
+
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                batches = list(executor.map(claim, range(12)))
+
+        claimed = [track.uri for batch in batches for track in batch]
+        self.assertEqual(len(claimed), 200)
+        self.assertEqual(len(set(claimed)), 200)
+
+    def test_claiming_leaves_the_songs_alone(self):
+        plan = ShufflePlan.create('user', ['a'], ['a1'], make_records(50), claimed=20)
+
+        with mock.patch.object(caches['default'], 'set') as cache_set:
+            self.assertEqual(plan.claim(20), make_records(50)[20:40])
+        self.assertEqual([call.args[0] for call in cache_set.call_args_list],
+            [f'{plan.key}:cursor'])
+
+    def test_claim_stops_at_the_end(self):
+        plan = ShufflePlan.create('user', ['a'], ['a1'], make_records(50), claimed=40)
+
+        self.assertEqual(plan.claim(20), make_records(50)[40:])
+        self.assertEqual(plan.claim(20), [])
+        self.assertEqual(ShufflePlan.get('user', ['a'], ['a1']).cursor, 50)
+
+    def test_short_batch_is_topped_up(self):
+        with FakeSpotify(playlist_count=1, playlist_size=30) as fake:
+            snapshots = [f'{playlist_id}-snapshot' for playlist_id in fake.playlist_ids()]
+            self.queue(fake, snapshots)
+            first_plan = ShufflePlan.get('user', fake.playlist_ids(), snapshots)
+            self.assertEqual(self.queue(fake, snapshots).message, 'Success!')
+
+        # The plan's last 10 songs and 10 more from the next plan, none of them twice
+        second_batch = fake.queued[20:]
+        self.assertEqual(len(second_batch), 20)
+        self.assertEqual(len(set(second_batch)), 20)
+        self.assertEqual(second_batch[:10], [track.uri for track in first_plan.tracks[20:]])
+
+        plan = ShufflePlan.get('user', fake.playlist_ids(), snapshots)
+        self.assertEqual(plan.cursor, 10)
+        self.assertEqual(second_batch[10:], [track.uri for track in plan.tracks[:10]])
+        self.assertCountEqual(plan.tracks, first_plan.tracks)
+
+    def test_lazy_order_matches_full_order(self):
+        playlists = [make_records(50), make_records(120)[50:]]
+        random.seed(4)
+        full = Shuffler.shuffle_multiple_playlists(playlists, [], queue_limit=None,
+            no_double_artist=True)
+        random.seed(4)
+        songs = Shuffler.iter_multiple_playlists(playlists, [], no_double_artist=True)
+
+        self.assertEqual(list(itertools.islice(songs, 20)) + list(songs), full)
+
+    def test_full_ordering(self):
+        playlists = [make_records(50), make_records(120)[50:]]
+        queue = Shuffler.shuffle_multiple_playlists(playlists, [], queue_limit=None,
+            no_double_artist=True)
+
+        self.assertCountEqual(queue, make_records(120))
+
+
+class SpaceOutTests(SimpleTestCase):
+    '''Each position must take the best track that breaks no rule, whatever the rules.'''
+
+    keys = [Shuffler.artist_key, Shuffler.album_key]
+
+    @staticmethod
+    def queue(*tracks):
+        '''ScoredSongs named after their artist and album, best first.'''
+
+        return [ScoredSong(TrackRecord(f'spotify:track:{idx}', f'{artist}{album}{idx}',
+            artist_name=artist, album_name=album), score=len(tracks) - idx)
+            for idx, (artist, album) in enumerate(tracks)]
+
+    @staticmethod
+    def reference(queue, keys, min_gap):
+        '''space_out's rule, checking every remaining track at every position.'''
+
+        remaining = list(queue)
+        spaced = []
+        while remaining:
+            def free_at(scored_song):
+                return max([idx + min_gap + 1 - len(spaced) for key in keys
+                    for idx in range(max(0, len(spaced) - min_gap), len(spaced))
+                    if key(spaced[idx]) == key(scored_song)] + [0])
+
+            best = min(range(len(remaining)), key=lambda idx: (free_at(remaining[idx]) > 0,
+                free_at(remaining[idx]), idx))
+            spaced.append(remaining.pop(best))
+        return spaced
+
+    def names(self, queue):
+        return [scored_song.song.name for scored_song in queue]
+
+    def test_blocked_album_does_not_hide_artist(self):
+        queue = self.queue(('B', 'X'), ('A', 'X'), ('A', 'Y'), ('C', 'Z'))
+
+        self.assertEqual(self.names(Shuffler.space_out(queue, self.keys)),
+            ['BX0', 'AY2', 'CZ3', 'AX1'])
+
+    def test_combined_rules_avoid_repeats(self):
+        queue = self.queue(('A', 'X'), ('B', 'X'), ('B', 'Y'), ('C', 'X'), ('C', 'Y'), ('B', 'Z'))
+        spaced = Shuffler.space_out(queue, self.keys)
+
+        for before, after in zip(spaced, spaced[1:]):
+            self.assertNotEqual(before.song.artist_name, after.song.artist_name)
+            self.assertNotEqual(before.song.album_name, after.song.album_name)
+
+    def test_min_gap(self):
+        queue = self.queue(('A', 'X'), ('A', 'X'), ('B', 'Y'), ('C', 'Z'), ('A', 'X'))
+
+        self.assertEqual(self.names(Shuffler.space_out(queue, [Shuffler.artist_key], min_gap=2)),
+            ['AX0', 'BY2', 'CZ3', 'AX1', 'AX4'])
+
+    def test_score_order_is_kept_without_conflicts(self):
+        queue = self.queue(('A', 'X'), ('B', 'Y'), ('C', 'Z'))
+        shuffled = [queue[2], queue[0], queue[1]]
+
+        self.assertEqual(Shuffler.space_out(queue, self.keys), queue)
+        self.assertEqual(list(Shuffler.iter_spaced(shuffled, self.keys, by_score=True)), queue)
+
+    def test_artist_with_many_albums(self):
+        # Every other track by one artist, each on an album of its own
+        queue = self.queue(*[('A', f'X{idx}') if idx % 2 else (f'B{idx % 7}', 'Y')
+            for idx in range(120)])
+
+        for min_gap in (1, 3):
+            self.assertEqual(self.names(Shuffler.space_out(queue, self.keys, min_gap=min_gap)),
+                self.names(self.reference(queue, self.keys, min_gap)))
+
+    def test_matches_the_rule_on_random_queues(self):
+        rng = random.Random(3)
+
+        for _ in range(2000):
+            tracks = [(rng.choice('ABC'), rng.choice('XYZ')) for _ in range(rng.randrange(2, 8))]
+            queue = self.queue(*tracks)
+            keys = rng.choice([self.keys, self.keys[:1], self.keys[1:]])
+            min_gap = rng.choice([1, 2])
+
+            self.assertEqual(self.names(Shuffler.space_out(queue, keys, min_gap=min_gap)),
+                self.names(self.reference(queue, keys, min_gap)), (tracks, min_gap))
+
+
+class LazySelectionTests(SimpleTestCase):
+    '''Selecting songs lazily must give the same songs as scoring, sorting and spacing
+    every playlist in full.'''
+
+    @staticmethod
+    def full_pass(song_list, recency_index, no_double_artist=False, no_double_album=False,
+        min_gap=1, rng=None):
+        '''iter_scored_playlist as it was before it went lazy, ordering every song at once
+        when the first one is taken, as the lazy version scores them.'''
+
+        queue = Shuffler.rank_playlist(song_list, recency_index, rng=rng)
+        yield from Shuffler.space_out(queue,
+            Shuffler.spacing_keys(no_double_artist, no_double_album), min_gap=min_gap)
+
+    def test_single_playlist_matches_full_pass(self):
+        song_list = make_playlist('lazy', 400)
+        recency_index = Shuffler.build_recency_index(song_list[:30])
+
+        for seed in range(5):
+            random.seed(seed)
+            lazy = list(Shuffler.iter_single_playlist(song_list, recency_index,
+                no_double_artist=True, no_double_album=True, min_gap=2))
+            random.seed(seed)
+            full = Shuffler.shuffle_single_playlist(song_list, [], recency_index=recency_index,
+                no_double_artist=True, no_double_album=True, min_gap=2)
+
+            self.assertEqual(lazy, full)
+
+    def test_multiple_playlists_match_full_pass(self):
+        playlists = [make_playlist(f'lazy{idx}', size) for idx, size in enumerate((300, 40, 150))]
+        recently_played = playlists[0][:20]
+
+        for seed in range(5):
+            for queue_limit in (20, None):
+                random.seed(seed)
+                lazy = Shuffler.shuffle_multiple_playlists(playlists, recently_played,
+                    queue_limit=queue_limit, no_double_artist=True)
+                random.seed(seed)
+                with mock.patch.object(Shuffler, 'iter_scored_playlist', self.full_pass):
+                    full = Shuffler.shuffle_multiple_playlists(playlists, recently_played,
+                        queue_limit=queue_limit, no_double_artist=True)
+
+                self.assertEqual(lazy, full)
+
+
+class DeduplicationTests(SimpleTestCase):
+    '''Songs shared by several playlists must be queued once without shortening the queue.'''
+
+    def test_overlapping_playlists_fill_the_queue(self):
+        records = make_records(100)
+        playlists = [records[:60], records[20:80], records[40:]]
+
+        for _ in range(20):
+            queue = Shuffler.shuffle_multiple_playlists(playlists, [], queue_limit=100,
+                no_double_artist=True)
+            self.assertCountEqual(queue, records)
+
+    def test_songs_keep_their_first_playlist(self):
+        records = make_records(10)
+        assigned = Shuffler.assign_sources([records[:6], records[3:] + records[:2]])
+
+        self.assertEqual(assigned, [records[:6], records[6:]])
+
+
+class WeightedInterleaveTests(SimpleTestCase):
+    '''Playlists must be drawn from in proportion to their weights.'''
+
+    def setUp(self):
+        random.seed(0)
+
+    def test_sampler_follows_weights(self):
+        sampler = WeightedSampler([1, 0, 3, 0, 4])
+        picks = Counter(sampler.pick() for _ in range(8000))
+
+        self.assertEqual(set(picks), {0, 2, 4})
+        for idx, weight in ((0, 1), (2, 3), (4, 4)):
+            self.assertAlmostEqual(picks[idx] / 8000, weight / 8, delta=0.02)
+
+        sampler.update(4, 0)
+        sampler.update(1, 2)
+        picks = Counter(sampler.pick() for _ in range(6000))
+        self.assertEqual(set(picks), {0, 1, 2})
+        self.assertAlmostEqual(picks[2] / 6000, 0.5, delta=0.02)
+
+        for idx in range(5):
+            sampler.update(idx, 0)
+        self.assertFalse(sampler)
+
+    def share_of_small_playlist(self, weights):
+        records = make_records(1000)
+        playlists = [records[:100], records[100:]]
+        small = {track.uri for track in playlists[0]}
+
+        taken = 0
+        for _ in range(50):
+            queue = Shuffler.shuffle_multiple_playlists(playlists, [], queue_limit=100,
+                weights=weights)
+            taken += sum(track.uri in small for track in queue)
+
+        return taken / 5000
+
+    def test_default_weights_follow_playlist_size(self):
+        self.assertAlmostEqual(self.share_of_small_playlist(None), 0.1, delta=0.02)
+
+    def test_custom_weights(self):
+        self.assertAlmostEqual(self.share_of_small_playlist([1, 1]), 0.5, delta=0.03)
+
+    def test_exhausted_playlists_are_skipped(self):
+        records = make_records(300)
+        queue = Shuffler.shuffle_multiple_playlists([records[:5], records[5:]], [],
+            queue_limit=None, weights=[100, 1])
+
+        self.assertCountEqual(queue, records)
+        self.assertLessEqual(set(records[:5]), set(queue[:10]))
+
+
+@override_settings(JOB_CACHE_ALIAS='default', PLAYLIST_CACHE_ALIAS='default')
+class AsyncPathTests(SimpleTestCase):
+    '''The async views must load and queue the same songs as the sync ones.'''
+
+    async def test_tracks_match_sync_path(self):
+        with FakeSpotify(playlist_count=3, playlist_size=250) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url):
+                expected = await sync_to_async(spotify_utils.get_tracks_from_playlists)(
+                    'token', fake.playlist_ids())
+                actual = await spotify_async.get_tracks_from_playlists('token',
+                    fake.playlist_ids())
+                await spotify_async.aclose()
+
+        self.assertEqual(actual, expected)
+
+    async def test_queue_job(self):
+        job = jobs.Job('async-test')
+
+        with FakeSpotify(playlist_count=2, playlist_size=150, throttle_every=7,
+         retry_after=0) as fake:
+            with override_settings(SPOTIFY_API_URL=fake.url, SPOTIFY_HTTP_BACKOFF=0.01):
+                await async_views.queue_job(job, 'token', fake.playlist_ids(), None, 12)
+                await spotify_async.aclose()
+
+        self.assertEqual(job.message, 'Success!')
+        self.assertEqual(job.tracks_queued, 12)
+        self.assertEqual(len(fake.queued), 12)
+        self.assertGreater(fake.throttled, 0)
+
+    async def test_blocking_calls_leave_the_loop(self):
+        loop_thread = threading.get_ident()
+        blocking_threads = []
+
+        def on_thread(func):
+            def wrapper(*args, **kwargs):
+                blocking_threads.append(threading.get_ident())
+                return func(*args, **kwargs)
+            return wrapper
+
+        cache = caches['default']
+        with mock.patch.object(cache, 'set', on_thread(cache.set)), \
+         mock.patch.object(ratelimit, '_state', on_thread(ratelimit._state)):
+            with FakeSpotify(playlist_count=2, playlist_size=150) as fake:
+                with override_settings(SPOTIFY_API_URL=fake.url):
+                    job = await jobs.submit_async(async_views.queue_job, 'token',
+                        fake.playlist_ids(), None, 12)
+                    await asyncio.gather(*jobs._tasks)
+                    await spotify_async.aclose()
+
+        self.assertGreater(len(blocking_threads), 0)
+        self.assertNotIn(loop_thread, blocking_threads)
+        self.assertEqual(len(fake.queued), 12)
+        self.assertEqual(jobs.Job.get(job.id).to_dict(), job.to_dict())
+
+    async def test_job_saves_are_coalesced(self):
+        job = jobs.AsyncJob('coalesce-test')
+        with mock.patch.object(caches['default'], 'set') as cache_set:
+            for tracks_fetched in range(100):
+                job.update(tracks_fetched=tracks_fetched)
+            await job.asave()
+
+        self.assertLessEqual(cache_set.call_count, 2)
+        self.assertEqual(cache_set.call_args.args[1]['tracks_fetched'], 99)
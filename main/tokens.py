@@ -0,0 +1,158 @@
+'''Users' access tokens, kept on the server and refreshed before they expire.
+
+callback stores the tokens of each login here along with the time the access token
+expires. They live in the settings.TOKEN_CACHE_ALIAS cache, shared by every worker,
+under a hash of the refresh token cookie, so a request only ever gets the tokens of the
+login it carries.
+
+get hands out an access token that stays valid for at least settings.TOKEN_MIN_TTL
+seconds. A token that expires within settings.TOKEN_REFRESH_MARGIN seconds is still
+handed out while a background thread refreshes it, so requests only wait for a refresh
+when a user comes back after their token has run out. Refreshes are single-flight. A
+process runs at most one refresh per login at a time, and a lock in the cache makes the
+other workers wait for its token instead of asking for their own.'''
+
+import base64
+import hashlib
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.core.cache import caches
+from . import spotify_utils
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.RLock()
+_refreshing = {}
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='token-refresh')
+
+
+class TokenError(Exception):
+    '''Raised when Spotify's token endpoint refuses a request.
+
+    status -- HTTP status of the response.'''
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def _key(refresh_token):
+    return 'token:' + hashlib.sha256(refresh_token.encode('utf-8')).hexdigest()
+
+def request_token(data):
+    '''POST data to Spotify's token endpoint with the app's credentials and return
+    the JSON response. Raises TokenError if the response is not a 200.'''
+
+    credentials = f'{os.getenv("CLIENT_ID")}:{os.getenv("CLIENT_SECRET")}'
+    auth_header = {'Authorization': 'Basic '
+        + base64.b64encode(credentials.encode('ascii')).decode('ascii')}
+
+    response = spotify_utils.get_session().post(f'{settings.SPOTIFY_ACCOUNTS_URL}api/token',
+        data=data, headers=auth_header, timeout=settings.SPOTIFY_HTTP_TIMEOUT)
+    if response.status_code != 200:
+        raise TokenError(f'Token request failed with HTTP {response.status_code}.',
+            response.status_code)
+
+    return response.json()
+
+def store(refresh_token, token_response, current_refresh_token=None):
+    '''Store a response of the token endpoint for the login whose cookie holds
+    refresh_token, and return its access token.
+
+    current_refresh_token -- refresh token to use next if the response has none,
+     when Spotify has sent a new one since the cookie was set. (default: refresh_token)'''
+
+    entry = {
+        'access_token': token_response['access_token'],
+        # Spotify may send a new refresh token; the cookie's keeps naming the login
+        'refresh_token': token_response.get('refresh_token') or current_refresh_token
+            or refresh_token,
+        'expires_at': time.time() + int(token_response.get('expires_in', 3600)),
+    }
+    caches[settings.TOKEN_CACHE_ALIAS].set(_key(refresh_token), entry, settings.TOKEN_TIMEOUT)
+
+    return entry['access_token']
+
+def get(refresh_token):
+    '''Return an access token for the login whose cookie holds refresh_token, valid for
+    at least settings.TOKEN_MIN_TTL seconds.
+
+    Returns None if no tokens are stored for the login or they could not be refreshed.'''
+
+    entry = caches[settings.TOKEN_CACHE_ALIAS].get(_key(refresh_token))
+    if entry is None:
+        return None
+
+    remaining = entry['expires_at'] - time.time()
+    if remaining > settings.TOKEN_REFRESH_MARGIN:
+        return entry['access_token']
+
+    future = refresh(refresh_token)
+    if remaining > settings.TOKEN_MIN_TTL:
+        return entry['access_token']
+
+    try:
+        return future.result(timeout=settings.SPOTIFY_HTTP_TIMEOUT * 2)
+    except Exception: # pylint: disable=broad-except
+        logger.warning('Could not refresh an access token', exc_info=True)
+        return None
+
+def refresh(refresh_token):
+    '''Start refreshing the login's access token on a background thread, unless this
+    process is refreshing it already. Returns a Future of the new access token.'''
+
+    key = _key(refresh_token)
+
+    with _lock:
+        future = _refreshing.get(key)
+        if future is None:
+            future = _refreshing[key] = _executor.submit(_refresh, refresh_token)
+            future.add_done_callback(lambda _: _forget(key, future))
+
+    return future
+
+def _forget(key, future):
+    with _lock:
+        if _refreshing.get(key) is future:
+            del _refreshing[key]
+
+def _fresh(entry):
+    return entry is not None and entry['expires_at'] - time.time() > settings.TOKEN_REFRESH_MARGIN
+
+def _refresh(refresh_token):
+    cache = caches[settings.TOKEN_CACHE_ALIAS]
+    key = _key(refresh_token)
+    lock_key = f'{key}:refreshing'
+    deadline = time.monotonic() + settings.SPOTIFY_HTTP_TIMEOUT
+
+    # Wait for another worker's refresh rather than starting a second one
+    while not cache.add(lock_key, os.getpid(), settings.SPOTIFY_HTTP_TIMEOUT):
+        entry = cache.get(key)
+        if _fresh(entry):
+            return entry['access_token']
+        if time.monotonic() > deadline:
+            break
+        time.sleep(0.05)
+
+    try:
+        # The other worker may have finished just before the lock was taken
+        entry = cache.get(key)
+        if entry is None or _fresh(entry):
+            return entry and entry['access_token']
+
+        try:
+            token_response = request_token({'grant_type': 'refresh_token',
+                'refresh_token': entry['refresh_token']})
+        except TokenError as error:
+            # A refresh token Spotify refuses won't work later either
+            if error.status in (400, 401):
+                cache.delete(key)
+            raise
+
+        return store(refresh_token, token_response, entry['refresh_token'])
+    finally:
+        cache.delete(lock_key)
@@ -0,0 +1,101 @@
+'''Structured trace records of shuffles, written off the request path.
+
+Records are handed to a logging.handlers.QueueHandler, so emitting one only appends it
+to an in-memory queue. A QueueListener thread in each process turns them into compact
+JSON lines in its own rotating file, settings.TRACE_DIR/trace-<pid>.jsonl, so workers
+never contend for a file. Only a settings.TRACE_SAMPLE_RATE fraction of shuffles is
+traced unless tracing is forced.'''
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+logger.propagate = False
+logger.setLevel(logging.INFO)
+
+_lock = threading.Lock()
+_listener = None
+_handler = None
+_pid = None
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    '''QueueHandler that enqueues records as they are.
+
+    The listener runs in the same process, so the formatting and copying the base class
+    does to make records picklable would only slow the caller down.'''
+
+    def prepare(self, record):
+        return record
+
+
+class JSONLinesFormatter(logging.Formatter):
+    '''Formats a trace record as one line of JSON.'''
+
+    def format(self, record):
+        fields = {'ts': round(record.created, 3), 'event': record.msg, 'pid': record.process}
+        fields.update(getattr(record, 'trace', {}))
+
+        return json.dumps(fields, separators=(',', ':'), default=str)
+
+
+def _start():
+    '''Start this process's listener, again after a fork since threads don't survive one.'''
+
+    global _listener, _handler, _pid
+
+    with _lock:
+        if _pid == os.getpid():
+            return
+
+        os.makedirs(settings.TRACE_DIR, exist_ok=True)
+        file_handler = logging.handlers.RotatingFileHandler(
+            os.path.join(settings.TRACE_DIR, f'trace-{os.getpid()}.jsonl'),
+            maxBytes=settings.TRACE_MAX_BYTES, backupCount=settings.TRACE_BACKUP_COUNT,
+            encoding='utf-8', delay=True)
+        file_handler.setFormatter(JSONLinesFormatter())
+
+        records = queue.SimpleQueue()
+        if _handler is not None:
+            logger.removeHandler(_handler)
+        _handler = _QueueHandler(records)
+        logger.addHandler(_handler)
+
+        _listener = logging.handlers.QueueListener(records, file_handler)
+        _listener.start()
+        _pid = os.getpid()
+
+def sampled():
+    '''Decide whether to trace a shuffle, with probability settings.TRACE_SAMPLE_RATE.'''
+
+    rate = settings.TRACE_SAMPLE_RATE
+    return rate > 0 and (rate >= 1 or random.random() < rate)
+
+def emit(event, **fields):
+    '''Queue a trace record with the given event name and fields.'''
+
+    if _pid != os.getpid():
+        _start()
+
+    logger.info(event, extra={'trace': fields})
+
+def flush():
+    '''Write out every queued record and stop the listener until the next emit.'''
+
+    global _pid
+
+    with _lock:
+        if _listener is not None and _pid == os.getpid():
+            _listener.stop()
+            for handler in _listener.handlers:
+                handler.close()
+        _pid = None
+
+atexit.register(flush)
@@ -0,0 +1,98 @@
+'''Server-side cache of playlist tracks keyed by playlist snapshot.
+
+Spotify gives every version of a playlist a new snapshot_id, so the tracks stored for a
+(playlist_id, snapshot_id) pair never go stale. Entries live in the Django cache named by
+settings.TRACK_CACHE_ALIAS, which is file based by default so every gunicorn worker on
+the machine shares it. Least recently used entries are evicted once their pickled size
+passes settings.TRACK_CACHE_MAX_BYTES.'''
+
+import pickle
+from django.conf import settings
+from django.core.cache import caches
+
+INDEX_KEY = 'tracks:index'
+HITS_KEY = 'tracks:hits'
+MISSES_KEY = 'tracks:misses'
+
+
+def _cache():
+    return caches[settings.TRACK_CACHE_ALIAS]
+
+def _key(playlist_id, snapshot_id):
+    return f'tracks:{playlist_id}:{snapshot_id}'
+
+def _count(key):
+    cache = _cache()
+    cache.add(key, 0, timeout=None)
+    try:
+        cache.incr(key)
+    except ValueError:
+        # Evicted between add and incr
+        cache.set(key, 1, timeout=None)
+
+def get(playlist_id, snapshot_id):
+    '''Return the cached tracks of a playlist snapshot, or None if they are not cached.'''
+
+    cache = _cache()
+    key = _key(playlist_id, snapshot_id)
+    tracks = cache.get(key)
+
+    if tracks is None:
+        _count(MISSES_KEY)
+        return None
+
+    _count(HITS_KEY)
+
+    # Move the entry to the most recently used end of the index
+    index = cache.get(INDEX_KEY) or {}
+    if key in index:
+        index[key] = index.pop(key)
+        cache.set(INDEX_KEY, index, timeout=None)
+
+    return tracks
+
+def store(playlist_id, snapshot_id, tracks):
+    '''Cache the tracks of a playlist snapshot, evicting least recently used entries
+     until the cache fits in settings.TRACK_CACHE_MAX_BYTES.
+
+    The index used for eviction is shared by all workers and updated last-writer-wins,
+    so entries that drop out of it under contention still expire after the cache TIMEOUT.'''
+
+    max_bytes = settings.TRACK_CACHE_MAX_BYTES
+    size = len(pickle.dumps(tracks, pickle.HIGHEST_PROTOCOL))
+    if size > max_bytes:
+        return
+
+    cache = _cache()
+    key = _key(playlist_id, snapshot_id)
+    cache.set(key, tracks)
+
+    index = cache.get(INDEX_KEY) or {}
+    index.pop(key, None)
+    index[key] = size
+
+    total = sum(index.values())
+    while total > max_bytes:
+        oldest = next(iter(index))
+        total -= index.pop(oldest)
+        cache.delete(oldest)
+
+    cache.set(INDEX_KEY, index, timeout=None)
+
+def stats():
+    '''Return hit and miss counters along with the number and total size of cached entries.'''
+
+    cache = _cache()
+    index = cache.get(INDEX_KEY) or {}
+
+    return {
+        'hits': cache.get(HITS_KEY, 0),
+        'misses': cache.get(MISSES_KEY, 0),
+        'entries': len(index),
+        'bytes': sum(index.values()),
+    }
+
+def clear():
+    '''Remove every cached playlist and reset the counters.'''
+
+    _cache().clear()
@@ -0,0 +1,66 @@
+'''Compact track records passed between the Spotify helpers and the Shuffler.'''
+
+
+class TrackRecord:
+    '''The few fields of a Spotify track this app uses.
+
+    Playlist items from the API carry market lists, images and full album objects that are
+    never read. Records are built from each page as it is parsed so that only these fields
+    stay alive for the rest of the request.'''
+
+    __slots__ = ('uri', 'name', 'artist_id', 'artist_name', 'album_id', 'album_name',
+        'duration_ms')
+
+    def __init__(self, uri, name=None, artist_id=None, artist_name=None, album_id=None,
+     album_name=None, duration_ms=None):
+        self.uri = uri
+        self.name = name
+        self.artist_id = artist_id
+        self.artist_name = artist_name
+        self.album_id = album_id
+        self.album_name = album_name
+        self.duration_ms = duration_ms
+
+    @classmethod
+    def from_item(cls, item):
+        '''Build a record from a playlist item, saved track or play history object,
+         or from a bare track object.
+
+        Returns None for items without a playable track, e.g. tracks that were removed
+        from Spotify.'''
+
+        track = item.get('track') if 'track' in item else item
+        if not track or not track.get('uri'):
+            return None
+
+        artists = track.get('artists') or [{}]
+        album = track.get('album') or {}
+
+        return cls(track['uri'], track.get('name'), artists[0].get('id'), artists[0].get('name'),
+            album.get('id'), album.get('name'), track.get('duration_ms'))
+
+    @classmethod
+    def coerce(cls, track):
+        '''Return track as a record, converting Spotify API objects with from_item.'''
+
+        if isinstance(track, cls):
+            return track
+
+        return cls.from_item(track)
+
+    @classmethod
+    def from_items(cls, items):
+        '''Convert a page of Spotify API objects, dropping those without a playable track.'''
+
+        return [record for record in map(cls.coerce, items) if record is not None]
+
+    def __eq__(self, other):
+        if not isinstance(other, TrackRecord):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field) for field in self.__slots__)
+
+    def __hash__(self):
+        return hash(self.uri)
+
+    def __repr__(self):
+        return f'TrackRecord({self.uri!r}, {self.name!r}, artist={self.artist_name!r})'
@@ -1,11 +1,20 @@
+from django.conf import settings
 from django.urls import path
 from . import views
 
+if settings.ASYNC_VIEWS:
+    from . import async_views as upstream_views
+else:
+    upstream_views = views
+
 urlpatterns = [
     path("", views.index, name="index"),
     path("login", views.login_request, name="login"),
     path("callback", views.callback, name="callback"),
-    path("select", views.select, name="select"),
+    path("select", upstream_views.select, name="select"),
+    path("playlists", upstream_views.playlists, name="playlists"),
     path("refresh_token", views.refresh_token_request, name="refresh_token_request"),
-    path("queue", views.queue, name="queue"),
+    path("queue", upstream_views.queue, name="queue"),
+    path("queue/status/<str:job_id>", views.queue_status, name="queue_status"),
+    path("metrics", views.metrics_view, name="metrics"),
 ]
@@ -1,17 +1,30 @@
 '''Defines what is returned when the endpoints defined in urls.py are accessed.'''
 
+import logging
 import os
-import base64
+import math
+from django.conf import settings
 from django.shortcuts import render, redirect
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from dotenv import load_dotenv
-import requests
-import six
-import spotipy
 from . import spotify_utils
 from . import shuffler
+from . import jobs
+from . import metrics
+from . import history
+from . import playlist_cache
+from . import plans
+from . import tokens
+from .queue_dispatcher import QueueDispatchError
+from .ratelimit import SpotifyUnavailable
 
 load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Value the select page sends in selected_playlists for the user's Liked Songs
+LIKED_SONGS = "liked"
+
 # Create your views here.
 
 def index(request):
@@ -26,71 +39,65 @@ def login_request(request):
 
     client_id = os.getenv("CLIENT_ID")
     redirect_uri = os.getenv("REDIRECT_URI")
-    base_url = "https://accounts.spotify.com/authorize?response_type=code"
+    base_url = f"{settings.SPOTIFY_ACCOUNTS_URL}authorize?response_type=code"
 
     return redirect(
         f'{base_url}&client_id={client_id}&scope={url_scope}&redirect_uri={redirect_uri}')
 
 def callback(request):
-    '''Returns user to selection page after login and sets authentication and refresh cookies'''
+    '''Returns user to selection page after login and sets authentication and refresh cookies.
+    The tokens are also kept by tokens, which refreshes the access token before it expires.'''
 
     if not "code" in request.GET:
         return redirect('/')
 
     code = request.GET["code"]
-    client_id = os.getenv("CLIENT_ID")
-    client_secret = os.getenv("CLIENT_SECRET")
     redirect_uri = os.getenv("REDIRECT_URI")
 
-    auth_header = base64.b64encode(
-        six.text_type(client_id + ":" + client_secret).encode("ascii")
-    )
-    auth_header = {"Authorization": "Basic %s" % auth_header.decode("ascii")}
-
-    token_request = requests.post('https://accounts.spotify.com/api/token',
-        data = {'code':code, 'redirect_uri': redirect_uri, 'grant_type': 'authorization_code'},
-        headers=auth_header)
-
-    if token_request.status_code != 200:
+    try:
+        json = tokens.request_token({'code': code, 'redirect_uri': redirect_uri,
+            'grant_type': 'authorization_code'})
+    except tokens.TokenError:
         return redirect('/')
-
-    json = token_request.json()
+    except SpotifyUnavailable as error:
+        return HttpResponse(f"ERROR: {error}", status=503)
 
     access_token = json["access_token"]
     refresh_token = json["refresh_token"]
+    tokens.store(refresh_token, json)
 
     response = redirect('/select')
     response.set_cookie('access_token', access_token)
     response.set_cookie('refresh_token', refresh_token)
 
+    # Identifies the user's listening history; queuing still works without it. Signed so
+    # that a client can't claim another user's history
+    try:
+        response.set_signed_cookie('user_id', spotify_utils.get_user_id(access_token))
+    except:
+        pass
+
     return response
 
 def refresh_token_request(request):
-    '''Gets a new authentication token and sets the associated cookie to it.'''
+    '''Gets a new authentication token and sets the associated cookie to it.
+
+    Only needed when tokens has lost the login's tokens or Spotify rejected them.'''
 
     if "refresh_token" not in request.COOKIES:
         return redirect('/')
 
     refresh_token = request.COOKIES["refresh_token"]
-    client_id = os.getenv("CLIENT_ID")
-    client_secret = os.getenv("CLIENT_SECRET")
-
-    auth_header = base64.b64encode(
-        six.text_type(client_id + ":" + client_secret).encode("ascii")
-    )
-    auth_header = {"Authorization": "Basic %s" % auth_header.decode("ascii")}
-
-    refresh_request = requests.post('https://accounts.spotify.com/api/token',
-        data = {'grant_type' : 'refresh_token', "refresh_token": refresh_token},
-        headers=auth_header)
 
-
-    if refresh_request.status_code != 200:
+    try:
+        json = tokens.request_token({'grant_type': 'refresh_token',
+            'refresh_token': refresh_token})
+    except tokens.TokenError:
         return redirect('/')
+    except SpotifyUnavailable as error:
+        return HttpResponse(f"ERROR: {error}", status=503)
 
-    json = refresh_request.json()
-
-    access_token = json["access_token"]
+    access_token = tokens.store(refresh_token, json)
 
     response = redirect('/select')
     response.set_cookie('access_token', access_token)
@@ -98,28 +105,112 @@ def refresh_token_request(request):
     return response
 
 
+def get_access_token(request):
+    '''Returns the access token to use for a request, or None if it has none.
+
+    The one kept by tokens for the request's login is preferred, since it is refreshed
+    before it expires. The access_token cookie is used otherwise.'''
+
+    access_token = None
+    if "refresh_token" in request.COOKIES:
+        access_token = tokens.get(request.COOKIES["refresh_token"])
+
+    return access_token or request.COOKIES.get("access_token")
+
+
+def get_user_id(request):
+    '''Returns the Spotify id of the request's user, or None if it has none.
+
+    Only the signed cookie set by callback is trusted. A missing, unsigned or tampered
+    user_id cookie is treated like no cookie at all.'''
+
+    return request.get_signed_cookie("user_id", default=None)
+
+
 def select(request):
-    '''Returns select page with user's playlists loaded.
+    '''Returns select page. The playlists are loaded from /playlists by the page itself.
     Redirects to login page if access_token cookie is not set.'''
 
     if not "access_token" in request.COOKIES or not "refresh_token" in request.COOKIES:
         return redirect('/login')
 
-    access_token = request.COOKIES["access_token"]
+    response = render(request, "main/select.html", {})
+    return response
+
+
+def playlists(request):
+    '''Returns one page of the user's playlists as JSON, optionally filtered by name.
+
+    Accepts offset, limit (at most 200) and q, the text to filter names by, as GET
+    parameters, and refresh=1 to skip the playlist cache. Responds with status 401 if
+    the access token is missing or Spotify rejects it, see playlists_error.'''
+
+    access_token = get_access_token(request)
+    if access_token is None:
+        return JsonResponse({"message": "ERROR: Tokens not set."}, status=401)
 
-    playlists=[]
     try:
-        playlists = spotify_utils.get_playlists(access_token)
-    except:
-        return redirect('/refresh_token')
+        user_playlists = playlist_cache.get(access_token, get_user_id(request),
+            refresh=request.GET.get("refresh") == "1")
+    except Exception as error:
+        return playlists_error(error)
 
-    response = render(request, "main/select.html", {"playlists": playlists})
-    return response
+    return playlists_page(request, user_playlists)
+
+
+def playlists_error(error):
+    '''Responds to a playlists request that failed with error.
+
+    Only a token that Spotify rejected gets status 401, which sends the page to
+    /refresh_token. While Spotify is unavailable the page is asked to wait instead.'''
+
+    if isinstance(error, SpotifyUnavailable):
+        response = JsonResponse({"message": f"ERROR: {error}"}, status=503)
+        response["Retry-After"] = str(math.ceil(error.retry_after))
+        return response
+
+    # spotipy's SpotifyException has http_status, requests' and httpx's errors a response
+    status = getattr(error, "http_status", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+
+    if status == 401:
+        return JsonResponse({"message": "ERROR: Access token expired."}, status=401)
+
+    return JsonResponse({"message": "ERROR: Could not load playlists."}, status=502)
+
+
+def playlists_page(request, user_playlists):
+    '''Responds with the page of user_playlists asked for by a playlists request.'''
+
+    offset = request.GET.get("offset", "0")
+    limit = request.GET.get("limit", "50")
+
+    offset = int(offset) if offset.isnumeric() else 0
+    limit = min(int(limit), 200) if limit.isnumeric() and int(limit) > 0 else 50
+
+    return JsonResponse(playlist_cache.page(user_playlists, offset, limit, request.GET.get("q")))
 
 
 def queue(request):
     '''Accepts a POST request to the selected number of songs from the selected playlists.
-    Does nothing if the access or refresh tokenss are not set.'''
+    Does nothing if the access or refresh tokenss are not set.
+
+    The songs are fetched, shuffled and queued by a background job. Responds with the
+    job's id as JSON, to be polled at /queue/status/<id>.'''
+
+    job_args = queue_job_args(request)
+    if isinstance(job_args, HttpResponse):
+        return job_args
+
+    job = jobs.submit(queue_job, *job_args)
+
+    return JsonResponse({"job_id": job.id})
+
+
+def queue_job_args(request):
+    '''Reads the arguments of queue_job, after job, from a queue request.
+    Returns an error response instead if the request is incomplete.'''
 
     if not "access_token" in request.COOKIES or not "refresh_token" in request.COOKIES:
         return HttpResponse("ERROR: Tokens not set.")
@@ -128,33 +219,257 @@ def queue(request):
     if "selected_playlists[]" not in request.POST or "queue_limit" not in request.POST:
         return HttpResponse("ERROR: Selected playlists or queue limit not received.")
 
-    access_token = request.COOKIES["access_token"]
+    access_token = get_access_token(request)
     default_queue_limit = 20
     selected_playlists = request.POST.getlist("selected_playlists[]")
+    selected_snapshots = request.POST.getlist("selected_snapshots[]")
     queue_limit = request.POST["queue_limit"]
+    sampled = request.POST.get("sampled") == "true"
+    user_id = get_user_id(request)
 
     if queue_limit.isnumeric():
         queue_limit = int(queue_limit)
     else:
         queue_limit = default_queue_limit
 
-    playlists_tracks = []
+    # Without a snapshot for every playlist the track cache can't be used. The job
+    # replaces them with the current ones, see current_snapshots.
+    if len(selected_snapshots) != len(selected_playlists):
+        selected_snapshots = None
+
+    liked = LIKED_SONGS in selected_playlists
+    if liked:
+        idx = selected_playlists.index(LIKED_SONGS)
+        del selected_playlists[idx]
+        if selected_snapshots is not None:
+            del selected_snapshots[idx]
+
+    return (access_token, selected_playlists, selected_snapshots, queue_limit, sampled,
+        user_id, liked)
+
+
+def current_snapshots(access_token, user_id, playlist_ids):
+    '''Returns the snapshot ids of the playlists, read from Spotify along with the rest
+    of the user's playlists, which are stored in the playlist cache.
+
+    Returns None if one of them is not among the user's playlists or the playlists could
+    not be loaded. Snapshot ids sent by the select page are never used instead, since
+    they key the shared track cache and the user's plans but may be out of date, or be
+    those of another user's private playlist.'''
 
     try:
-        for playlist_id in selected_playlists:
-            tracks = spotify_utils.get_tracks_from_playlist(access_token, playlist_id)
-            playlists_tracks.append(tracks)
+        user_playlists = playlist_cache.get(access_token, user_id, refresh=True)
+    except Exception:
+        return None
+
+    return playlist_snapshots(user_playlists, playlist_ids)
+
+
+def playlist_snapshots(user_playlists, playlist_ids):
+    '''Returns the snapshot ids of the playlists with the given ids among user_playlists,
+    or None if one of them is missing.'''
+
+    snapshots = {playlist['id']: playlist['snapshot_id'] for playlist in user_playlists}
+    if not all(snapshots.get(playlist_id) for playlist_id in playlist_ids):
+        return None
+
+    return [snapshots[playlist_id] for playlist_id in playlist_ids]
+
+
+def queue_job(job, access_token, selected_playlists, selected_snapshots, queue_limit,
+    sampled=False, user_id=None, liked=False):
+    '''Fetches, shuffles and queues songs for the queue view, reporting progress on job.
+
+    If sampled is set, only a random sample of settings.SAMPLE_POOL_FACTOR times
+    queue_limit songs is fetched and shuffled instead of every song of the playlists.
+
+    Unless selected_snapshots is None, in which case every song is fetched, the playlists
+    are looked up in the user's playlists first and their current snapshot ids are used
+    instead of the ones given, see current_snapshots.
+
+    If liked is set, the user's Liked Songs are shuffled along with the playlists.
+    The library is streamed into a random sample of settings.SAMPLE_POOL_FACTOR times
+    queue_limit songs, however large it is.
+
+    If user_id is set, songs are scored against the user's stored listening history,
+    which is synced first, instead of only their last 50 plays. The first batch is
+    queued as soon as it is shuffled, and the rest of the selection is then ordered into
+    a plan. Later jobs for the same playlists claim the plan's next songs without fetching
+    or shuffling again until a playlist changes. When a plan runs out, its last songs are
+    topped up from a fresh shuffle, which becomes the next plan. Selections with Liked
+    Songs, which has no snapshot, are never planned.'''
+
+    if selected_snapshots is not None:
+        selected_snapshots = current_snapshots(access_token, user_id, selected_playlists)
+
+    remaining_songs = None
+    if user_id and selected_snapshots is not None and not sampled and not liked:
+        plan = plans.ShufflePlan.get(user_id, selected_playlists, selected_snapshots)
+        shuffled_queue = plan.claim(queue_limit) if plan is not None else []
+
+        if len(shuffled_queue) < queue_limit:
+            remaining_songs = shuffle_tracks(job, access_token, selected_playlists,
+                selected_snapshots, None, user_id=user_id)
+            if remaining_songs is None:
+                return
+            fresh_songs, passed_over = take_songs(remaining_songs,
+                queue_limit - len(shuffled_queue), shuffled_queue)
+            shuffled_queue += fresh_songs
+    else:
+        shuffled_queue = shuffle_tracks(job, access_token, selected_playlists,
+            selected_snapshots, queue_limit, sampled=sampled, user_id=user_id, liked=liked)
+        if shuffled_queue is None:
+            return
+
+    job.update(phase="queuing")
+
+    try:
+        spotify_utils.queue_tracks(access_token, shuffled_queue,
+            progress=lambda tracks_queued: job.update(tracks_queued=tracks_queued))
+        job.finish("Success!")
+    except QueueDispatchError as error:
+        job.finish(queue_error_message(error, len(shuffled_queue)), error=True)
+
+    # Ordering the rest of the selection waits until the user has their songs
+    if remaining_songs is not None:
+        plans.ShufflePlan.create(user_id, selected_playlists, selected_snapshots,
+            fresh_songs + list(remaining_songs) + passed_over, claimed=len(fresh_songs))
+
+
+def take_songs(songs, count, queued=()):
+    '''Take the next count songs from the iterator songs, passing over those in queued.
+
+    Returns the songs taken and the songs passed over. The rest of songs is left for
+    the caller.'''
+
+    queued_uris = {track.uri for track in queued}
+    taken = []
+    passed_over = []
+    for song in songs:
+        (passed_over if song.uri in queued_uris else taken).append(song)
+        if len(taken) == count:
+            break
+
+    return taken, passed_over
+
+
+def queue_error_message(error, song_count):
+    '''Message shown to the user when a QueueDispatchError stopped song_count songs
+    from all being queued.'''
+
+    if error.status == 404:
+        message = "ERROR: Please make sure a device is actively playing."
+    elif error.status == 429:
+        message = "ERROR: Spotify is busy, please try again in a minute."
+    else:
+        message = f"ERROR: Could not queue songs ({error})."
+
+    if error.queued:
+        message += f" {error.queued} of {song_count} songs were queued."
+
+    return message
+
+
+def shuffle_tracks(job, access_token, selected_playlists, selected_snapshots, queue_limit,
+    sampled=False, user_id=None, liked=False):
+    '''Fetches and shuffles songs for queue_job, reporting progress on job.
+
+    Returns queue_limit shuffled songs, or an iterator over all of them that orders
+    them as they are taken if queue_limit is None.
+    Returns None after marking the job as failed if the playlists could not be loaded.'''
+
+    job.update(phase="fetching")
+
+    def progress(tracks_fetched):
+        job.update(tracks_fetched=tracks_fetched)
+
+    weights = None
+
+    try:
+        if sampled:
+            playlists_tracks = spotify_utils.sample_tracks_from_playlists(access_token,
+                selected_playlists, queue_limit * settings.SAMPLE_POOL_FACTOR,
+                snapshot_ids=selected_snapshots, progress=progress)
+        else:
+            playlists_tracks = spotify_utils.get_tracks_from_playlists(access_token,
+                selected_playlists, snapshot_ids=selected_snapshots, progress=progress)
+
+        if liked:
+            tracks_fetched = sum(len(tracks) for tracks in playlists_tracks)
+            saved_tracks, saved_total = spotify_utils.sample_saved_tracks(access_token,
+                queue_limit * settings.SAMPLE_POOL_FACTOR,
+                progress=lambda count: progress(tracks_fetched + count))
+            weights = liked_weights(playlists_tracks, saved_total, sampled)
+            playlists_tracks.append(saved_tracks)
+    except SpotifyUnavailable as error:
+        job.finish(f"ERROR: {error}", error=True)
+        return None
     except:
-        return HttpResponse("ERROR: Could not load playlists.")
+        job.finish("ERROR: Could not load playlists.", error=True)
+        return None
+
+    recent_tracks = []
+    recency_index = None
+    if user_id:
+        with metrics.span("history_sync"):
+            recency_index = synced_recency_index(access_token, user_id)
+    else:
+        recent_tracks = spotify_utils.get_recently_played(access_token)
+
+    job.update(phase="shuffling")
+
+    rng = None
+    if settings.SHUFFLE_BACKEND == 'numpy':
+        rng = shuffler.Shuffler.numpy_rng()
 
-    recent_tracks = spotify_utils.get_recently_played(access_token)
+    if queue_limit is None:
+        return shuffler.Shuffler.iter_multiple_playlists(playlists_tracks, recent_tracks,
+            no_double_artist=True, rng=rng, recency_index=recency_index, weights=weights)
 
-    shuffled_queue = shuffler.Shuffler.shuffle_multiple_playlists(
+    return shuffler.Shuffler.shuffle_multiple_playlists(
         playlists_tracks, recent_tracks, queue_limit=queue_limit,
-        no_double_artist=True)
+        no_double_artist=True, rng=rng, recency_index=recency_index, weights=weights)
+
+
+def synced_recency_index(access_token, user_id):
+    '''Syncs the user's listening history and returns its recency index.
+
+    The sync only adds the latest plays, so if Spotify refuses it or is unavailable the
+    index is built from the plays stored so far rather than failing the job.'''
 
     try:
-        spotify_utils.queue_tracks(access_token, shuffled_queue)
-        return HttpResponse("Success!")
-    except spotipy.exceptions.SpotifyException:
-        return HttpResponse("ERROR: Please make sure a device is actively playing.")
+        history.sync(access_token, user_id)
+    except Exception: # pylint: disable=broad-except
+        logger.warning('Could not sync the listening history', exc_info=True)
+
+    return history.recency_index(user_id)
+
+
+def liked_weights(playlists_tracks, saved_total, sampled):
+    '''Interleaving weights for playlists_tracks followed by a sample of Liked Songs.
+
+    Only a sample of the library is loaded, so next to fully loaded playlists it is
+    weighed by the size of the whole library. Next to sampled playlists it is weighed
+    like one more of them, by the size of its sample, which is the default.'''
+
+    if sampled:
+        return None
+
+    return [len(tracks) for tracks in playlists_tracks] + [saved_total]
+
+
+def queue_status(request, job_id):
+    '''Returns the progress of a queue job as JSON.'''
+
+    job = jobs.Job.get(job_id)
+
+    if job is None:
+        return JsonResponse({"message": "ERROR: Unknown job."}, status=404)
+
+    return JsonResponse(job.to_dict())
+
+
+def metrics_view(request):
+    '''Returns phase latencies and Spotify call counts of every worker for Prometheus.'''
+
+    return HttpResponse(metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
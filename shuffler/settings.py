@@ -12,6 +12,7 @@ https://docs.djangoproject.com/en/4.0/ref/settings/
 
 from pathlib import Path
 import os
+import tempfile
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -48,6 +49,7 @@ INSTALLED_APPS = [
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
+    'main.metrics.ServerTimingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -83,11 +85,99 @@ WSGI_APPLICATION = 'shuffler.wsgi.application'
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'NAME': os.getenv('DATABASE_PATH', BASE_DIR / 'db.sqlite3'),
     }
 }
 
 
+# Cache
+# https://docs.djangoproject.com/en/4.0/topics/cache/
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    # Shared by every worker on the machine. Eviction is handled by main/track_cache.py,
+    # so MAX_ENTRIES is only a backstop.
+    'tracks': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('TRACK_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'shuffler-tracks')),
+        'TIMEOUT': 60 * 60 * 24 * 7,
+        'OPTIONS': {'MAX_ENTRIES': 100000},
+    },
+    'jobs': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('JOB_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'shuffler-jobs')),
+    },
+    'playlists': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('PLAYLIST_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'shuffler-playlists')),
+    },
+    'plans': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('PLAN_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'shuffler-plans')),
+    },
+    'tokens': {
+        'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+        'LOCATION': os.getenv('TOKEN_CACHE_DIR',
+            os.path.join(tempfile.gettempdir(), 'shuffler-tokens')),
+    },
+}
+
+TRACK_CACHE_ALIAS = 'tracks'
+TRACK_CACHE_MAX_BYTES = int(os.getenv('TRACK_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+# Each user's playlist list (see main/playlist_cache.py) is refetched after this many seconds
+PLAYLIST_CACHE_ALIAS = 'playlists'
+PLAYLIST_CACHE_TIMEOUT = int(os.getenv('PLAYLIST_CACHE_TIMEOUT', '300'))
+
+# Shuffle plans (see main/plans.py) are continued by later queue requests for this many seconds
+PLAN_CACHE_ALIAS = 'plans'
+PLAN_TIMEOUT = int(os.getenv('PLAN_TIMEOUT', str(60 * 60 * 24)))
+# Locked while a plan's next batch is claimed, by every worker on the machine
+PLAN_LOCK_FILE = os.getenv('PLAN_LOCK_FILE',
+    os.path.join(tempfile.gettempdir(), 'shuffler-plans.lock'))
+
+# Access tokens kept on the server by main/tokens.py. Tokens that expire within
+# TOKEN_REFRESH_MARGIN seconds are refreshed in the background, and requests only wait
+# for a refresh when less than TOKEN_MIN_TTL seconds are left. A login's tokens are
+# forgotten after TOKEN_TIMEOUT seconds without a refresh.
+TOKEN_CACHE_ALIAS = 'tokens'
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_MIN_TTL = int(os.getenv('TOKEN_MIN_TTL', '30'))
+TOKEN_TIMEOUT = int(os.getenv('TOKEN_TIMEOUT', str(60 * 60 * 24 * 30)))
+
+
+# Background jobs (see main/jobs.py)
+
+JOB_BACKEND = os.getenv('JOB_BACKEND', 'main.jobs.LocalBackend')
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_CACHE_ALIAS = 'jobs'
+# Seconds a finished job's status stays available
+JOB_TIMEOUT = 60 * 60
+
+
+# Metrics (see main/metrics.py). Every worker writes its registry to METRICS_DIR at most
+# every METRICS_FLUSH_INTERVAL seconds for /metrics to add up.
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'shuffler-metrics'))
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+
+
+# Shuffle traces (see main/trace.py). Each worker writes JSON lines to its own rotating
+# file in TRACE_DIR. TRACE_SAMPLE_RATE is the fraction of shuffles traced; 0 turns
+# tracing off except for shuffles run with debug=True.
+
+TRACE_DIR = os.getenv('TRACE_DIR', os.path.join(tempfile.gettempdir(), 'shuffler-trace'))
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', '0'))
+TRACE_MAX_BYTES = int(os.getenv('TRACE_MAX_BYTES', str(10 * 1024 * 1024)))
+TRACE_BACKUP_COUNT = int(os.getenv('TRACE_BACKUP_COUNT', '5'))
+
+
 # Password validation
 # https://docs.djangoproject.com/en/4.0/ref/settings/#auth-password-validators
 
@@ -134,5 +224,64 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 STATIC_ROOT = BASE_DIR / "static"
 
+# Spotify Web API
+# SPOTIFY_API_URL and SPOTIFY_ACCOUNTS_URL, where users log in and tokens are requested,
+# can be pointed at a local stand-in (see main/fake_spotify.py)
+
+SPOTIFY_API_URL = os.getenv('SPOTIFY_API_URL', 'https://api.spotify.com/v1/')
+SPOTIFY_ACCOUNTS_URL = os.getenv('SPOTIFY_ACCOUNTS_URL', 'https://accounts.spotify.com/')
+
+# Connections kept alive per Spotify host by the shared session in main/spotify_utils.py.
+# Should be at least SPOTIFY_FETCH_WORKERS.
+SPOTIFY_HTTP_POOL_SIZE = int(os.getenv('SPOTIFY_HTTP_POOL_SIZE', '16'))
+# Seconds to wait for a response from Spotify
+SPOTIFY_HTTP_TIMEOUT = float(os.getenv('SPOTIFY_HTTP_TIMEOUT', '10'))
+# Retries for idempotent requests that fail with a connection error, 429 or 5xx
+SPOTIFY_HTTP_RETRIES = int(os.getenv('SPOTIFY_HTTP_RETRIES', '3'))
+SPOTIFY_HTTP_BACKOFF = float(os.getenv('SPOTIFY_HTTP_BACKOFF', '0.3'))
+
+# Rate limit and circuit breaker shared by every worker on the machine (see
+# main/ratelimit.py). Calls per second, and how many may go out at once after a quiet
+# spell; a rate of 0 only honours Retry-After. Calls that would wait longer than
+# SPOTIFY_RATE_LIMIT_MAX_WAIT seconds fail instead.
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', '50'))
+SPOTIFY_RATE_LIMIT_BURST = int(os.getenv('SPOTIFY_RATE_LIMIT_BURST', '100'))
+SPOTIFY_RATE_LIMIT_MAX_WAIT = float(os.getenv('SPOTIFY_RATE_LIMIT_MAX_WAIT', '10'))
+SPOTIFY_RATE_LIMIT_FILE = os.getenv('SPOTIFY_RATE_LIMIT_FILE',
+    os.path.join(tempfile.gettempdir(), 'shuffler-ratelimit'))
+# Consecutive 5xx responses or connection errors that open the circuit, and the seconds
+# it then stays open for
+SPOTIFY_CIRCUIT_FAILURES = int(os.getenv('SPOTIFY_CIRCUIT_FAILURES', '5'))
+SPOTIFY_CIRCUIT_COOLDOWN = float(os.getenv('SPOTIFY_CIRCUIT_COOLDOWN', '30'))
+
+# Market sent with track requests. 'from_token' uses the user's country and makes
+# Spotify leave the available_markets lists out of its responses.
+SPOTIFY_MARKET = os.getenv('SPOTIFY_MARKET', 'from_token')
+
+# Serve select, playlists and queue with the async views in main/async_views.py.
+# Only useful when running under ASGI, for example with
+#   gunicorn shuffler.asgi:application -k uvicorn.workers.UvicornWorker
+# WhiteNoise is sync only, so static files are still served on a thread. An async
+# worker serves every user from one connection pool, so it gets a bigger one.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '0') == '1'
+SPOTIFY_ASYNC_POOL_SIZE = int(os.getenv('SPOTIFY_ASYNC_POOL_SIZE', '100'))
+
+# Maximum number of track pages requested from Spotify at the same time
+SPOTIFY_FETCH_WORKERS = int(os.getenv('SPOTIFY_FETCH_WORKERS', '8'))
+
+# In sampled mode (the "huge playlists" option of the select page) only this many
+# times queue_limit tracks are fetched, picked uniformly from the selected playlists
+SAMPLE_POOL_FACTOR = int(os.getenv('SAMPLE_POOL_FACTOR', '5'))
+
+# Listening history stored in the database by main/history.py. It is synced with
+# Spotify at most once per HISTORY_SYNC_INTERVAL seconds, and recency scoring looks
+# at the last HISTORY_RECENCY_LIMIT plays.
+HISTORY_SYNC_INTERVAL = int(os.getenv('HISTORY_SYNC_INTERVAL', '60'))
+HISTORY_RECENCY_LIMIT = int(os.getenv('HISTORY_RECENCY_LIMIT', '5000'))
+
+# Shuffler scoring backend: 'python', or 'numpy' to score whole playlists in one batch.
+# Falls back to 'python' when numpy is not installed.
+SHUFFLE_BACKEND = os.getenv('SHUFFLE_BACKEND', 'python')
+
 import django_heroku
 django_heroku.settings(locals())
\ No newline at end of file